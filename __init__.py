@@ -39,4 +39,62 @@ tags: Contains the Tags class used to access the Tags API
 
 lists: Contains the NBLists class used to access the Lists API.
 
+nb_async: Contains the AsyncNationBuilder class, whose API methods return
+    futures instead of blocking.
+
+transport: Contains the transports requests are sent with: the default
+    Httplib2Transport, and PooledTransport, a thread safe pool of keep-alive
+    connections.
+
+ratelimit: Contains the RateLimiter class, which all requests to a nation go
+    through.
+
+retry: Contains the RetryPolicy class, which decides which failed requests
+    are tried again.
+
+metrics: Contains the RequestMetrics class, which keeps per-endpoint request
+    counters and latency histograms, and exports them for Prometheus.
+
+spool: Contains the ContactSpool class, which logs contacts in the
+    background from a durable spool file.
+
+pool: helper for running lots of API calls on a bounded number of threads.
+
+cache: Contains the LRUCache class, for caching person reads.
+
+httpcache: Contains the ResponseCache class, an on-disk cache of responses
+    that are revalidated with conditional requests.
+
+mirror: Contains the PeopleMirror class, which keeps a local SQLite copy of
+    a nation's people up to date and can be searched offline.
+
+lookup: Contains the PersonIndex class, a local index of email addresses and
+    phone numbers to NationBuilder IDs.
+
+membership: Contains the MembershipIndex class, a local index of the members
+    of tags and lists that can be combined with and / or / not queries.
+
+spatial: Contains the SpatialIndex class, a local index of people's
+    locations that answers nearby queries offline.
+
+jsondecode: decoding of response bodies, with a choice of JSON module and
+    incremental decoding of paginated responses.
+
+records: compact namedtuple records for the fields=[...] option of the
+    people readers.
+
+export: streams the records of a paginated endpoint to an NDJSON, CSV or
+    Parquet file.
+
+storage: helpers for saving the local indexes and state files atomically.
+
+checkpoint: Contains the Checkpoint class, which lets long paginated walks
+    be resumed where they stopped.
+
+pagesize: Contains the PageSizer class, which adapts the page size of
+    per_page='auto' walks to how quickly the pages arrive.
+
+paging: helpers for walking paginated endpoints, including fetching pages
+    ahead of time on background threads.
+
 """
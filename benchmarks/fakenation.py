@@ -0,0 +1,264 @@
+# fakenation.py ---
+#
+# Filename: fakenation.py
+# Description: Fake NationBuilder API server for the benchmarks.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A fake NationBuilder API server, serving synthetic people, lists, tags and
+contacts over plain HTTP on localhost.
+
+The data is generated from the person IDs, so it is the same on every run
+and takes no memory: person n is on list 1 if n <= list_size, and has the
+tag 'bench' if n is even. Writes (tagging, contacts, person updates) are
+acknowledged but not stored.
+
+Classes:
+    FakeNation
+     -- the server. start() returns the base URL, and point_at() makes a
+        NationBuilder talk to it instead of nationbuilder.com.
+
+Functions:
+    point_at(nation, url)
+     -- makes a NationBuilder talk to the server at url, e.g. one started
+        by another process.
+
+Example usage:
+
+server = FakeNation(people=10000, latency=0.005)
+server.start()
+nb = server.point_at(NationBuilder('bench', 'token'))
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import re
+import threading
+import time
+import urlparse
+
+_PERSON = (
+    '{"id": %(id)d, "first_name": "First%(id)d", "last_name": "Last%(id)d", '
+    '"email": "person%(id)d@example.com", "email_opt_in": true, '
+    '"phone": "555-%(phone)07d", "mobile": null, "sex": "%(sex)s", '
+    '"birthdate": null, "employer": null, "occupation": null, '
+    '"external_id": null, "ngp_id": null, "van_id": null, '
+    '"salesforce_id": null, "membership_level_id": null, "support_level": '
+    '%(support)d, "is_volunteer": %(volunteer)s, "recruiter_id": null, '
+    '"tags": [%(tags)s], "created_at": "2013-0%(month)d-01T10:00:00-07:00", '
+    '"updated_at": "2014-0%(month)d-15T10:00:00-07:00", '
+    '"primary_address": {"address1": "%(id)d Main St", "city": "Springfield",'
+    ' "state": "IL", "zip": "6270%(zip)d", "country_code": "US", '
+    '"lat": "39.78%(id)d", "lng": "-89.65%(id)d"}}')
+
+
+def person_json(nb_id):
+    """Returns the JSON of the abbreviated record of person nb_id."""
+    return _PERSON % {
+        'id': nb_id, 'phone': nb_id % 10000000,
+        'sex': 'MF'[nb_id % 2], 'support': nb_id % 5 + 1,
+        'volunteer': 'true' if nb_id % 7 == 0 else 'false',
+        'tags': '"bench"' if nb_id % 2 == 0 else '',
+        'month': nb_id % 9 + 1, 'zip': nb_id % 10}
+
+
+def _page_json(ids, page, per_page, total, record=person_json):
+    """Returns the JSON of a page of records."""
+    total_pages = max(1, (total + per_page - 1) // per_page)
+    return ('{"page": %d, "total_pages": %d, "per_page": %d, "total": %d, '
+            '"results": [%s]}' % (page, total_pages, per_page, total,
+                                  ', '.join(record(i) for i in ids)))
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # otherwise the end of a large response can wait for the client's
+    # delayed ACK (40ms on Linux), which would swamp the numbers.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def _handle(self, method):
+        nation = self.server.nation
+        if self.headers.get('Content-Length'):
+            self.rfile.read(int(self.headers['Content-Length']))
+        nation._count()
+        if nation.latency:
+            time.sleep(nation.latency)
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        path = re.sub(r'^/api/v1', '', url.path)
+        try:
+            status, body = nation.respond(method, path, query)
+        except Exception as err:
+            status, body = 500, json.dumps({'code': 'server_error',
+                                            'message': str(err)})
+        self._send(status, body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeNation(object):
+
+    """
+    The fake API server.
+
+    Public attributes:
+        people : the number of people in the nation.
+        list_size : the number of people on list 1.
+        latency : seconds to wait before answering each request.
+        requests : the number of requests answered.
+    """
+
+    def __init__(self, people=10000, list_size=None, latency=0.0):
+        self.people = people
+        self.list_size = people if list_size is None else list_size
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        """Starts serving on a free port, and returns the base URL."""
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.nation = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def point_at(self, nation):
+        """Makes a NationBuilder talk to this server, and returns it."""
+        return point_at(nation, self.url)
+
+    def _page(self, query, total, record=person_json, first_id=1):
+        page = int(query.get('page', 1))
+        per_page = min(int(query.get('per_page', 10)), 100)
+        start = (page - 1) * per_page + first_id
+        end = min(start + per_page, first_id + total)
+        return 200, _page_json(xrange(start, end), page, per_page, total,
+                               record)
+
+    def respond(self, method, path, query):
+        """Returns the (status, body) of a request."""
+        match = re.match(r'^/people/(\d+)(/.*)?$', path)
+        if match:
+            nb_id = int(match.group(1))
+            if nb_id > self.people:
+                return 404, '{"code": "not_found"}'
+            rest = match.group(2)
+            if rest is None:
+                if method == 'DELETE':
+                    return 204, ''
+                return 200, '{"person": %s}' % person_json(nb_id)
+            if rest == '/taggings':
+                if method == 'PUT':
+                    return 200, '{"tagging": {"person_id": %d}}' % nb_id
+                return 200, ('{"taggings": [%s]}' % (
+                    '{"tag": "bench"}' if nb_id % 2 == 0 else ''))
+            if rest.startswith('/taggings/'):
+                return 204, ''
+            if rest == '/contacts':
+                if method == 'POST':
+                    return 200, '{"contact": {"person_id": %d}}' % nb_id
+                return self._page(query, 20, _contact_json)
+            return 404, '{"code": "not_found"}'
+        if path in ('/people', '/people/search', '/people/nearby'):
+            return self._page(query, self.people)
+        if path == '/lists':
+            return self._page(query, 10, _list_json)
+        if path == '/lists/1/people':
+            return self._page(query, self.list_size)
+        if path == '/tags':
+            return self._page(query, 1, lambda i: '{"name": "bench"}')
+        if path == '/tags/bench/people':
+            # the even IDs.
+            total = self.people // 2
+            page = int(query.get('page', 1))
+            per_page = min(int(query.get('per_page', 10)), 100)
+            start = (page - 1) * per_page
+            ids = xrange(2 * start + 2, 2 * min(start + per_page, total) + 1,
+                         2)
+            return 200, _page_json(ids, page, per_page, total)
+        if path == '/people/match':
+            match = re.match(r'person(\d+)@example.com',
+                             query.get('email', ''))
+            if match and int(match.group(1)) <= self.people:
+                return 200, '{"person": %s}' % person_json(
+                    int(match.group(1)))
+            return 400, '{"code": "no_matches"}'
+        return 404, '{"code": "not_found"}'
+
+
+def point_at(nation, url):
+    """Rewrites the URLs of a NationBuilder's session to point at the
+    server at url, and returns the NationBuilder."""
+    session = nation.session
+    for name, value in vars(session).items():
+        if isinstance(value, basestring) and value.startswith('https://'):
+            setattr(session, name, re.sub(r'^https://[^/]+', url, value))
+    return nation
+
+
+def _contact_json(i):
+    return ('{"type_id": 1, "method": "phone_call", "sender_id": 1, '
+            '"note": "contact %d", "status": "answered"}' % i)
+
+
+def _list_json(i):
+    return ('{"id": %d, "name": "List %d", "slug": "list%d", '
+            '"count": 100}' % (i, i, i))
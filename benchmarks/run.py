@@ -0,0 +1,364 @@
+# run.py ---
+#
+# Filename: run.py
+# Description: Benchmarks of the API client against a fake nation.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Benchmarks of pagination, JSON handling and connection reuse, run against
+the fake nation in fakenation.py.
+
+The fake server runs in this process; each scenario runs in a child
+process, so that the scenarios don't share a GIL with the server and each
+gets its own peak RSS. For every scenario the requests/s, records/s, p50
+and p99 request latency (measured by the client) and peak RSS of the child
+are reported.
+
+The startup scenario measures what a short-lived program pays before its
+first request: the median over several fresh interpreters of the time to
+import nationbuilder, to create a NationBuilder, and to make the first
+get_person() request, and the number of modules imported.
+
+Usage:
+
+    python benchmarks/run.py [--latency MS] [--people N] [--list-size N]
+                             [--workers N] [--transport {httplib2,pooled}]
+                             [--startup-runs N] [--only SCENARIO ...]
+                             [--output results.json]
+                             [--baseline old.json] [--tolerance 0.1]
+
+With --baseline, scenarios whose records/s fell by more than the tolerance
+compared to a previous --output file are reported as regressions, as are
+startup times that grew by more than the tolerance (and more than 10
+milliseconds, which is about the noise), and the exit status is 1.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+# the library modules import each other as top level modules.
+sys.path.insert(0, ROOT)
+
+# run with python -c in a fresh interpreter; prints the startup timings.
+_STARTUP = """
+import sys, time
+started = time.time()
+sys.path[:0] = [%(root)r, %(here)r]
+from nationbuilder import NationBuilder
+imported = time.time()
+modules = len(sys.modules)
+nb = NationBuilder('bench', 'token')
+created = time.time()
+from fakenation import point_at
+point_at(nb, %(url)r)
+if %(pooled)r:
+    from transport import PooledTransport
+    nb.session.transport = PooledTransport('token')
+requested = time.time()
+nb.people.get_person(1)
+done = time.time()
+import json
+print json.dumps({'import_ms': (imported - started) * 1000,
+                  'create_ms': (created - imported) * 1000,
+                  'first_request_ms': (done - requested) * 1000,
+                  'modules': modules})
+"""
+
+# the startup measurements that are compared with a baseline, and the
+# number of milliseconds they may grow by regardless of the tolerance.
+STARTUP_TIMES = ('import_ms', 'create_ms', 'first_request_ms')
+STARTUP_SLACK_MS = 10.0
+
+
+def _nation(url, transport, workers):
+    from nationbuilder import NationBuilder
+    from fakenation import point_at
+    from transport import PooledTransport
+    if transport == 'pooled':
+        transport = PooledTransport(pool_size=workers)
+    else:
+        transport = None
+    return point_at(NationBuilder('bench', 'token', transport=transport),
+                    url)
+
+
+def people_walk(args, nb, prefetch=0):
+    """get_people_iter() over the whole nation."""
+    count = 0
+    for _ in nb.people.get_people_iter(prefetch=prefetch):
+        count += 1
+    return count
+
+
+def people_walk_prefetch(args, nb):
+    """get_people_iter(prefetch=workers) over the whole nation."""
+    return people_walk(args, nb, args.workers)
+
+
+def people_walk_compact(args, nb):
+    """get_people_iter() with incremental decoding and field projection."""
+    nb.session.incremental_json = True
+    count = 0
+    for _ in nb.people.get_people_iter(prefetch=args.workers,
+                                       fields=['id', 'email']):
+        count += 1
+    return count
+
+
+def list_members(args, nb):
+    """Lists.get_list() of list 1 (list_size members)."""
+    return len(nb.lists.get_list(1, per_page=100, workers=args.workers))
+
+
+def list_members_auto(args, nb):
+    """Lists.get_list() of list 1 with per_page='auto'."""
+    return len(nb.lists.get_list(1, per_page='auto', workers=args.workers))
+
+
+def tag_bulk(args, nb):
+    """NBTags.tag_people() of the first 'writes' people."""
+    report = nb.tags.tag_people(xrange(1, args.writes + 1), 'bench',
+                                workers=args.workers)
+    return len(report['succeeded'])
+
+
+def person_storm(args, nb):
+    """get_person() of the first 'lookups' people, on 'workers' threads."""
+    from pool import map_concurrently
+    count = 0
+    for _, _, error in map_concurrently(nb.people.get_person,
+                                        xrange(1, args.lookups + 1),
+                                        args.workers):
+        if error is not None:
+            raise error
+        count += 1
+    return count
+
+
+def contact_spool(args, nb):
+    """ContactSpool.log_contact() of 'writes' contacts, until all are sent."""
+    import shutil
+    import tempfile
+    from spool import ContactSpool
+    directory = tempfile.mkdtemp()
+    try:
+        spool = ContactSpool(nb.contacts, os.path.join(directory, 'spool'),
+                             workers=args.workers)
+        for nb_id in xrange(1, args.writes + 1):
+            spool.log_contact(nb_id, 5, 'door_knock', 1)
+        spool.close()
+        return spool.sent
+    finally:
+        shutil.rmtree(directory)
+
+
+SCENARIOS = [people_walk, people_walk_prefetch, people_walk_compact,
+             list_members, list_members_auto, tag_bulk, contact_spool,
+             person_storm]
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X.
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024.0
+
+
+def run_scenario(args):
+    """Runs one scenario in this (child) process, and prints the result as
+    JSON."""
+    scenario = dict((func.__name__, func) for func in SCENARIOS)[args.child]
+    nb = _nation(args.url, args.transport, args.workers)
+    latencies = []
+
+    def hook(event):
+        if event['type'] == 'request':
+            latencies.append(event['latency'])
+    nb.session.add_hook(hook)
+    started = time.time()
+    records = scenario(args, nb)
+    seconds = time.time() - started
+    print json.dumps({
+        'scenario': args.child,
+        'seconds': seconds,
+        'requests': len(latencies),
+        'records': records,
+        'requests_per_s': len(latencies) / seconds,
+        'records_per_s': records / seconds,
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': _peak_rss_mb(),
+    })
+    sys.stdout.flush()
+    # skip the interpreter teardown, which the idle daemon worker threads
+    # would complain about.
+    os._exit(0)
+
+
+def run_startup(args, url):
+    """Measures startup in 'startup_runs' fresh interpreters, and returns
+    the median of each measurement."""
+    code = _STARTUP % {'root': ROOT, 'here': HERE, 'url': url,
+                       'pooled': args.transport == 'pooled'}
+    runs = []
+    for _ in xrange(args.startup_runs):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return dict((key, _percentile([run[key] for run in runs], 0.5))
+                for key in runs[0])
+
+
+def _child_args(args, name, url):
+    return [sys.executable, os.path.abspath(__file__), '--child', name,
+            '--url', url, '--workers', str(args.workers),
+            '--transport', args.transport,
+            '--writes', str(args.writes), '--lookups', str(args.lookups)]
+
+
+def compare(results, baseline, tolerance):
+    """Returns the names of the scenarios whose records/s fell by more than
+    tolerance (a fraction) compared to the baseline results."""
+    old = dict((result['scenario'], result) for result in baseline)
+    regressions = []
+    for result in results:
+        before = old.get(result['scenario'])
+        if before is None:
+            continue
+        if result['records_per_s'] < before['records_per_s'] * (1 - tolerance):
+            regressions.append(result['scenario'])
+    return regressions
+
+
+def compare_startup(startup, baseline, tolerance):
+    """Returns the startup measurements that grew by more than tolerance
+    (a fraction), and by more than STARTUP_SLACK_MS, compared to the
+    baseline."""
+    regressions = []
+    for key in STARTUP_TIMES:
+        if key not in baseline:
+            continue
+        limit = max(baseline[key] * (1 + tolerance),
+                    baseline[key] + STARTUP_SLACK_MS)
+        if startup[key] > limit:
+            regressions.append('startup %s' % key)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=2.0,
+                        help="server latency per request, in ms")
+    parser.add_argument('--people', type=int, default=20000)
+    parser.add_argument('--list-size', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--transport', choices=('httplib2', 'pooled'),
+                        default='httplib2',
+                        help="the transport the client uses")
+    parser.add_argument('--writes', type=int, default=2000,
+                        help="people tagged by tag_bulk, and contacts logged "
+                             "by contact_spool")
+    parser.add_argument('--lookups', type=int, default=5000,
+                        help="people fetched by person_storm")
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help="interpreters started by the startup scenario")
+    parser.add_argument('--only', nargs='*',
+                        help="the scenarios to run, including 'startup' "
+                        "(default: all)")
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_scenario(args)
+        return 0
+
+    from fakenation import FakeNation
+    server = FakeNation(people=max(args.people, args.writes, args.lookups),
+                        list_size=args.list_size,
+                        latency=args.latency / 1000.0)
+    url = server.start()
+    names = args.only or ['startup'] + [func.__name__
+                                        for func in SCENARIOS]
+    startup = None
+    if 'startup' in names:
+        names.remove('startup')
+        startup = run_startup(args, url)
+        print '%-22s %9s %9s %11s %9s' % ('startup', 'import ms',
+                                          'create ms', 'request ms',
+                                          'modules')
+        print '%-22s %9.1f %9.2f %11.1f %9d' % (
+            '', startup['import_ms'], startup['create_ms'],
+            startup['first_request_ms'], startup['modules'])
+        print
+    results = []
+    if names:
+        print '%-22s %9s %9s %11s %9s %9s %9s' % (
+            'scenario', 'seconds', 'req/s', 'records/s', 'p50 ms', 'p99 ms',
+            'RSS MB')
+    for name in names:
+        output = subprocess.check_output(_child_args(args, name, url))
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print '%-22s %9.2f %9.0f %11.0f %9.2f %9.2f %9.1f' % (
+            name, result['seconds'], result['requests_per_s'],
+            result['records_per_s'], result['p50_ms'], result['p99_ms'],
+            result['peak_rss_mb'])
+    server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'settings': {'latency': args.latency,
+                                    'people': args.people,
+                                    'list_size': args.list_size,
+                                    'workers': args.workers,
+                                    'transport': args.transport},
+                       'startup': startup,
+                       'results': results}, out, indent=2)
+    if args.baseline:
+        with open(args.baseline) as saved:
+            baseline = json.load(saved)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if startup is not None and baseline.get('startup'):
+            regressions += compare_startup(startup, baseline['startup'],
+                                           args.tolerance)
+        for name in regressions:
+            print 'REGRESSION: %s' % name
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
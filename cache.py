@@ -0,0 +1,162 @@
+# cache.py ---
+#
+# Filename: cache.py
+# Description: In-process caching of NationBuilder records.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+In-process caching of records read from the API.
+
+Classes:
+    LRUCache
+     -- size-bounded, least-recently-used cache with per-entry expiry, used
+        to cache person reads. Entries can be grouped (e.g. by person ID) so
+        that everything cached about a person can be dropped at once.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+
+    """
+    A thread safe LRU cache whose entries expire 'ttl' seconds after they
+    were stored.
+
+    When passed to NationBuilder(person_cache=...), get_person(),
+    get_person_by_email(), match_person() and NBTags.get_person_tags() are
+    served from it, and the methods that change a person (update_person(),
+    tag_person(), delete_person(), ...) update or drop that person's entries.
+
+    Note that cached records are returned as-is, so they shouldn't be
+    modified by the caller.
+
+    Public attributes:
+        hits, misses, evictions, expirations : counters for sizing the cache.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        """
+        Parameters:
+            max_size : the maximum number of entries to keep.
+            ttl : the number of seconds an entry is valid for. None means
+                entries only leave the cache when evicted or invalidated.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expiry time, value, group)
+        self._entries = OrderedDict()
+        # group -> set of keys
+        self._groups = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns the value stored for key, or None if there isn't a valid
+        one."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                self._forget(key, entry)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # re-insert to mark it as the most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, group=None):
+        """
+        Stores value for key.
+
+        Parameters:
+            key : the cache key.
+            value : the value to store. None values are not stored.
+            group : optional group the entry belongs to, for
+                invalidate_group().
+        """
+        if value is None:
+            return
+        expiry = None
+        if self.ttl is not None:
+            expiry = time.time() + self.ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            self._entries[key] = (expiry, value, group)
+            if group is not None:
+                self._groups.setdefault(group, set()).add(key)
+            while len(self._entries) > self.max_size:
+                old_key, old = self._entries.popitem(last=False)
+                self._forget(old_key, old)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops the entry for key, if there is one."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._forget(key, entry)
+
+    def invalidate_group(self, group):
+        """Drops all of the entries in a group."""
+        with self._lock:
+            for key in self._groups.pop(group, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Drops everything."""
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+
+    def stats(self):
+        """Returns the cache counters and size as a dict."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _forget(self, key, entry):
+        """Removes key from its group. Call with the lock held, after
+        removing the entry itself."""
+        group = entry[2]
+        if group is not None:
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
@@ -0,0 +1,111 @@
+# checkpoint.py ---
+#
+# Filename: checkpoint.py
+# Description: Resumable paginated walks.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Checkpoints for resuming long paginated walks.
+
+Pass a Checkpoint to one of the people readers (get_people_iter(),
+Lists.get_list_iter(), search_iter(), ...) and the iterator saves its
+position to a file every few pages. If the walk is interrupted, running it
+again with the same checkpoint file starts from the saved page instead of
+page 1. The file is deleted once the walk has finished.
+
+The position is a page number, so records added to or removed from the
+endpoint during the walk can shift records between pages, just as they can
+during any walk.
+
+Classes:
+    Checkpoint
+     -- the file the position (cursor) of a walk is saved in.
+
+Example usage:
+
+checkpoint = Checkpoint('people.ckpt', every=10)
+for person in nb.people.get_people_iter(prefetch=4, checkpoint=checkpoint):
+    process(person)
+"""
+
+import json
+import os
+import urllib
+import urlparse
+
+from storage import atomic_write
+
+
+class Checkpoint(object):
+
+    """
+    A file holding the cursor of a paginated walk: a dict with the
+    endpoint, query and per_page identifying the walk, the page and offset
+    into the page of the next record, and the count of records already
+    yielded.
+
+    Public attributes:
+        path : the checkpoint file.
+        every : the number of pages between saves.
+    """
+
+    def __init__(self, path, every=10):
+        """
+        Parameters:
+            path : the file to save the cursor in.
+            every : save the cursor every this many pages. The cursor is
+                saved as the iterator moves on to the next page, i.e. after
+                the consumer has finished with the records of the previous
+                one.
+        """
+        self.path = path
+        self.every = every
+
+    def load(self):
+        """Returns the saved cursor, or None if there isn't one."""
+        try:
+            with open(self.path) as saved:
+                return json.load(saved)
+        except IOError:
+            return None
+
+    def save(self, cursor):
+        """Saves a cursor, replacing the previous one atomically."""
+        with atomic_write(self.path) as out:
+            json.dump(cursor, out)
+
+    def clear(self):
+        """Deletes the checkpoint, as the walk has finished."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def walk_id(url, per_page):
+    """
+    Returns the part of a cursor that identifies a walk, from the URL of
+    any of its pages: the endpoint path, the query without the paging
+    parameters, and per_page (a number, or 'auto' for adaptive page sizes).
+    """
+    parts = urlparse.urlsplit(url)
+    query = [(key, value) for key, value in urlparse.parse_qsl(parts.query)
+             if key not in ('page', 'per_page')]
+    if per_page != 'auto':
+        per_page = int(per_page)
+    return {'endpoint': parts.path, 'query': urllib.urlencode(sorted(query)),
+            'per_page': per_page}
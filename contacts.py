@@ -21,18 +21,38 @@
 #
 
 import nb_api
+from paging import PageIterator
 import json
 
 
+def contact_body(contact_type, contact_method, sender_id, status=None,
+                 broadcaster=None, note=None):
+    """Returns the request body that logs a contact, with the parameters of
+    Contacts.log_contact()."""
+    contact = {
+        "sender_id": sender_id,
+        "method": contact_method,
+        "type_id": contact_type,
+    }
+    if broadcaster is not None:
+        contact['broadcaster_id'] = broadcaster
+    if status is not None:
+        contact['status'] = status
+    if note is not None:
+        contact['note'] = note
+    return {"contact": contact}
+
+
 class Contacts(nb_api.NationBuilderApi):
 
-    def __init__(self, nation_slug, api_key):
-        super(Contacts, self).__init__(nation_slug, api_key)
+    def __init__(self, nation_slug, api_key, session=None):
+        super(Contacts, self).__init__(nation_slug, api_key, session)
 
     def log_contact(self, nb_id, contact_type, contact_method, sender_id,
                     status=None, broadcaster=None, note=None):
         """
-        Log a contact.
+        Log a contact. This blocks until the contact has been sent; see
+        nbpy.spool.ContactSpool for logging contacts in the background.
 
         Required Parameters:
             nb_id : The NationBuilder ID of the person who was contacted.
@@ -59,57 +79,60 @@ class Contacts(nb_api.NationBuilderApi):
         }
         }
         """
+        body = contact_body(contact_type, contact_method, sender_id, status,
+                            broadcaster, note)
+        return self._decode(self._post_contact(nb_id, body))
+
+    def _post_contact(self, nb_id, body):
+        """POSTs a contact body (see contact_body()) for the person with
+        nb_id, and returns the response content."""
         self._authorise()
         url = self.GET_CONTACT_URL.format(nb_id)
-        update = {
-            "contact": {
-                "sender_id": sender_id,
-                "method": contact_method,
-                "type_id": contact_type,
-            }
-        }
-        if broadcaster is not None:
-            update['contact']['broadcaster_id'] = broadcaster
-        if status is not None:
-            update['contact']['status'] = status,
-        if note is not None:
-            update['contact']['note'] = note
-
-        update = json.dumps(update)
-        print str(update)
-
-        header, content = self.http.request(url, headers=self.HEADERS,
-                                            method='POST', body=str(update))
+        header, content = self.session.request(url, headers=self.HEADERS,
+                                               method='POST',
+                                               body=json.dumps(body))
         self._check_response(header, content, "Log Contact", url)
-        return json.loads(content)
+        return content
 
-    def get_person_contacts(self, nb_id, per_page=100):
+    def get_person_contacts(self, nb_id, per_page=100, workers=0):
         """
         Get all contacts for a person.
 
         Parameters:
             nb_id : the NationBuilder ID of the person.
             per_page : the number of contacts to fetch at once.
+            workers : once the number of pages is known, fetch the rest of
+                the pages on this many threads at once. Defaults to 0, which
+                fetches them one after another.
 
         Returns a list of contacts.
         """
+        return list(self.get_person_contacts_iter(nb_id, per_page, workers))
+
+    def get_person_contacts_iter(self, nb_id, per_page=100, prefetch=0):
+        """
+        Iterator version of get_person_contacts().
+
+        Parameters:
+            nb_id : the NationBuilder ID of the person.
+            per_page : the number of contacts to fetch at once.
+            prefetch : the number of pages to fetch in the background ahead
+                of the one being consumed. Defaults to 0.
+
+        Returns a nbpy.paging.PageIterator of contacts.
+        """
         base_url = self.GET_CONTACT_URL.format(nb_id) + self.PAGINATE_QUERY
 
         def get_person_contact_page(page):
             self._authorise()
             url = base_url.format(page=page, per_page=per_page)
-            header, content = self.http.request(uri=url, headers=self.HEADERS)
+            header, content = self.session.request(uri=url,
+                                                   headers=self.HEADERS)
             self._check_response(
                 header, content, "Get Person Contact page", url)
-            return json.loads(content)
-
-        first_page = get_person_contact_page(1)
-        total_pages = first_page['total_pages']
-        result = first_page['results']
-        for page_no in range(2, total_pages + 1):
-            result += get_person_contact_page(page_no)['results']
+            return self._decode_page(content)
 
-        return result
+        return PageIterator(get_person_contact_page, prefetch)
 
     def list_contact_types(self):
         """
@@ -171,6 +194,5 @@ class Contacts(nb_api.NationBuilderApi):
         """
         self._authorise()
         url = self.CONTACT_STATUS_URL
-        hdr, cont = self.http.request(uri=url, headers=self.HEADERS)
-        self._check_response(hdr, cont, "List Contact Statuses", url)
-        return json.loads(cont)['results']
+        return self._get_json(url, "List Contact Statuses",
+                              cacheable=True)['results']
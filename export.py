@@ -0,0 +1,391 @@
+# export.py ---
+#
+# Filename: export.py
+# Description: Streaming export of records to files.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Streaming export of the records of a paginated endpoint to a file.
+
+The records are read in the calling thread (which, with prefetch, also
+keeps the page requests going) and handed to a writer thread in batches,
+so writing to disk overlaps with fetching. Only a few batches are in memory
+at any time, however many records there are.
+
+Functions:
+    export(records, path, format=None, fields=None, compression=None,
+           batch_size=1000)
+     -- writes records to path as NDJSON, CSV or Parquet, optionally
+        compressed.
+
+Formats:
+    ndjson : one JSON object per line.
+    csv : a header row followed by one row per record. Values that are
+        lists or dicts (e.g. addresses) are written as JSON.
+    parquet : a columnar file, written one row group per batch. Needs the
+        pyarrow package.
+
+Example usage:
+
+nb = nbpy.nationbuilder.NationBuilder("slug", MY_API_KEY)
+export(nb.lists.get_list_iter(5, prefetch=4), "list5.csv.gz",
+       fields=['id', 'first_name', 'last_name', 'email'])
+export(nb.people.get_people_iter(prefetch=4), "people.ndjson")
+"""
+
+import bz2
+import csv
+import gzip
+import json
+import logging
+import os
+import Queue
+import sys
+import threading
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = logging.getLogger('nbpy')
+
+# file extension -> format / compression
+_FORMATS = {'.ndjson': 'ndjson', '.jsonl': 'ndjson', '.json': 'ndjson',
+            '.csv': 'csv', '.parquet': 'parquet'}
+_COMPRESSIONS = {'.gz': 'gzip', '.bz2': 'bz2'}
+
+# the number of batches queued for the writer thread.
+_QUEUE_DEPTH = 4
+
+# tells the writer thread that there are no more batches.
+_STOP = object()
+
+
+def export(records, path, format=None, fields=None, compression=None,
+           batch_size=1000):
+    """
+    Writes records to a file.
+
+    Parameters:
+        records : an iterable of record dicts or namedtuples, e.g. the
+            iterator returned by get_list_iter() or get_people_iter().
+        path : the file to write.
+        format : 'ndjson', 'csv' or 'parquet'. By default it is worked out
+            from the extension of path (e.g. people.csv.gz).
+        fields : the fields to write. By default all of them: the fields of
+            namedtuple records, or the keys of the first record dict.
+        compression : 'gzip' or 'bz2', or None for no compression. By
+            default it is worked out from the extension of path. For parquet
+            files this is the compression codec of the columns (e.g.
+            'snappy').
+        batch_size : the number of records handed to the writer thread at a
+            time.
+
+    If records is an iterator with a checkpoint (e.g.
+    get_people_iter(checkpoint=...)), the cursor is saved after each batch
+    has been written to disk, together with the size of the file. Running the
+    same export again then truncates the file to that size and carries on
+    from the cursor. Only uncompressed NDJSON and CSV exports can be resumed.
+
+    Returns:
+        the number of records written by this call.
+    """
+    root, ext = os.path.splitext(path)
+    if compression is None and ext in _COMPRESSIONS:
+        compression = _COMPRESSIONS[ext]
+        root, ext = os.path.splitext(root)
+    if format is None:
+        if ext not in _FORMATS:
+            raise ValueError("Can't tell the format of %s" % path)
+        format = _FORMATS[ext]
+    writers = {'ndjson': _NDJSONWriter, 'csv': _CSVWriter,
+               'parquet': _ParquetWriter}
+    if format not in writers:
+        raise ValueError("Unknown export format %s" % format)
+
+    checkpoint = getattr(records, 'checkpoint', None)
+    resume_at = None
+    if checkpoint is not None:
+        if compression is not None or format == 'parquet':
+            raise ValueError("Only uncompressed NDJSON and CSV exports can "
+                             "be resumed")
+        # the cursor is saved once the records before it are on disk.
+        records.autosave = False
+        if records.resumed_from is not None:
+            resume_at = records.resumed_from.get('file_size')
+            if resume_at is None:
+                raise ValueError("%s wasn't saved by an export"
+                                 % checkpoint.path)
+            log.info("Resuming the export to %s after %d records", path,
+                     records.count)
+        cursor = records.cursor
+    else:
+        cursor = _no_cursor
+
+    records = iter(records)
+    try:
+        first = next(records)
+    except StopIteration:
+        first = None
+    if fields is None and first is not None:
+        fields = _fields(first)
+    writer = writers[format](path, fields, compression, resume_at)
+    thread = _WriterThread(writer, checkpoint)
+    thread.start()
+    count = 0
+    try:
+        if first is not None:
+            batch = [first]
+            for record in records:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    thread.put(batch, cursor())
+                    count += len(batch)
+                    batch = []
+            thread.put(batch, cursor())
+            count += len(batch)
+    finally:
+        thread.finish()
+    if checkpoint is not None:
+        checkpoint.clear()
+    log.info("Exported %d records to %s", count, path)
+    return count
+
+
+def _no_cursor():
+    """The cursor of records that can't be resumed."""
+    return None
+
+
+def _fields(record):
+    """The fields of a namedtuple, or the sorted keys of a dict."""
+    if isinstance(record, dict):
+        return sorted(record)
+    return list(record._fields)
+
+
+def _as_dict(record):
+    if isinstance(record, dict):
+        return record
+    return record._asdict()
+
+
+def _open(path, compression, resume_at=None):
+    """Opens path for writing, through a compressor if asked to. If
+    resume_at is given, the file is truncated to that size and appended
+    to."""
+    if resume_at is not None:
+        out = open(path, 'r+b', 1 << 20)
+        out.truncate(resume_at)
+        out.seek(0, os.SEEK_END)
+        return out
+    if compression is None:
+        return open(path, 'wb', 1 << 20)
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    if compression == 'bz2':
+        return bz2.BZ2File(path, 'wb')
+    raise ValueError("Unknown compression %s" % compression)
+
+
+class _WriterThread(threading.Thread):
+
+    """Writes the batches put into its queue, and holds on to the exception
+    if writing fails so that the producer can re-raise it. With a
+    checkpoint, the cursor that came with each batch is saved once the batch
+    is on disk."""
+
+    def __init__(self, writer, checkpoint=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.writer = writer
+        self.checkpoint = checkpoint
+        self.queue = Queue.Queue(_QUEUE_DEPTH)
+        self.exc_info = None
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _STOP:
+                    break
+                batch, cursor = item
+                self.writer.write(batch)
+                if self.checkpoint is not None:
+                    cursor['file_size'] = self.writer.sync()
+                    self.checkpoint.save(cursor)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            try:
+                self.writer.close()
+            except Exception:
+                if self.exc_info is None:
+                    self.exc_info = sys.exc_info()
+
+    def _check(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def put(self, batch, cursor=None):
+        """Queues a batch, and the cursor after its last record, waiting
+        while the queue is full."""
+        while True:
+            self._check()
+            try:
+                self.queue.put((batch, cursor), True, 1)
+                return
+            except Queue.Full:
+                pass
+
+    def finish(self):
+        """Waits for the queued batches to be written and the file closed."""
+        while self.is_alive():
+            try:
+                self.queue.put(_STOP, True, 1)
+                break
+            except Queue.Full:
+                pass
+        while self.is_alive():
+            self.join(1)
+        self._check()
+
+
+class _FileWriter(object):
+
+    """Base class of the writers of line based files."""
+
+    def __init__(self, path, fields, compression, resume_at=None):
+        self.fields = fields
+        self.out = _open(path, compression, resume_at)
+
+    def sync(self):
+        """Flushes the file to disk, and returns its size."""
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        return self.out.tell()
+
+    def close(self):
+        self.out.close()
+
+
+class _NDJSONWriter(_FileWriter):
+
+    def write(self, batch):
+        lines = []
+        for record in batch:
+            record = _as_dict(record)
+            if self.fields is not None:
+                record = dict((field, record.get(field))
+                              for field in self.fields)
+            lines.append(json.dumps(record))
+        lines.append('')
+        self.out.write('\n'.join(lines))
+
+
+class _CSVWriter(_FileWriter):
+
+    def __init__(self, path, fields, compression, resume_at=None):
+        _FileWriter.__init__(self, path, fields or [], compression,
+                             resume_at)
+        self.writer = csv.writer(self.out)
+        if resume_at is None:
+            self.writer.writerow([_utf8(field) for field in self.fields])
+
+    def write(self, batch):
+        rows = []
+        for record in batch:
+            record = _as_dict(record)
+            rows.append([_cell(record.get(field)) for field in self.fields])
+        self.writer.writerows(rows)
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _cell(value):
+    """Returns a value as it is written to a CSV file."""
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return _utf8(value)
+
+
+class _ParquetWriter(object):
+
+    def __init__(self, path, fields, compression, resume_at=None):
+        if pyarrow is None:
+            raise ImportError("Exporting to parquet needs pyarrow")
+        self.path = path
+        self.fields = fields or []
+        self.compression = compression or 'snappy'
+        self.writer = None
+        self.schema = None
+
+    def _infer_schema(self, columns):
+        """Types each column after its first non-null value. Columns that
+        are all null, or hold lists or dicts, are strings."""
+        types = []
+        for field, column in zip(self.fields, columns):
+            sample = next((v for v in column if v is not None), None)
+            if isinstance(sample, bool):
+                arrow_type = pyarrow.bool_()
+            elif isinstance(sample, (int, long)):
+                arrow_type = pyarrow.int64()
+            elif isinstance(sample, float):
+                arrow_type = pyarrow.float64()
+            else:
+                arrow_type = pyarrow.string()
+            types.append(pyarrow.field(field, arrow_type))
+        return pyarrow.schema(types)
+
+    def write(self, batch):
+        batch = [_as_dict(record) for record in batch]
+        columns = [[record.get(field) for record in batch]
+                   for field in self.fields]
+        if self.schema is None:
+            self.schema = self._infer_schema(columns)
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.path, self.schema, compression=self.compression)
+        arrays = []
+        for field, column in zip(self.schema, columns):
+            if field.type == pyarrow.string():
+                column = [_text(value) for value in column]
+            arrays.append(pyarrow.array(column, type=field.type))
+        table = pyarrow.Table.from_arrays(arrays, schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _text(value):
+    """Returns a value as it is written to a string column."""
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value).decode('utf-8')
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
@@ -0,0 +1,195 @@
+# httpcache.py ---
+#
+# Filename: httpcache.py
+# Description: On-disk cache of API responses, revalidated with ETags.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+On-disk cache of decoded API responses, for conditional requests.
+
+Classes:
+    ResponseCache
+     -- stores the decoded body of a response together with its ETag /
+        Last-Modified validators, keyed by URL. The mostly-static endpoints
+        (Lists.list_lists(), NBTags.list_tags(),
+        Contacts.list_contact_statuses()) send the validators with their
+        requests, and reuse the cached body when the server answers
+        304 Not Modified.
+"""
+
+import cPickle as pickle
+import errno
+import hashlib
+import os
+import threading
+import time
+
+from storage import atomic_write
+
+
+class ResponseCache(object):
+
+    """
+    A directory of cached responses, one file per URL.
+
+    Files are written to a temporary file and renamed into place, so several
+    processes on one host can share the directory. Once the files add up to
+    more than max_size bytes, the least recently used ones are deleted.
+
+    The entries are pickled, so the directory should only be writable by
+    trusted users.
+
+    Public attributes:
+        hits : the number of 304 responses answered from the cache.
+        misses : the number of cacheable requests that needed a full
+            response.
+    """
+
+    def __init__(self, directory, max_size=50 * 1024 * 1024):
+        """
+        Parameters:
+            directory : where to keep the cache. Created if needed.
+            max_size : the maximum total size of the cache files, in bytes.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # path -> ((mtime, size), entry), so unchanged files aren't
+        # unpickled again.
+        self._loaded = {}
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def _path(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url).hexdigest() + '.cache')
+
+    def get(self, url):
+        """
+        Returns the cached entry for url, a dict with 'etag',
+        'last_modified' and 'body' keys, or None if there isn't one.
+        """
+        path = self._path(url)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            loaded = self._loaded.get(path)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+        try:
+            with open(path, 'rb') as cached:
+                entry = pickle.load(cached)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if entry.get('url') != url:
+            return None
+        with self._lock:
+            self._loaded[path] = (signature, entry)
+        return entry
+
+    def validators(self, entry):
+        """Returns the conditional request headers for a cached entry."""
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def hit(self, url):
+        """Records that the entry for url was used, for the LRU eviction."""
+        with self._lock:
+            self.hits += 1
+        path = self._path(url)
+        try:
+            # only the access time changes, so the entry stays loaded.
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    def put(self, url, response, body):
+        """
+        Caches the decoded body of a response, if it has an ETag or
+        Last-Modified header.
+
+        Parameters:
+            url : the requested URL.
+            response : the response headers (a httplib2 Response).
+            body : the decoded response body.
+        """
+        with self._lock:
+            self.misses += 1
+        etag = response.get('etag')
+        last_modified = response.get('last-modified')
+        if not etag and not last_modified:
+            return
+        entry = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                 'body': body}
+        with atomic_write(self._path(url)) as out:
+            pickle.dump(entry, out, pickle.HIGHEST_PROTOCOL)
+        self._evict()
+
+    def clear(self):
+        """Deletes every cached response."""
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                _remove(os.path.join(self.directory, name))
+        with self._lock:
+            self._loaded.clear()
+
+    def _evict(self):
+        """Deletes the least recently used files until the cache is no
+        bigger than max_size."""
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.cache'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size,
+                          path))
+            total += stat.st_size
+        if total <= self.max_size:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_size:
+                break
+            _remove(path)
+            with self._lock:
+                self._loaded.pop(path, None)
+            total -= size
+
+
+def _remove(path):
+    """Deletes a file that another process may already have deleted."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
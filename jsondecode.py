@@ -0,0 +1,149 @@
+# jsondecode.py ---
+#
+# Filename: jsondecode.py
+# Description: Decoding of API response bodies.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Decoding of API response bodies.
+
+The stdlib json module is the slowest part of walking a large nation, so
+the decoder can be swapped for a faster one (ujson or simplejson) when it is
+installed. Paginated responses can also be decoded incrementally, so that
+only one record of a page is turned into objects at a time.
+
+Functions:
+    get_decoder(backend=None)
+     -- returns the loads() function of a JSON backend.
+    decode_page(body, loads=json.loads)
+     -- decodes the page metadata of a paginated response, and returns the
+        'results' as a generator that decodes the records as they are
+        iterated over.
+"""
+
+import json
+import re
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+# the backends get_decoder() tries, fastest first.
+BACKENDS = ('ujson', 'simplejson', 'json')
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# raw_decode() decodes one value at an offset into the body, which the
+# incremental decoding needs. ujson doesn't have it.
+_raw_decode = (simplejson or json).JSONDecoder().raw_decode
+
+
+def get_decoder(backend=None):
+    """
+    Returns the loads() function of a JSON module.
+
+    Parameters:
+        backend : the name of the module ('ujson', 'simplejson' or 'json'),
+            or None for the fastest one that is installed. A module that is
+            asked for by name but isn't installed raises ImportError.
+    """
+    if backend is not None:
+        return __import__(backend).loads
+    for name in BACKENDS:
+        try:
+            return __import__(name).loads
+        except ImportError:
+            pass
+
+
+def decode_page(body, loads=json.loads):
+    """
+    Decodes a page of a paginated endpoint, without decoding its results.
+
+    Returns the page as a dict, whose 'results' is a generator decoding one
+    record at a time. Apart from the lower peak memory, the first record is
+    available without waiting for the whole page to be decoded.
+
+    NationBuilder puts the results after the page metadata. Any members
+    that come after the results are added to the page once the results have
+    been iterated over. If total_pages isn't known before the results, or
+    the body isn't an object with a results array, the body is decoded in
+    full with loads().
+    """
+    try:
+        page, idx = _decode_members(body, _skip(body, 0))
+    except ValueError:
+        page, idx = None, None
+    if idx is None or 'total_pages' not in page:
+        return loads(body)
+    page['results'] = _iter_results(body, idx, page)
+    return page
+
+
+def _skip(body, idx):
+    return _WHITESPACE.match(body, idx).end()
+
+
+def _decode_members(body, idx, page=None):
+    """
+    Decodes the members of the object at body[idx] (or, if page is given,
+    the rest of its members, starting at a ',' or the closing '}') into a
+    dict, stopping at a 'results' array.
+
+    Returns the dict and the offset of the first element of the results
+    array, which is None if there is no results array. Returns (None, None)
+    if body isn't an object.
+    """
+    if page is None:
+        if body[idx:idx + 1] != '{':
+            return None, None
+        page = {}
+        idx = _skip(body, idx + 1)
+    elif body[idx:idx + 1] == ',':
+        idx = _skip(body, idx + 1)
+    while body[idx:idx + 1] == '"':
+        key, idx = _raw_decode(body, idx)
+        idx = _skip(body, idx)
+        if body[idx:idx + 1] != ':':
+            raise ValueError("Expecting : at offset %d" % idx)
+        idx = _skip(body, idx + 1)
+        if key == 'results' and body[idx:idx + 1] == '[':
+            return page, _skip(body, idx + 1)
+        page[key], idx = _raw_decode(body, idx)
+        idx = _skip(body, idx)
+        if body[idx:idx + 1] == ',':
+            idx = _skip(body, idx + 1)
+    if body[idx:idx + 1] != '}':
+        raise ValueError("Expecting } at offset %d" % idx)
+    return page, None
+
+
+def _iter_results(body, idx, page):
+    """Yields the elements of the array starting at body[idx], then decodes
+    the rest of the page's members."""
+    if body[idx:idx + 1] != ']':
+        while True:
+            record, idx = _raw_decode(body, idx)
+            yield record
+            idx = _skip(body, idx)
+            if body[idx:idx + 1] != ',':
+                break
+            idx = _skip(body, idx + 1)
+        if body[idx:idx + 1] != ']':
+            raise ValueError("Expecting , or ] at offset %d" % idx)
+    _decode_members(body, _skip(body, idx + 1), page)
@@ -19,8 +19,10 @@
 #    limitations under the License.
 
 from nb_api import NationBuilderApi
+from paging import PageIterator
+from records import projection
+from checkpoint import walk_id
 
-import json
 import logging
 
 
@@ -30,39 +32,50 @@ class Lists(NationBuilderApi):
     Class for accessing NationBuilder Lists API endpoints.
     """
 
-    def __init__(self, nation_slug, api_key):
-        super(Lists, self).__init__(nation_slug, api_key)
+    def __init__(self, nation_slug, api_key, session=None):
+        super(Lists, self).__init__(nation_slug, api_key, session)
         self.logger = logging.getLogger(__name__)
 
-    def list_lists(self, per_page=100):
+    def list_lists(self, per_page=100, workers=0):
         """
         Get all of the lists in the nation.
+
+        Parameters:
+            per_page: the number of lists to fetch at a time.
+            workers: once the number of pages is known, fetch the rest of the
+                pages on this many threads at once. Defaults to 0, which
+                fetches them one after another.
         """
-        res = self._list_list_page(page=1, per_page=per_page)
-        jres = json.loads(res)
-        i = 2
-        while i <= jres['total_pages']:
-            self.logger.debug("getting page %i of %i", i, jres['total_pages'])
-            more = self._list_list_page(page=i, per_page=per_page)
-            jmore = json.loads(more)
-            jres['results'].extend(jmore['results'])
-            jres['total'] += jmore['total']
-            i += 1
+        lists = self.list_lists_iter(per_page, workers)
+        results = list(lists)
         # make the total number of pages = 1, as we've merged all the pages.
-        jres['total_pages'] = 1
-        jres['per_page'] = jres['total']
+        jres = {'page': 1, 'total_pages': 1, 'total': lists.total,
+                'per_page': lists.total, 'results': results}
         self.logger.debug("lists: %s", jres)
         return jres
 
+    def list_lists_iter(self, per_page=100, prefetch=0):
+        """
+        Iterator over all of the lists in the nation.
+
+        Parameters:
+            per_page: the number of lists to fetch at a time.
+            prefetch: the number of pages to fetch in the background ahead of
+                the one being consumed. Defaults to 0.
+
+        Returns a nbpy.paging.PageIterator of lists, whose total and
+        total_pages are known once the first page arrives.
+        """
+        return PageIterator(lambda p: self._list_list_page(p, per_page),
+                            prefetch)
+
     def _list_list_page(self, page=1, per_page=100):
         """Gets a list of nb_lists available in NB Will do a max of 100."""
         self._authorise()
         url = self.LIST_INDEX_URL.format(page=page, per_page=per_page)
-        hdr, content = self.http.request(url, headers=self.HEADERS)
-        self._check_response(hdr, content, url)
-        return content
+        return self._get_json(url, url, cacheable=True)
 
-    def get_list_page(self, list_id, page_num=1, per_page=50):
+    def get_list_page(self, list_id, page_num=1, per_page=100):
         """
         Gets a single page of results of a list.
 
@@ -74,49 +87,62 @@ class Lists(NationBuilderApi):
         self._authorise()
         url = self.GET_LIST_URL.format(
             list_id=list_id, per_page=per_page, page=page_num)
-        header, content = self.http.request(url, headers=self.HEADERS)
+        header, content = self.session.request(url, headers=self.HEADERS)
         self._check_response(header, content, url)
-        return json.loads(content)
+        return self._decode(content)
 
-    def get_list(self, list_id, per_page=50):
+    def get_list(self, list_id, per_page=100, workers=0, fields=None):
         """
         Gets the people in a list.
         Can take a very long time, as it concatenates all of the pages.
 
-        returns a json array of person records."""
-        # TODO make it a bit more efficient somehow.
-        self._authorise()
-        page = 1
-        lists = []  # Make it a set to avoid duplicates.
-        while True:
-            url = self.GET_LIST_URL.format(list_id=list_id,
-                                           per_page=per_page, page=page)
-            header, content = self.http.request(url, headers=self.HEADERS)
-            self._check_response(header, content, "Get list", url)
-            content = json.loads(content)
-            lists.extend(content['results'])
-            page += 1
-            if page > content['total_pages']:
-                break
+        Parameters:
+            list_id: the ID of the list.
+            per_page: the number of entries to fetch at a time (<= 100),
+                or 'auto' to adapt it to how quickly pages arrive (see
+                nbpy.pagesize).
+            workers: once the number of pages is known, fetch the rest of the
+                pages on this many threads at once. Defaults to 0, which
+                fetches them one after another.
+            fields: a list of field names. If given, the people are returned
+                as namedtuples of just these fields (see nbpy.records),
+                rather than dicts.
 
+        returns a json array of person records."""
+        lists = list(self.get_list_iter(list_id, per_page, workers, fields))
         self.logger.debug("retrieved %d people", len(lists))
         return lists
 
-    def get_list_iter(self, list_id, per_page=100):
+    def get_list_iter(self, list_id, per_page=100, prefetch=0, fields=None,
+                      checkpoint=None):
         """
-        Generator function that gets the people in a list. may be more
+        Gets the people in a list, one page at a time. may be more
         efficient than get_list() in some cases.
+
+        Returns a nbpy.paging.PageIterator of people records, whose total and
+        total_pages are known once the first page arrives.
+
+        Parameters:
+            list_id: the ID of the list.
+            per_page: the number of entries to fetch at a time (<= 100),
+                or 'auto' (see get_list()).
+            prefetch: the number of pages to fetch in the background ahead of
+                the one being consumed (e.g. 1 to 4). Defaults to 0.
+            fields: the fields to return, see get_list().
+            checkpoint: a nbpy.checkpoint.Checkpoint to resume the walk from
+                and save its position to, or None.
         """
-        self._authorise()
-        page = 1
-        while True:
-            url = self.GET_LIST_URL.format(list_id=list_id,
-                                           per_page=per_page, page=page)
-            header, content = self.http.request(url, headers=self.HEADERS)
+        def page_url(page, size=per_page):
+            return self.GET_LIST_URL.format(list_id=list_id,
+                                            per_page=size, page=page)
+
+        def get_list_page(page, size=per_page):
+            self._authorise()
+            url = page_url(page, size)
+            header, content = self.session.request(url, headers=self.HEADERS)
             self._check_response(header, content, "Get list", url)
-            content = json.loads(content)
-            for person in content['results']:
-                yield person
-            page += 1
-            if page > content['total_pages']:
-                break
+            return self._decode_page(content)
+
+        return PageIterator(get_list_page, prefetch, projection(fields),
+                            checkpoint, walk_id(page_url(1), per_page),
+                            self._page_sizer(per_page, page_url(1)))
@@ -0,0 +1,340 @@
+# lookup.py ---
+#
+# Filename: lookup.py
+# Description: Local email / phone to NationBuilder ID index.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A local index from email addresses and phone numbers to NationBuilder IDs.
+
+When passed to NationBuilder(person_index=...), People.get_id_by_email(),
+get_person_by_email() and match_person() (by email, phone or mobile) look
+the person up in the index first, and only ask the API when the index
+doesn't know them.
+
+Classes:
+    PersonIndex
+     -- the index. Keys are stored as 64 bit hashes of the normalised email
+        or phone number in sorted arrays, so a million people take about
+        32MB.
+
+Example usage:
+
+index = PersonIndex('people.idx')
+index.refresh(nb.people)   # full load the first time, incremental later
+index.save()
+nb = nbpy.nationbuilder.NationBuilder("slug", MY_API_KEY, person_index=index)
+nb.people.get_id_by_email('bob@example.com')
+"""
+
+from array import array
+import bisect
+import hashlib
+import logging
+import os
+import re
+import struct
+import threading
+import time
+
+from storage import atomic_write, read_header, write_header
+
+log = logging.getLogger('nbpy')
+
+# the ID arrays hold C longs; the 64 bit key hashes are split into a
+# signed high and an unsigned low 32 bit half, as array has no 64 bit type
+# on platforms (Windows, 32 bit Linux) where a long is 32 bits.
+_TYPECODE = 'l'
+_HIGH_TYPECODE = 'i'
+_LOW_TYPECODE = 'I'
+
+# the version of the saved index file layout.
+_FORMAT = 2
+
+# the person record fields that are indexed.
+EMAIL_FIELDS = ('email', 'email1', 'email2', 'email3', 'email4')
+PHONE_FIELDS = ('phone', 'mobile', 'work_phone_number')
+
+# the number of entries added before they are merged into the arrays.
+_MAX_RECENT = 100000
+
+
+def normalise_email(email):
+    """Returns the index key for an email address."""
+    return 'e:' + _utf8(email.strip().lower())
+
+
+def normalise_phone(phone):
+    """Returns the index key for a phone number: its digits, without a
+    leading 1 on 11 digit (North American) numbers."""
+    digits = re.sub(r'\D', '', phone)
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    return 'p:' + _utf8(digits)
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _hash(key):
+    """Returns the 64 bit hash of a key, as a signed integer."""
+    return struct.unpack('<q', hashlib.md5(key).digest()[:8])[0]
+
+
+def _split(h):
+    """Returns the (high, low) 32 bit halves of a hash, which sort in the
+    same order as the hashes."""
+    return h >> 32, h & 0xffffffff
+
+
+class PersonIndex(object):
+
+    """
+    Maps normalised email addresses and phone numbers to person IDs.
+
+    The index can be stale: someone whose email address changed is still
+    found under the old one until the next full refresh. Set confirm=True to
+    have the People API check each hit with get_person() (which can be
+    served from a person cache). People deleted with People.delete_person()
+    are removed from the index; people deleted some other way are only
+    dropped by a full refresh.
+
+    Public attributes:
+        path : the file the index is saved to, or None.
+        confirm : whether hits are confirmed with the API.
+        last_refresh : the unix time of the last refresh, or None.
+        hits, misses : lookup counters.
+    """
+
+    def __init__(self, path=None, confirm=False):
+        """
+        Parameters:
+            path : where to save the index. If the file exists, the index is
+                loaded from it.
+            confirm : confirm hits with the API, see above.
+        """
+        self.path = path
+        self.confirm = confirm
+        self.last_refresh = None
+        self.hits = 0
+        self.misses = 0
+        # the sorted key hashes (as high and low halves), and the IDs they
+        # map to.
+        self._highs = array(_HIGH_TYPECODE)
+        self._lows = array(_LOW_TYPECODE)
+        self._ids = array(_TYPECODE)
+        # entries added since the arrays were last rebuilt, or None for
+        # removed ones.
+        self._recent = {}
+        # set during a full refresh, whose walk replaces the arrays.
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._ids) + len(self._recent)
+
+    def _find(self, h, start=0):
+        """Returns the index of the first merged entry whose hash is not
+        less than h, looking from start."""
+        high, low = _split(h)
+        i = bisect.bisect_left(self._highs, high, start)
+        end = bisect.bisect_right(self._highs, high, i)
+        return bisect.bisect_left(self._lows, low, i, end)
+
+    def _merged_hash(self, i):
+        return (self._highs[i] << 32) | self._lows[i]
+
+    def _get(self, key):
+        h = _hash(key)
+        with self._lock:
+            if h in self._recent:
+                nb_id = self._recent[h]
+            else:
+                nb_id = None
+                i = self._find(h)
+                if i < len(self._ids) and self._merged_hash(i) == h:
+                    nb_id = self._ids[i]
+            if nb_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return nb_id
+
+    def lookup_email(self, email):
+        """Returns the ID of the person with an email address, or None."""
+        return self._get(normalise_email(email))
+
+    def lookup_phone(self, phone):
+        """Returns the ID of the person with a phone number, or None."""
+        return self._get(normalise_phone(phone))
+
+    def _add(self, key, nb_id):
+        with self._lock:
+            self._recent[_hash(key)] = nb_id
+            full = (len(self._recent) >= _MAX_RECENT and
+                    not self._rebuilding)
+        if full:
+            self.compact()
+
+    def add_email(self, email, nb_id):
+        self._add(normalise_email(email), nb_id)
+
+    def add_phone(self, phone, nb_id):
+        self._add(normalise_phone(phone), nb_id)
+
+    def add(self, person):
+        """Indexes the email addresses and phone numbers of a person
+        record."""
+        if person.get('id') is None:
+            return
+        for field in EMAIL_FIELDS:
+            if person.get(field):
+                self.add_email(person[field], person['id'])
+        for field in PHONE_FIELDS:
+            if person.get(field):
+                self.add_phone(person[field], person['id'])
+
+    def remove(self, nb_id):
+        """Forgets the email addresses and phone numbers of the person with
+        nb_id. This looks through the whole index, so it takes a while for
+        a big one."""
+        with self._lock:
+            for key, value in self._recent.iteritems():
+                if value == nb_id:
+                    self._recent[key] = None
+            for i, value in enumerate(self._ids):
+                if value == nb_id:
+                    key = self._merged_hash(i)
+                    if key not in self._recent:
+                        self._recent[key] = None
+
+    def compact(self):
+        """Merges the recently added entries into the sorted arrays."""
+        with self._lock:
+            if not self._recent:
+                return
+            old_highs, old_lows, old_ids = self._highs, self._lows, self._ids
+            highs = array(_HIGH_TYPECODE)
+            lows = array(_LOW_TYPECODE)
+            ids = array(_TYPECODE)
+            i = 0
+            for key, nb_id in sorted(self._recent.iteritems()):
+                j = self._find(key, i)
+                highs.extend(old_highs[i:j])
+                lows.extend(old_lows[i:j])
+                ids.extend(old_ids[i:j])
+                if nb_id is not None:
+                    high, low = _split(key)
+                    highs.append(high)
+                    lows.append(low)
+                    ids.append(nb_id)
+                # skip the old entry the new one replaces.
+                if j < len(old_ids) and self._merged_hash(j) == key:
+                    j += 1
+                i = j
+            highs.extend(old_highs[i:])
+            lows.extend(old_lows[i:])
+            ids.extend(old_ids[i:])
+            self._highs = highs
+            self._lows = lows
+            self._ids = ids
+            self._recent = {}
+
+    def refresh(self, people_api, full=False, prefetch=4):
+        """
+        Brings the index up to date from the API.
+
+        The first refresh (or one with full=True) streams every person with
+        get_people_iter() into a new index, which replaces the current one
+        once the walk has finished, so lookups made in the meantime (or
+        after the walk failed) use the old one. Later refreshes only add the
+        people updated since the previous refresh.
+
+        Parameters:
+            people_api : the nbpy.people.People API to read from.
+            full : rebuild the index from scratch.
+            prefetch : the number of pages to fetch ahead.
+
+        Returns:
+            the number of people read.
+        """
+        started = time.time()
+        people = people_api.changed_people_iter(self.last_refresh, full,
+                                                prefetch)
+        rebuild = full or self.last_refresh is None
+        if rebuild:
+            # from here on _recent only holds changes made during the walk,
+            # which are kept when the new index is swapped in.
+            self.compact()
+            self._rebuilding = True
+            target = PersonIndex()
+        else:
+            target = self
+        try:
+            count = 0
+            for person in people:
+                target.add(person)
+                count += 1
+            if rebuild:
+                target.compact()
+                with self._lock:
+                    self._highs = target._highs
+                    self._lows = target._lows
+                    self._ids = target._ids
+        finally:
+            self._rebuilding = False
+        self.compact()
+        self.last_refresh = started
+        log.info("Indexed %d people in %.1fs", count, time.time() - started)
+        return count
+
+    def save(self, path=None):
+        """Saves the index to path (default: self.path)."""
+        path = path or self.path
+        self.compact()
+        with atomic_write(path) as out:
+            write_header(out, {'format': _FORMAT, 'count': len(self._ids),
+                               'last_refresh': self.last_refresh})
+            self._highs.tofile(out)
+            self._lows.tofile(out)
+            self._ids.tofile(out)
+
+    def load(self, path=None):
+        """Loads the index from path (default: self.path)."""
+        path = path or self.path
+        with open(path, 'rb') as saved:
+            header = read_header(saved, path)
+            if header.get('format') != _FORMAT:
+                raise ValueError("%s was saved by an older version of nbpy, "
+                                 "refresh the index with full=True" % path)
+            highs = array(_HIGH_TYPECODE)
+            lows = array(_LOW_TYPECODE)
+            ids = array(_TYPECODE)
+            highs.fromfile(saved, header['count'])
+            lows.fromfile(saved, header['count'])
+            ids.fromfile(saved, header['count'])
+        with self._lock:
+            self._highs = highs
+            self._lows = lows
+            self._ids = ids
+            self._recent = {}
+        self.last_refresh = header['last_refresh']
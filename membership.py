@@ -0,0 +1,521 @@
+# membership.py ---
+#
+# Filename: membership.py
+# Description: Local index of tag and list memberships.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A local index of the members of tags and lists, for combining them without
+downloading them again.
+
+The members of each tag and list are kept as a sorted array of person IDs
+(8 bytes per membership), and as a bitmap once a query has needed one.
+Queries are built from tag() and list() with the
+& (and), | (or) and - (and not) operators, or all_of() / any_of() for many
+sets at once, and yield the matching IDs in ascending order.
+
+The first refresh() reads the tags of every person in one walk of
+get_people_iter(), however many tags there are; later ones only read the
+people updated since the previous refresh. Lists are walked when they are
+first added to the index, and again when their size has changed or they
+were last walked more than max_list_age seconds ago: the API gives no other
+sign that a list has changed, so members swapped for others without
+changing its size are only seen by the next walk. refresh_list() walks a
+list straight away.
+
+Classes:
+    MembershipIndex
+     -- the index.
+    Members
+     -- a query over the index: the IDs of the people in a tag or list, or
+        a combination of them.
+
+Example usage:
+
+index = MembershipIndex('members.idx')
+index.refresh(nb, lists=[42])   # full load the first time, incremental later
+index.save()
+query = (index.tag('volunteer') & index.tag('donor-2024')) - index.list(42)
+for nb_id in query:
+    print nb_id
+"""
+
+from array import array
+import binascii
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+
+from storage import atomic_write, read_header, write_header
+
+log = logging.getLogger('nbpy')
+
+_TYPECODE = 'l'
+
+# an intersection with a sorted array probes the array with bisect, rather
+# than scanning it, when the array is this many times bigger than the
+# result so far.
+_PROBE_RATIO = 32
+
+# queries over at least this many IDs are worked out with bitmaps.
+_BITMAP_MIN = 50000
+
+
+def _tag_key(name):
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    return ('tag', name)
+
+
+def _list_key(list_id):
+    return ('list', int(list_id))
+
+
+def _contains(ids, nb_id):
+    """Returns True if the sorted array ids holds nb_id."""
+    i = bisect.bisect_left(ids, nb_id)
+    return i < len(ids) and ids[i] == nb_id
+
+
+def _to_bits(ids):
+    """Returns a bitmap (a long with bit n set for ID n) of ids."""
+    if not ids:
+        return 0
+    buf = bytearray((max(ids) >> 3) + 1)
+    for nb_id in ids:
+        buf[nb_id >> 3] |= 1 << (nb_id & 7)
+    buf.reverse()
+    return int(binascii.hexlify(buf), 16)
+
+
+# byte value -> the positions of its set bits.
+_BYTE_BITS = [tuple(bit for bit in xrange(8) if value >> bit & 1)
+              for value in xrange(256)]
+_NONZERO = re.compile('[^\x00]+')
+
+
+def _iter_bits(bits):
+    """Yields the IDs in a bitmap, in ascending order."""
+    if not bits:
+        return
+    digits = '%x' % bits
+    if len(digits) % 2:
+        digits = '0' + digits
+    data = binascii.unhexlify(digits)[::-1]
+    for run in _NONZERO.finditer(data):
+        offset = run.start() * 8
+        for char in run.group():
+            for bit in _BYTE_BITS[ord(char)]:
+                yield offset + bit
+            offset += 8
+
+
+class _Result(object):
+
+    """The value of a query: a sorted array or a set of IDs, or a bitmap,
+    converted from one to the other as needed."""
+
+    def __init__(self, ids=None, bits=None, get_bits=None):
+        self.ids = ids
+        self.bits = bits
+        self._get_bits = get_bits
+        self._len = None
+
+    def __len__(self):
+        if self._len is None:
+            if self.ids is not None:
+                self._len = len(self.ids)
+            else:
+                self._len = bin(self.bits).count('1')
+        return self._len
+
+    def as_bits(self):
+        if self.bits is None:
+            if self._get_bits is not None:
+                self.bits = self._get_bits()
+            else:
+                self.bits = _to_bits(self.ids)
+        return self.bits
+
+    def as_set(self):
+        if self.ids is None:
+            return set(_iter_bits(self.bits))
+        return set(self.ids)
+
+    def probe(self, result, keep):
+        """Returns the members of the set result that are (keep=True) or
+        aren't (keep=False) in this one, modifying result."""
+        ids = self.ids
+        if isinstance(ids, array) and len(result) * _PROBE_RATIO < len(ids):
+            return set(nb_id for nb_id in result
+                       if _contains(ids, nb_id) == keep)
+        other = ids if ids is not None else self.as_set()
+        if keep:
+            result.intersection_update(other)
+        else:
+            result.difference_update(other)
+        return result
+
+    def sorted_ids(self):
+        if self.ids is None:
+            return array(_TYPECODE, _iter_bits(self.bits))
+        if isinstance(self.ids, array):
+            return array(_TYPECODE, self.ids)
+        return array(_TYPECODE, sorted(self.ids))
+
+
+class Members(object):
+
+    """
+    The IDs of the people in a tag or list, or in a combination of them
+    made with &, | and -. Nothing is computed until the query is iterated
+    over, and it is computed again each time, so a query can be kept and
+    reused after the index has been refreshed.
+
+    Small sets are combined as Python sets, probing big sorted arrays with
+    bisect; big ones as bitmaps.
+    """
+
+    def __init__(self, index, op, operands):
+        self.index = index
+        self._op = op
+        self._operands = operands
+
+    def __and__(self, other):
+        return Members(self.index, 'and', [self, other])
+
+    def __or__(self, other):
+        return Members(self.index, 'or', [self, other])
+
+    def __sub__(self, other):
+        return Members(self.index, 'not', [self, other])
+
+    def _evaluate(self):
+        """Returns the members as a _Result."""
+        if self._op == 'key':
+            return self.index._result(self._operands)
+        parts = [operand._evaluate() for operand in self._operands]
+        if not parts:
+            return _Result(ids=())
+        if self._op == 'or':
+            if sum(len(part) for part in parts) < _BITMAP_MIN:
+                result = set()
+                for part in parts:
+                    result.update(part.as_set())
+                return _Result(ids=result)
+            bits = 0
+            for part in parts:
+                bits |= part.as_bits()
+            return _Result(bits=bits)
+        if self._op == 'and':
+            # start with the smallest, so every step is cheap.
+            parts.sort(key=len)
+        first, rest = parts[0], parts[1:]
+        keep = self._op == 'and'
+        if len(first) < _BITMAP_MIN:
+            result = first.as_set()
+            for part in rest:
+                if not result:
+                    break
+                result = part.probe(result, keep)
+            return _Result(ids=result)
+        bits = first.as_bits()
+        for part in rest:
+            if keep:
+                bits &= part.as_bits()
+            else:
+                bits &= ~part.as_bits()
+        return _Result(bits=bits)
+
+    def ids(self):
+        """Returns the IDs as a sorted array."""
+        return self._evaluate().sorted_ids()
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def count(self):
+        """Returns the number of IDs, without sorting them."""
+        return len(self._evaluate())
+
+    def __len__(self):
+        return self.count()
+
+
+class MembershipIndex(object):
+
+    """
+    The members of the tags and lists of a nation.
+
+    Tag memberships are kept up to date incrementally. As with the other
+    incremental readers, people deleted from the nation (and tags that have
+    been deleted) are only dropped by a full refresh.
+
+    Public attributes:
+        path : the file the index is saved to, or None.
+        last_refresh : the unix time of the last refresh, or None.
+        max_list_age : seconds after which a refresh walks a list again
+            even if its size hasn't changed, or None to only walk it again
+            when its size changes.
+    """
+
+    def __init__(self, path=None, max_list_age=24 * 3600):
+        """
+        Parameters:
+            path : where to save the index. If the file exists, the index is
+                loaded from it.
+            max_list_age : see the max_list_age attribute.
+        """
+        self.path = path
+        self.last_refresh = None
+        self.max_list_age = max_list_age
+        # ('tag', name) or ('list', id) -> sorted array of person IDs
+        self._sets = {}
+        # list id -> the list's size when it was last walked
+        self._list_counts = {}
+        # list id -> the unix time it was last walked
+        self._list_walked = {}
+        # key -> bitmap of the set, built when a query first needs it
+        self._bitmaps = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def tags(self):
+        """Returns the names of the tags in the index."""
+        with self._lock:
+            return sorted(key[1] for key in self._sets if key[0] == 'tag')
+
+    def lists(self):
+        """Returns the IDs of the lists in the index."""
+        with self._lock:
+            return sorted(key[1] for key in self._sets if key[0] == 'list')
+
+    def members(self, key):
+        """Returns the sorted array of the members of ('tag', name) or
+        ('list', id). A tag nobody has has no members; a list that isn't in
+        the index raises KeyError."""
+        with self._lock:
+            ids = self._sets.get(key)
+        if ids is None:
+            if key[0] == 'list':
+                raise KeyError("List %s isn't in the index" % key[1])
+            return array(_TYPECODE)
+        return ids
+
+    def _result(self, key):
+        ids = self.members(key)
+
+        def get_bits():
+            with self._lock:
+                bits = self._bitmaps.get(key)
+            if bits is None:
+                bits = _to_bits(ids)
+                with self._lock:
+                    # unless the set has been refreshed in the meantime.
+                    if self._sets.get(key) is ids:
+                        self._bitmaps[key] = bits
+            return bits
+        return _Result(ids=ids, get_bits=get_bits)
+
+    def tag(self, name):
+        """Returns the query for the people with a tag."""
+        return Members(self, 'key', _tag_key(name))
+
+    def list(self, list_id):
+        """Returns the query for the people on a list."""
+        return Members(self, 'key', _list_key(list_id))
+
+    def all_of(self, *queries):
+        """Returns the query for the people in every one of queries."""
+        return Members(self, 'and', list(queries))
+
+    def any_of(self, *queries):
+        """Returns the query for the people in any of queries."""
+        return Members(self, 'or', list(queries))
+
+    def refresh(self, nation, full=False, lists=None, prefetch=4):
+        """
+        Brings the index up to date from the API.
+
+        Parameters:
+            nation : the nbpy.nationbuilder.NationBuilder to read from.
+            full : rebuild the tags from a walk of every person, and walk
+                every list again.
+            lists : IDs of lists to add to the index. The lists already in
+                it are refreshed too.
+            prefetch : the number of pages to fetch ahead.
+
+        A list already in the index is only walked again if its size has
+        changed, or it is older than max_list_age; use full, or
+        refresh_list(), to pick up members that were swapped for others
+        without changing its size.
+
+        Returns:
+            the number of people and list members read.
+        """
+        started = time.time()
+        count = self._refresh_tags(nation.people, full, prefetch)
+        count += self._refresh_lists(nation.lists, full, lists or (),
+                                     prefetch)
+        self.last_refresh = started
+        log.info("Refreshed the membership index in %.1fs",
+                 time.time() - started)
+        return count
+
+    def _refresh_tags(self, people_api, full, prefetch):
+        people = people_api.changed_people_iter(
+            self.last_refresh, full, prefetch, fields=['id', 'tags'])
+        # the people read, and the tags they have now.
+        updated = set()
+        added = {}
+        untagged = 0
+        for person in people:
+            updated.add(person.id)
+            if person.tags is None:
+                untagged += 1
+            for name in person.tags or ():
+                added.setdefault(_tag_key(name), []).append(person.id)
+        if untagged and untagged == len(updated):
+            log.warning("The people records didn't include their tags")
+
+        with self._lock:
+            if full or self.last_refresh is None:
+                sets = dict((key, ids) for key, ids in self._sets.iteritems()
+                            if key[0] == 'list')
+                for key, ids in added.iteritems():
+                    sets[key] = array(_TYPECODE, sorted(ids))
+                self._sets = sets
+                self._bitmaps = {}
+                return len(updated)
+            for key in set(added) | set(key for key in self._sets
+                                        if key[0] == 'tag'):
+                old = self._sets.get(key, ())
+                if key not in added and updated.isdisjoint(old):
+                    continue
+                ids = set(old)
+                ids.difference_update(updated)
+                ids.update(added.get(key, ()))
+                if ids:
+                    self._sets[key] = array(_TYPECODE, sorted(ids))
+                else:
+                    self._sets.pop(key, None)
+                self._bitmaps.pop(key, None)
+        log.debug("Updated the tags of %d people", len(updated))
+        return len(updated)
+
+    def _refresh_lists(self, lists_api, full, new_lists, prefetch):
+        list_ids = set(int(list_id) for list_id in new_lists)
+        list_ids.update(self.lists())
+        if not list_ids:
+            return 0
+        counts = dict((nb_list['id'], nb_list.get('count'))
+                      for nb_list in lists_api.list_lists_iter())
+        now = time.time()
+        count = 0
+        for list_id in sorted(list_ids):
+            size = counts.get(list_id)
+            if not full and self._list_current(list_id, size, now):
+                continue
+            count += self._walk_list(lists_api, list_id, size, prefetch)
+        return count
+
+    def _list_current(self, list_id, size, now):
+        """Returns True if the list needn't be walked again: it is in the
+        index, its size hasn't changed, and it isn't older than
+        max_list_age."""
+        if _list_key(list_id) not in self._sets or size is None:
+            return False
+        if self._list_counts.get(list_id) != size:
+            return False
+        if self.max_list_age is None:
+            return True
+        walked = self._list_walked.get(list_id)
+        return walked is not None and now - walked < self.max_list_age
+
+    def _walk_list(self, lists_api, list_id, size, prefetch):
+        walked = time.time()
+        ids = array(_TYPECODE, sorted(
+            person.id for person in lists_api.get_list_iter(
+                list_id, prefetch=prefetch, fields=['id'])))
+        key = _list_key(list_id)
+        with self._lock:
+            self._sets[key] = ids
+            self._bitmaps.pop(key, None)
+            self._list_counts[list_id] = size
+            self._list_walked[list_id] = walked
+        log.debug("Read the %d members of list %d", len(ids), list_id)
+        return len(ids)
+
+    def refresh_list(self, nation, list_id, prefetch=4):
+        """
+        Walks one list now, adding it to the index if it isn't there, and
+        returns the number of members read. This picks up changes that a
+        refresh() can't see, such as members swapped for others.
+        """
+        list_id = int(list_id)
+        counts = dict((nb_list['id'], nb_list.get('count'))
+                      for nb_list in nation.lists.list_lists_iter())
+        return self._walk_list(nation.lists, list_id, counts.get(list_id),
+                               prefetch)
+
+    def remove_list(self, list_id):
+        """Drops a list from the index."""
+        with self._lock:
+            self._sets.pop(_list_key(list_id), None)
+            self._bitmaps.pop(_list_key(list_id), None)
+            self._list_counts.pop(int(list_id), None)
+            self._list_walked.pop(int(list_id), None)
+
+    def save(self, path=None):
+        """Saves the index to path (default: self.path)."""
+        path = path or self.path
+        with self._lock:
+            keys = sorted(self._sets)
+            sets = [self._sets[key] for key in keys]
+            header = {
+                'last_refresh': self.last_refresh,
+                'sets': [[key[0], key[1], len(ids)]
+                         for key, ids in zip(keys, sets)],
+                'list_counts': self._list_counts.items(),
+                'list_walked': self._list_walked.items()}
+        with atomic_write(path) as out:
+            write_header(out, header)
+            for ids in sets:
+                ids.tofile(out)
+
+    def load(self, path=None):
+        """Loads the index from path (default: self.path)."""
+        path = path or self.path
+        sets = {}
+        with open(path, 'rb') as saved:
+            header = read_header(saved, path)
+            for kind, name, count in header['sets']:
+                ids = array(_TYPECODE)
+                ids.fromfile(saved, count)
+                sets[(kind, name)] = ids
+        with self._lock:
+            self._sets = sets
+            self._bitmaps = {}
+            self._list_counts = dict(header['list_counts'])
+            # files saved before walk times were kept have their lists
+            # walked again by the next refresh.
+            self._list_walked = dict(header.get('list_walked', ()))
+        self.last_refresh = header['last_refresh']
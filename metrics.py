@@ -0,0 +1,245 @@
+# metrics.py ---
+#
+# Filename: metrics.py
+# Description: Per-endpoint request metrics.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Metrics about the requests made to a nation.
+
+Every request made through a NationBuilderSession is recorded in the
+session's RequestMetrics (nb.session.metrics), and passed to any hooks
+added with NationBuilderSession.add_hook(). A hook is called with an event
+dict:
+
+    {'type': 'request', 'endpoint': '/people/{id}', 'method': 'GET',
+     'status': 200, 'latency': 0.153, 'bytes': 2311, 'retries': 0,
+     'throttled': 0, 'error': None}
+
+where latency includes any retries, status is None if the request failed
+without a response (error is then the exception), and throttled is the
+number of 429 responses. When a response body is decoded, hooks get a
+second event:
+
+    {'type': 'decode', 'endpoint': '/people/{id}', 'seconds': 0.002}
+
+Classes:
+    RequestMetrics
+     -- per-endpoint counters and latency histograms, which can be read with
+        stats() and quantile(), or exported in the Prometheus text format
+        with prometheus().
+
+Example usage:
+
+nb = nbpy.nationbuilder.NationBuilder("slug", MY_API_KEY)
+...
+print nb.session.metrics.quantile('/people/{id}', 'GET', 0.99)
+print nb.session.metrics.prometheus()
+"""
+
+import threading
+
+# the upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class _EndpointStats(object):
+
+    __slots__ = ('requests', 'statuses', 'errors', 'buckets', 'latency',
+                 'bytes', 'retries', 'throttled')
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = {}
+        self.errors = 0
+        self.buckets = [0] * len(BUCKETS)
+        self.latency = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0
+
+
+class RequestMetrics(object):
+
+    """
+    Counters and latency histograms of the requests to a nation, per
+    endpoint and method. Thread safe.
+    """
+
+    def __init__(self):
+        # (endpoint, method) -> _EndpointStats
+        self._stats = {}
+        # endpoint -> [decode count, decode seconds]
+        self._decode = {}
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        """Records a 'request' or 'decode' event (see above)."""
+        with self._lock:
+            if event['type'] == 'decode':
+                decode = self._decode.setdefault(event['endpoint'], [0, 0.0])
+                decode[0] += 1
+                decode[1] += event['seconds']
+                return
+            key = (event['endpoint'], event['method'])
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _EndpointStats()
+            stats.requests += 1
+            if event['status'] is None:
+                stats.errors += 1
+            else:
+                stats.statuses[event['status']] = (
+                    stats.statuses.get(event['status'], 0) + 1)
+            latency = event['latency']
+            for i, bound in enumerate(BUCKETS):
+                if latency <= bound:
+                    stats.buckets[i] += 1
+                    break
+            stats.latency += latency
+            stats.bytes += event['bytes']
+            stats.retries += event['retries']
+            stats.throttled += event['throttled']
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self._stats.clear()
+            self._decode.clear()
+
+    def stats(self):
+        """
+        Returns the metrics as a dict mapping (endpoint, method) to a dict
+        of:
+            requests : the number of requests.
+            statuses : a dict of response status -> count.
+            errors : requests that failed without a response.
+            latency : the total latency in seconds.
+            buckets : a list of (upper bound, count) latency buckets.
+            bytes : the total size of the response bodies.
+            retries : the number of retried attempts.
+            throttled : the number of 429 responses.
+            decode_seconds : the time spent decoding response bodies from
+                the endpoint (for any method).
+        """
+        with self._lock:
+            result = {}
+            for key, stats in self._stats.iteritems():
+                decode = self._decode.get(key[0], (0, 0.0))
+                result[key] = {
+                    'requests': stats.requests,
+                    'statuses': dict(stats.statuses),
+                    'errors': stats.errors,
+                    'latency': stats.latency,
+                    'buckets': zip(BUCKETS, stats.buckets),
+                    'bytes': stats.bytes,
+                    'retries': stats.retries,
+                    'throttled': stats.throttled,
+                    'decode_seconds': decode[1],
+                }
+            return result
+
+    def quantile(self, endpoint, method, q):
+        """
+        Estimates the q quantile (e.g. 0.99) of the latency of an endpoint
+        from its histogram, interpolating within the bucket it falls in.
+        Returns None if there haven't been any requests.
+        """
+        with self._lock:
+            stats = self._stats.get((endpoint, method))
+            if stats is None or not stats.requests:
+                return None
+            buckets = list(stats.buckets)
+            total = stats.requests
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(BUCKETS, buckets):
+            if count and seen + count >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            if bound != float('inf'):
+                lower = bound
+        return lower
+
+    def prometheus(self, prefix='nbpy'):
+        """Returns the metrics in the Prometheus text exposition format."""
+        stats = self.stats()
+        with self._lock:
+            decode = dict(self._decode)
+        lines = []
+
+        def header(name, kind, text):
+            lines.append('# HELP %s_%s %s' % (prefix, name, text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        keys = sorted(stats)
+        header('requests_total', 'counter',
+               'Requests to the NationBuilder API, by response status.')
+        for endpoint, method in keys:
+            entry = stats[(endpoint, method)]
+            for status, count in sorted(entry['statuses'].iteritems()):
+                lines.append('%s_requests_total{%s,status="%d"} %d'
+                             % (prefix, _labels(endpoint, method), status,
+                                count))
+            if entry['errors']:
+                lines.append('%s_requests_total{%s,status="error"} %d'
+                             % (prefix, _labels(endpoint, method),
+                                entry['errors']))
+        header('request_duration_seconds', 'histogram',
+               'Request latency, including retries.')
+        for endpoint, method in keys:
+            entry = stats[(endpoint, method)]
+            labels = _labels(endpoint, method)
+            cumulative = 0
+            for bound, count in entry['buckets']:
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_request_duration_seconds_bucket{%s,le="%s"}'
+                             ' %d' % (prefix, labels, le, cumulative))
+            lines.append('%s_request_duration_seconds_sum{%s} %r'
+                         % (prefix, labels, entry['latency']))
+            lines.append('%s_request_duration_seconds_count{%s} %d'
+                         % (prefix, labels, entry['requests']))
+        for name, field, text in (
+                ('response_bytes_total', 'bytes',
+                 'Size of the response bodies.'),
+                ('retries_total', 'retries', 'Retried request attempts.'),
+                ('throttled_total', 'throttled',
+                 '429 Too Many Requests responses.')):
+            header(name, 'counter', text)
+            for endpoint, method in keys:
+                lines.append('%s_%s{%s} %d'
+                             % (prefix, name, _labels(endpoint, method),
+                                stats[(endpoint, method)][field]))
+        header('decode_seconds_total', 'counter',
+               'Time spent decoding response bodies.')
+        for endpoint in sorted(decode):
+            lines.append('%s_decode_seconds_total{endpoint="%s"} %r'
+                         % (prefix, _escape(endpoint), decode[endpoint][1]))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(endpoint, method):
+    return 'endpoint="%s",method="%s"' % (_escape(endpoint), method)
@@ -0,0 +1,291 @@
+# mirror.py ---
+#
+# Filename: mirror.py
+# Description: Local SQLite mirror of a nation's people.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A local copy of a nation's people, kept in an SQLite database.
+
+The first sync() walks every person with People.get_people_iter(); after
+that only the people updated since the previous sync are fetched, with
+People.search_iter(updated_since=...). The mirror can then be queried offline
+with the same filters as People.search().
+
+updated_at is stored as UTC text ('2014-03-15T17:00:00Z'), so that people
+updated in different time zones are compared in time order.
+
+Classes:
+    PeopleMirror
+     -- the mirror database and the sync engine.
+
+Example usage:
+
+nb = nbpy.nationbuilder.NationBuilder("slug", MY_API_KEY)
+mirror = PeopleMirror(nb, "nation.db")
+mirror.sync()
+smiths = mirror.search(last_name="Smith", city="Springfield")
+"""
+
+import calendar
+import json
+import logging
+import re
+import sqlite3
+import time
+
+from pool import map_concurrently
+
+log = logging.getLogger('nbpy')
+
+# the search() filters that match a field of the same name.
+EXTERNAL_IDS = ('civicrm_id', 'county_file_id', 'state_file_id',
+                'datatrust_id', 'dw_id', 'media_market_id',
+                'membership_level_id', 'ngp_id', 'pf_strat_id', 'van_id',
+                'salesforce_id', 'rnc_id', 'rnc_regid', 'external_id')
+TEXT_FIELDS = ('first_name', 'last_name', 'email', 'mobile', 'sex',
+               'birthdate', 'city', 'state', 'updated_at')
+
+_COLUMNS = TEXT_FIELDS + EXTERNAL_IDS
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS people (id INTEGER PRIMARY KEY, '
+    + ', '.join('%s TEXT COLLATE NOCASE' % col for col in _COLUMNS)
+    + ', generation INTEGER, data TEXT)',
+    'CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value)',
+    'CREATE INDEX IF NOT EXISTS people_name ON people (last_name, '
+    'first_name)',
+] + ['CREATE INDEX IF NOT EXISTS people_%s ON people (%s)' % (col, col)
+     for col in ('email', 'city', 'state', 'updated_at') + EXTERNAL_IDS]
+
+# an ISO 8601 date or time, optionally with seconds, fractions of a second
+# and a UTC offset.
+_TIMESTAMP = re.compile(r'^(\d{4})-(\d\d)-(\d\d)'
+                        r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?)?'
+                        r'\s*(Z|[+-]\d\d:?\d\d)?$', re.IGNORECASE)
+
+
+class PeopleMirror(object):
+
+    """
+    A local SQLite copy of a nation's people.
+
+    Public attributes:
+        path : the database file.
+        hydrate : if True, the full person record (from get_person()) is
+            stored instead of the abbreviated one.
+    """
+
+    def __init__(self, nation, path, hydrate=False, workers=10):
+        """
+        Parameters:
+            nation : the nbpy.nationbuilder.NationBuilder to mirror.
+            path : the SQLite database file. Created if it doesn't exist.
+            hydrate : store full person records rather than the abbreviated
+                records returned by the paginated endpoints. This costs one
+                request per synced person.
+            workers : the number of threads used to fetch pages and full
+                records.
+        """
+        self.nation = nation
+        self.path = path
+        self.hydrate = hydrate
+        self.workers = workers
+        self.db = sqlite3.connect(path)
+        for statement in _SCHEMA:
+            self.db.execute(statement)
+        if not self._get_state('utc_updated_at'):
+            # mirrors made before updated_at was stored as UTC.
+            self.db.create_function('nbpy_utc', 1, _utc)
+            self.db.execute('UPDATE people SET updated_at = nbpy_utc('
+                            'updated_at) WHERE updated_at IS NOT NULL')
+            self._set_state('utc_updated_at', 1)
+        self.db.commit()
+
+    def _get_state(self, key, default=None):
+        row = self.db.execute('SELECT value FROM sync_state WHERE key = ?',
+                              (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_state(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)',
+                        (key, value))
+
+    @property
+    def last_sync(self):
+        """The unix time the last successful sync started at, or None."""
+        return self._get_state('last_sync')
+
+    def sync(self, full=False, batch_size=500):
+        """
+        Brings the mirror up to date.
+
+        The first sync (or one with full=True) loads every person in the
+        nation, and removes people that no longer exist. Later ones only
+        fetch the people updated since the previous sync started. Note that
+        people deleted in NationBuilder are only removed by a full sync.
+
+        Parameters:
+            full : reload every person.
+            batch_size : the number of people written per transaction.
+
+        Returns:
+            the number of people fetched.
+        """
+        started = time.time()
+        last_sync = self.last_sync
+        generation = self._get_state('generation', 0) + 1
+        if full or last_sync is None:
+            log.info("Full sync of %s", self.path)
+        people = self.nation.people.changed_people_iter(
+            last_sync, full, prefetch=self.workers)
+        if self.hydrate:
+            people = self._hydrate(people)
+
+        count = 0
+        batch = []
+        for person in people:
+            batch.append(person)
+            if len(batch) >= batch_size:
+                self._store(batch, generation)
+                count += len(batch)
+                batch = []
+        self._store(batch, generation)
+        count += len(batch)
+
+        if full or last_sync is None:
+            # anyone not seen during a full load has been deleted.
+            self.db.execute('DELETE FROM people WHERE generation < ?',
+                            (generation,))
+        self._set_state('generation', generation)
+        self._set_state('last_sync', started)
+        self.db.commit()
+        log.info("Synced %d people in %.1fs", count, time.time() - started)
+        return count
+
+    def _hydrate(self, people):
+        """Yields the full records of the abbreviated person records."""
+        ids = (person['id'] for person in people)
+        for nb_id, result, error in map_concurrently(
+                self.nation.people.get_person, ids, self.workers):
+            if error is not None:
+                raise error
+            yield result['person']
+
+    def _store(self, people, generation):
+        """Upserts a batch of person records."""
+        rows = [(person['id'],)
+                + tuple(_field(person, col) for col in _COLUMNS)
+                + (generation, json.dumps(person))
+                for person in people]
+        self.db.executemany(
+            'INSERT OR REPLACE INTO people VALUES (%s)'
+            % ', '.join('?' * (len(_COLUMNS) + 3)), rows)
+        self.db.commit()
+
+    def get_person(self, person_id):
+        """Returns the mirrored record of a person, or None."""
+        row = self.db.execute('SELECT data FROM people WHERE id = ?',
+                              (person_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def search(self, **kwargs):
+        """
+        Finds people in the mirror. Takes the same filters as
+        People.search(), apart from custom_values:
+
+            first_name, last_name, city, state, sex, birthdate,
+            updated_since, with_mobile, civicrm_id, county_file_id,
+            state_file_id, datatrust_id, dw_id, media_market_id,
+            membership_level_id, ngp_id, pf_strat_id, van_id,
+            salesforce_id, rnc_id, rnc_regid, external_id
+
+        Text matches are exact but case insensitive. updated_since (and
+        updated_at) can be ISO 8601 text with any UTC offset, or a unix time.
+
+        Returns a list of person records.
+        """
+        return list(self.iter_search(**kwargs))
+
+    def iter_search(self, **kwargs):
+        """Generator version of search()."""
+        clauses = []
+        params = []
+        for key, value in sorted(kwargs.iteritems()):
+            if key == 'updated_since':
+                clauses.append('updated_at >= ?')
+                value = _utc(value)
+            elif key == 'updated_at':
+                clauses.append('updated_at = ?')
+                value = _utc(value)
+            elif key == 'with_mobile':
+                clauses.append("coalesce(mobile, '') %s ''"
+                               % ('!=' if value else '='))
+                continue
+            elif key in _COLUMNS:
+                clauses.append('%s = ?' % key)
+            else:
+                raise ValueError("Can't search the mirror by %s" % key)
+            params.append(unicode(value))
+        query = 'SELECT data FROM people'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        for row in self.db.execute(query + ' ORDER BY id', params):
+            yield json.loads(row[0])
+
+    def count(self):
+        """Returns the number of people in the mirror."""
+        return self.db.execute('SELECT count(*) FROM people').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def _field(person, name):
+    """Returns a searchable field of a person record as text (or None).
+    city and state are taken from the primary address if they aren't on the
+    record itself."""
+    value = person.get(name)
+    if value is None and name in ('city', 'state'):
+        address = person.get('primary_address') or {}
+        value = address.get(name)
+    if value is None:
+        return None
+    if name == 'updated_at':
+        return _utc(value)
+    return unicode(value)
+
+
+def _utc(value):
+    """Returns a timestamp, given as ISO 8601 text or a unix time, as UTC
+    text like '2014-03-15T17:00:00Z'. Text that isn't a timestamp is
+    returned as it is."""
+    if isinstance(value, (int, long, float)):
+        seconds = value
+    else:
+        match = _TIMESTAMP.match(unicode(value).strip())
+        if match is None:
+            return unicode(value)
+        year, month, day, hour, minute, second, offset = match.groups()
+        seconds = calendar.timegm((int(year), int(month), int(day),
+                                   int(hour or 0), int(minute or 0),
+                                   int(second or 0)))
+        if offset and offset.upper() != 'Z':
+            digits = offset[1:].replace(':', '')
+            shift = int(digits[:2]) * 3600 + int(digits[2:]) * 60
+            seconds += shift if offset[0] == '-' else -shift
+    return unicode(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds)))
@@ -20,10 +20,38 @@ ppl = my_site.people.get_person(123)
 list_five = my_site.lists.get_list(5)
 
 """
-from people import People
-from tags import NBTags
-from lists import Lists
-from contacts import Contacts
+import threading
+
+from nb_api import NationBuilderSession
+
+_lazy_lock = threading.Lock()
+
+
+class _LazyApi(object):
+
+    """
+    An API attribute of NationBuilder that is only created, and its module
+    only imported, when it is first used. The API is then stored on the
+    instance, which hides this descriptor from later lookups.
+    """
+
+    def __init__(self, name, module, cls):
+        self.name = name
+        self.module = module
+        self.cls = cls
+
+    def __get__(self, nation, owner):
+        if nation is None:
+            return self
+        with _lazy_lock:
+            api = nation.__dict__.get(self.name)
+            if api is None:
+                module = __import__(self.module, globals(), {}, [self.cls])
+                session = nation.session
+                api = getattr(module, self.cls)(session.NATION_SLUG,
+                                                session.ACCESS_TOKEN, session)
+                nation.__dict__[self.name] = api
+            return api
 
 
 class NationBuilder(object):
@@ -35,15 +63,62 @@ class NationBuilder(object):
         people : nbpy.people.People instance for accessing people API
         tags : nbpy.tags.NBTags instance for accessing People Tags API
         lists : nbpy.lists.NBList instance for accessing Lists API
+        contacts : nbpy.contacts.Contacts instance for accessing Contacts API
+        session : the nbpy.nb_api.NationBuilderSession shared by the APIs
+
+    The APIs are created, and their modules imported, the first time they
+    are used, so a program that only uses people doesn't pay for the rest.
     """
 
-    def __init__(self, slug, api_key):
+    people = _LazyApi('people', 'people', 'People')
+    tags = _LazyApi('tags', 'tags', 'NBTags')
+    lists = _LazyApi('lists', 'lists', 'Lists')
+    contacts = _LazyApi('contacts', 'contacts', 'Contacts')
+
+    def __init__(self, slug, api_key, rate_limit=None, retry_policy=None,
+                 person_cache=None, response_cache=None, person_index=None,
+                 json_backend=None, incremental_json=False, transport=None,
+                 spatial_index=None):
+        """
+        Parameters:
+            slug : the nation slug
+            api_key : the api key for the nation
+            rate_limit : the maximum number of requests per second that all
+                of the APIs together make. None (the default) only slows
+                down when NationBuilder says the rate limit has been hit.
+            retry_policy : a nbpy.retry.RetryPolicy, deciding which failed
+                requests are retried. By default idempotent requests are
+                retried up to 3 times.
+            person_cache : a nbpy.cache.LRUCache that person reads are
+                cached in. By default nothing is cached.
+            response_cache : a nbpy.httpcache.ResponseCache that the
+                responses of list_lists(), list_tags() and
+                list_contact_statuses() are kept in, and revalidated with
+                conditional requests. By default nothing is cached.
+            person_index : a nbpy.lookup.PersonIndex that get_id_by_email()
+                and match_person() check before making a request.
+            json_backend : the JSON module responses are decoded with:
+                'ujson', 'simplejson' or 'json'. By default the fastest one
+                installed is used.
+            incremental_json : if True, the records of paginated responses
+                are decoded one at a time as they are consumed, lowering the
+                peak memory of get_people_iter(), search() and friends.
+            transport : the nbpy.transport.Transport requests are sent with,
+                e.g. a PooledTransport. By default an Httplib2Transport,
+                whose connections are shared by the threads.
+            spatial_index : a nbpy.spatial.SpatialIndex that get_nearby()
+                and get_nearby_iter() are answered from once it has been
+                refreshed.
+        """
         super(NationBuilder, self).__init__()
 
-        self.people = People(slug, api_key)
-        self.tags = NBTags(slug, api_key)
-        self.lists = Lists(slug, api_key)
-        self.contacts = Contacts(slug, api_key)
+        # all of the APIs share one session, so there is only one
+        # authorised connection to the nation, and one rate limiter.
+        self.session = NationBuilderSession(slug, api_key, rate_limit,
+                                            retry_policy, person_cache,
+                                            response_cache, person_index,
+                                            json_backend, incremental_json,
+                                            transport, spatial_index)
 
 
 def from_file(filename):
@@ -23,6 +23,8 @@
 Base functionality for the NationBuilder APIs.
 
 Classes:
+    NationBuilderSession
+     -- Connection state (URLs, headers, transport) shared between APIs.
     NationBuilderAPI
      -- Base class of the other APIs.
     NBResponseError(Exception)
@@ -45,20 +47,66 @@ print tags
 """
 
 import logging
-import httplib2
-from oauth2client.client import AccessTokenCredentials
+import re
+import sys
+import threading
+import time
+import urlparse
+from ratelimit import RateLimiter, parse_seconds
+from retry import RetryPolicy
+from jsondecode import get_decoder, decode_page
+from metrics import RequestMetrics
+from pagesize import AUTO, PageSizer
+from transport import Httplib2Transport
 
 log = logging.getLogger('nbpy')
 
 
-class NationBuilderApi(object):
+class NationBuilderSession(object):
+
+    """
+    The connection state for a nation: the URL templates, request headers
+    and the transport that requests are sent with.
+
+    One of these is shared by all of the APIs belonging to a NationBuilder
+    instance, so that the nation is only authorised once and the same
+    (keep-alive) connections are reused for every endpoint.
+    """
+
+    # how many times a request refused with 429 Too Many Requests is tried
+    # again before giving up.
+    MAX_THROTTLED_RETRIES = 5
 
-    def __init__(self, nation_slug, api_key):
+    def __init__(self, nation_slug, api_key, rate_limit=None,
+                 retry_policy=None, person_cache=None, response_cache=None,
+                 person_index=None, json_backend=None,
+                 incremental_json=False, transport=None, spatial_index=None):
         """Create a NationBuilder Connection.
 
         Parameters:
             slug : the nation slug (e.g. foo in foo.nationbuilder.com)
             token : the access token or test token from nationbuilder
+            rate_limit : the maximum number of requests per second to make to
+                the nation, or None to only slow down when the server asks.
+            retry_policy : the nbpy.retry.RetryPolicy deciding which failed
+                requests are retried. Defaults to RetryPolicy().
+            person_cache : an nbpy.cache.LRUCache to keep person reads in, or
+                None to not cache them.
+            response_cache : an nbpy.httpcache.ResponseCache for the
+                responses of the mostly-static endpoints (lists, tags,
+                contact statuses), or None.
+            person_index : an nbpy.lookup.PersonIndex used to find people by
+                email or phone without a request, or None.
+            json_backend : the name of the JSON module used to decode
+                responses ('ujson', 'simplejson' or 'json'), or None for the
+                fastest one installed.
+            incremental_json : decode the records of paginated responses
+                one at a time as they are iterated over, rather than a page
+                at a time.
+            transport : the nbpy.transport.Transport to send requests with.
+                Defaults to an Httplib2Transport.
+            spatial_index : an nbpy.spatial.SpatialIndex that answers
+                nearby queries without walking the API, or None.
         """
         self.NATION_SLUG = nation_slug
         self.ACCESS_TOKEN = api_key
@@ -101,7 +149,173 @@ class NationBuilderApi(object):
             "Accept": "application/json",
             "User-Agent": self.USER_AGENT,
         }
-        self.http = None
+        self._local = threading.local()
+        self.transport = transport or Httplib2Transport()
+        if self.transport.access_token is None:
+            self.transport.access_token = api_key
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.person_cache = person_cache
+        self.response_cache = response_cache
+        self.person_index = person_index
+        self.spatial_index = spatial_index
+        self.json_loads = get_decoder(json_backend)
+        self.incremental_json = incremental_json
+        # chooses the page sizes of per_page='auto' walks.
+        self.page_sizer = PageSizer()
+        self.metrics = RequestMetrics()
+        self.hooks = []
+
+    @property
+    def http(self):
+        """An authorised httplib2 http object, if the session uses the
+        Httplib2Transport, or None (see Httplib2Transport.http)."""
+        return getattr(self.transport, 'http', None)
+
+    def authorise(self):
+        """Prepares the transport for making requests (for the
+        Httplib2Transport, authorises its first http object).
+
+        If this has already been done, does nothing."""
+        self.transport.authorise()
+
+    def add_hook(self, hook):
+        """Adds a function that is called with an event dict for every
+        request and response decode (see nbpy.metrics)."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _emit(self, event):
+        """Records an event in the metrics and passes it to the hooks."""
+        self.metrics.record(event)
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception:
+                log.exception("Request hook %r failed", hook)
+
+    def record_decode(self, seconds):
+        """Records the time taken to decode the body of the calling
+        thread's last response."""
+        self._emit({'type': 'decode', 'seconds': seconds,
+                    'endpoint': getattr(self._local, 'endpoint', None)})
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        """
+        Makes a request to the nation. Takes the same arguments and returns
+        the same (response, content) tuple as httplib2.Http.request().
+
+        All of the APIs make their requests through here, so that they share
+        the rate limiter. Requests refused with 429 Too Many Requests are
+        retried after the server's Retry-After interval, and requests that
+        fail for other transient reasons are retried according to the
+        retry_policy.
+
+        Every request is recorded in the session's metrics and passed to its
+        hooks.
+        """
+        endpoint = endpoint_name(uri)
+        self._local.endpoint = endpoint
+        event = {'type': 'request', 'endpoint': endpoint, 'method': method,
+                 'status': None, 'bytes': 0, 'retries': 0, 'throttled': 0,
+                 'error': None}
+        started = time.time()
+        try:
+            response, content = self._request(uri, method, body, headers,
+                                              event)
+        except Exception as err:
+            exc_info = sys.exc_info()
+            event['error'] = err
+            event['latency'] = time.time() - started
+            self._emit(event)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        event['status'] = response.status
+        event['bytes'] = len(content or '')
+        event['latency'] = time.time() - started
+        self._emit(event)
+        return response, content
+
+    def _request(self, uri, method, body, headers, event):
+        """The retry loop of request(), counting the retries in event."""
+        self.authorise()
+        policy = self.retry_policy
+        throttled = 0
+        failed = 0
+        while True:
+            event['retries'] = failed + throttled
+            event['throttled'] = throttled
+            self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                response, content = self.transport.request(
+                    uri, method=method, body=body, headers=headers)
+            except policy.TRANSIENT_ERRORS as err:
+                failed += 1
+                if not policy.can_retry(method, failed):
+                    raise
+                log.info("%s %s failed (%s), retrying", method, uri, err)
+            else:
+                self.rate_limiter.update(response)
+                if response.status == 429:
+                    throttled += 1
+                    event['throttled'] = throttled
+                    if throttled > self.MAX_THROTTLED_RETRIES:
+                        return response, content
+                    continue
+                failed += 1
+                if not policy.should_retry(method, response.status, failed):
+                    return response, content
+                log.info("%s %s returned %d, retrying", method, uri,
+                         response.status)
+                retry_after = parse_seconds(response.get('retry-after'))
+            policy.record_retry(event['endpoint'])
+            time.sleep(policy.delay(failed, retry_after))
+
+
+def endpoint_name(uri):
+    """
+    Returns the name of the endpoint a request URL belongs to: its path
+    relative to the API root, with IDs and tag names replaced by
+    placeholders. e.g.
+
+    https://foo.nationbuilder.com/api/v1/people/12/taggings/bar?x=1
+    -> /people/{id}/taggings/{tag}
+    """
+    path = urlparse.urlsplit(uri).path
+    path = re.sub(r'^/api/v1', '', path)
+    parts = path.split('/')
+    for i in xrange(1, len(parts)):
+        if parts[i - 1] in ('tags', 'taggings'):
+            parts[i] = '{tag}'
+        elif parts[i].isdigit():
+            parts[i] = '{id}'
+    return '/'.join(parts)
+
+
+class NationBuilderApi(object):
+
+    def __init__(self, nation_slug, api_key, session=None):
+        """Create a NationBuilder Connection.
+
+        Parameters:
+            slug : the nation slug (e.g. foo in foo.nationbuilder.com)
+            token : the access token or test token from nationbuilder
+            session : a NationBuilderSession to share with other APIs. If
+                None, a new one is created for this API.
+        """
+        if session is None:
+            session = NationBuilderSession(nation_slug, api_key)
+        self.session = session
+
+    def __getattr__(self, name):
+        """The URL templates, HEADERS and the transport all live on the
+        (shared) session."""
+        session = self.__dict__.get('session')
+        if session is None:
+            raise AttributeError(name)
+        return getattr(session, name)
 
     def _check_response(self, headers, content, attempted_action, url=None):
         """Log a warning if this is not a 200 OK response,
@@ -122,24 +336,77 @@ class NationBuilderApi(object):
         raise err(msg, header, body, url)
 
     def _authorise(self):
-        """Gets AccessTokenCredentials with the ACCESS_TOKEN and USER_AGENT and
-        authorises a httplib2 http object.
+        """Authorises the session's transport, if that hasn't already been
+        done."""
+        self.session.authorise()
 
-        If this has already been done, does nothing."""
-        if self.http is not None:
-            return
-        assert self.ACCESS_TOKEN is not None
+    def _get_json(self, url, attempted_action, cacheable=False):
+        """
+        GETs url and returns the decoded response body.
+
+        If cacheable is True and the session has a response_cache, the
+        request is made conditional on the cached response's validators, and
+        the cached body is returned if the server says it is unchanged.
+        """
+        cache = self.response_cache if cacheable else None
+        entry = None
+        headers = self.HEADERS
+        if cache is not None:
+            entry = cache.get(url)
+            if entry is not None:
+                headers = dict(headers, **cache.validators(entry))
+        hdr, content = self.session.request(url, headers=headers)
+        if entry is not None and hdr.status == 304:
+            cache.hit(url)
+            return entry['body']
+        self._check_response(hdr, content, attempted_action, url)
+        body = self._decode(content)
+        if cache is not None:
+            cache.put(url, hdr, body)
+        return body
+
+    def _decode(self, content):
+        """Decodes a JSON response body with the session's JSON backend."""
+        started = time.time()
+        body = self.json_loads(content)
+        self.session.record_decode(time.time() - started)
+        return body
+
+    def _decode_page(self, content):
+        """Decodes a page of a paginated endpoint. If the session has
+        incremental_json set, the results of the page are a generator that
+        decodes them one at a time, and only decoding the page metadata is
+        recorded in the metrics."""
+        if not self.incremental_json:
+            return self._decode(content)
+        started = time.time()
+        page = decode_page(content, self.json_loads)
+        self.session.record_decode(time.time() - started)
+        return page
+
+    def _page_sizer(self, per_page, url):
+        """Returns the session's page sizer for the endpoint of url if
+        per_page is 'auto' (see nbpy.pagesize), otherwise None."""
+        if per_page != AUTO:
+            return None
+        return self.page_sizer.for_endpoint(endpoint_name(url))
+
+    def _cache_get(self, key):
+        """Returns the session's cached person data for key, or None."""
+        if self.person_cache is None:
+            return None
+        return self.person_cache.get(key)
 
-        # if cred.user_agent is not none, then it adds appends the
-        # user-agent to the end of the existing user-agent string
-        # each time request() is called...
-        # ...Until you get a "headers too long" error.
-        # so make it None
-        cred = AccessTokenCredentials(self.ACCESS_TOKEN, None)
+    def _cache_put(self, key, value, person_id):
+        """Caches data about the person with person_id, if the session has
+        a person cache."""
+        if self.person_cache is not None:
+            self.person_cache.put(key, value, group=str(person_id))
 
-        # NationBuilder has a lot of problems with their SSL certs...
-        self.http = httplib2.Http(disable_ssl_certificate_validation=True)
-        self.http = cred.authorize(self.http)
+    def _cache_invalidate(self, person_id):
+        """Drops everything cached about a person, as it has changed."""
+        if self.person_cache is not None:
+            self.person_cache.invalidate_group(str(person_id))
 
 
 class NBResponseError(Exception):
@@ -156,9 +423,8 @@ class NBResponseError(Exception):
         self.url = url
         self.header = header
         self.body = body
-        print url
-        print "Header: %s" % header
-        print "Body: %s" % body
+        log.debug("%s failed: %s\nHeader: %s\nBody: %s", url, msg, header,
+                  body)
         Exception.__init__(self, msg)
 
 
@@ -0,0 +1,180 @@
+# nb_async.py ---
+#
+# Filename: nb_async.py
+# Description: Non-blocking access to the NationBuilder APIs.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Non-blocking counterpart of the NationBuilder object.
+
+Every API method of an AsyncNationBuilder returns immediately with a Future
+(from the concurrent.futures module, which on Python 2 is provided by the
+'futures' package) instead of blocking on the request. The requests are run
+on a bounded pool of worker threads, sharing the nation's connections.
+
+The paginated generators (get_people_iter(), get_list_iter()) are not
+wrapped in futures; instead they fetch their pages in the background, so
+the consumer only waits when it gets ahead of the network.
+
+Example usage:
+
+nb = nbpy.nb_async.AsyncNationBuilder("slug", MY_API_KEY, workers=20)
+
+# look up lots of people at once
+futures = [nb.people.get_person(nb_id) for nb_id in ids]
+people = [f.result() for f in futures]
+
+# tag someone without waiting for the response
+nb.tags.tag_person(123, 'volunteer')
+
+nb.shutdown()
+"""
+
+import inspect
+import threading
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+from nationbuilder import NationBuilder
+
+_lazy_lock = threading.Lock()
+
+
+class _LazyAsyncApi(object):
+
+    """
+    An API attribute of AsyncNationBuilder that is only created, along with
+    the NationBuilder API it wraps, when it is first used. As with
+    nationbuilder._LazyApi, it is then stored on the instance.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, async_nation, owner):
+        if async_nation is None:
+            return self
+        with _lazy_lock:
+            api = async_nation.__dict__.get(self.name)
+            if api is None:
+                api = AsyncApi(getattr(async_nation.nation, self.name),
+                               async_nation.executor, async_nation.prefetch)
+                async_nation.__dict__[self.name] = api
+            return api
+
+
+class AsyncNationBuilder(object):
+
+    """
+    Entry point to the nationbuilder APIs, with non-blocking methods.
+
+    Public attributes:
+        people, tags, lists, contacts : wrappers around the corresponding
+            APIs of a NationBuilder instance, whose methods return Futures.
+        nation : the underlying (blocking) NationBuilder instance.
+        prefetch : the number of pages the paginated generators fetch ahead
+            of the consumer.
+
+    Like the NationBuilder APIs, the wrappers are only created when they are
+    first used.
+    """
+
+    people = _LazyAsyncApi('people')
+    tags = _LazyAsyncApi('tags')
+    lists = _LazyAsyncApi('lists')
+    contacts = _LazyAsyncApi('contacts')
+
+    def __init__(self, slug, api_key, workers=10, prefetch=2, nation=None,
+                 rate_limit=None):
+        """
+        Parameters:
+            slug : the nation slug
+            api_key : the api key for the nation
+            workers : the maximum number of requests to run at once.
+            prefetch : the number of pages the paginated generators fetch
+                ahead of the consumer.
+            nation : an existing NationBuilder to wrap. If given, slug,
+                api_key and rate_limit are ignored.
+            rate_limit : the maximum number of requests per second (see
+                NationBuilder).
+        """
+        super(AsyncNationBuilder, self).__init__()
+        if ThreadPoolExecutor is None:
+            raise ImportError("AsyncNationBuilder needs concurrent.futures "
+                              "(pip install futures on Python 2)")
+        self.nation = nation or NationBuilder(slug, api_key, rate_limit)
+        self.executor = ThreadPoolExecutor(workers)
+        self.prefetch = prefetch
+
+    def shutdown(self, wait=True):
+        """Stops the worker threads, optionally waiting for the requests
+        that have already been submitted."""
+        self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class AsyncApi(object):
+
+    """
+    Wraps one of the APIs (People, NBTags, ...) so that calling a method
+    submits it to an executor and returns the Future.
+    """
+
+    def __init__(self, api, executor, prefetch=2):
+        self._api = api
+        self._executor = executor
+        self._prefetch = prefetch
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if name.endswith('_iter'):
+            position = _prefetch_position(attr)
+
+            def start_iter(*args, **kwargs):
+                # unless prefetch was passed, positionally or by name.
+                if position is not None and len(args) <= position:
+                    kwargs.setdefault('prefetch', self._prefetch)
+                return attr(*args, **kwargs)
+            return start_iter
+
+        def submit(*args, **kwargs):
+            return self._executor.submit(attr, *args, **kwargs)
+        return submit
+
+
+def _prefetch_position(method):
+    """Returns the index of a method's prefetch parameter among the
+    positional arguments it is called with, or None if it has none."""
+    try:
+        names = inspect.getargspec(method).args
+    except TypeError:
+        return None
+    if inspect.ismethod(method) and method.__self__ is not None:
+        names = names[1:]
+    if 'prefetch' not in names:
+        return None
+    return names.index('prefetch')
@@ -0,0 +1,231 @@
+# pagesize.py ---
+#
+# Filename: pagesize.py
+# Description: Adaptive page sizes for paginated walks.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Adaptive page sizes for the paginated readers.
+
+Passing per_page=AUTO ('auto') to one of the readers (get_people_iter(),
+Lists.get_list(), search(), ...) makes the walk start at the largest page
+size the API allows, so that it takes the fewest requests, and shrink the
+pages of an endpoint when they come back slowly or time out, growing them
+back once they are fast again. A page that times out is fetched again as
+several smaller pages, so the walk carries on.
+
+The endpoints are paginated by page number, so a walk can only change its
+page size at a record that starts a page of the new size. The page sizes are
+therefore a ladder in which every size divides the next larger one (100,
+50, 25, 5 by default).
+
+Classes:
+    PageSizer
+     -- the page size of each endpoint, shared by the walks of a session
+        (nb.session.page_sizer).
+
+Functions:
+    pages_needed(total, per_page=MAX_PER_PAGE)
+     -- the fewest requests that fetch total records.
+
+Example usage:
+
+nb.session.page_sizer = PageSizer(slow_seconds=2)
+for person in nb.lists.get_list_iter(5, per_page=AUTO, prefetch=4):
+    process(person)
+"""
+
+import logging
+import socket
+import threading
+
+log = logging.getLogger('nbpy')
+
+# the per_page value that makes a walk size its pages adaptively.
+AUTO = 'auto'
+
+# the largest per_page the API accepts.
+MAX_PER_PAGE = 100
+
+# response statuses meaning that the server gave up on a slow page.
+TIMEOUT_STATUSES = (502, 503, 504)
+
+# growing the page size takes at most 2 ** _MAX_BACKOFF times grow_after
+# fast pages.
+_MAX_BACKOFF = 3
+
+
+def pages_needed(total, per_page=MAX_PER_PAGE):
+    """Returns the fewest requests that fetch total records, per_page at a
+    time. Even an empty endpoint takes one request."""
+    return max(1, (total + per_page - 1) // per_page)
+
+
+def _ladder(largest, smallest):
+    """The page sizes from largest down to smallest, each one the largest
+    proper divisor of the one before it."""
+    sizes = [largest]
+    while True:
+        size = sizes[-1]
+        smaller = next((d for d in xrange(size // 2, 0, -1)
+                        if size % d == 0), None)
+        if smaller is None or smaller < smallest:
+            return tuple(sizes)
+        sizes.append(smaller)
+
+
+class PageSizer(object):
+
+    """
+    Keeps the page size of each endpoint, shrinking it a step when a page is
+    slow or times out, and growing it a step after several fast pages in a
+    row. Each time an endpoint's pages have to shrink, it takes twice as
+    many fast pages for them to grow again (up to 8 * grow_after), so an
+    endpoint whose large pages always time out settles on a smaller size.
+    Thread safe.
+
+    Public attributes:
+        sizes : the page sizes, largest first.
+        slow_seconds : pages taking longer than this shrink the page size.
+        grow_after : the number of pages in a row that must take less than
+            half of slow_seconds before the page size first grows.
+    """
+
+    def __init__(self, max_per_page=MAX_PER_PAGE, min_per_page=5,
+                 slow_seconds=10.0, grow_after=3):
+        """
+        Parameters:
+            max_per_page : the page size walks start at.
+            min_per_page : the smallest page size to shrink to.
+            slow_seconds : see above.
+            grow_after : see above.
+        """
+        self.sizes = _ladder(max_per_page, min_per_page)
+        self.slow_seconds = slow_seconds
+        self.grow_after = grow_after
+        # endpoint -> [index into sizes, fast pages in a row, times shrunk]
+        self._state = {}
+        self._lock = threading.Lock()
+
+    @property
+    def max_per_page(self):
+        return self.sizes[0]
+
+    def _get_state(self, endpoint):
+        state = self._state.get(endpoint)
+        if state is None:
+            state = self._state[endpoint] = [0, 0, 0]
+        return state
+
+    def per_page(self, endpoint, position=0):
+        """
+        Returns the page size to fetch the records of endpoint from position
+        (the index of the first record) with: the endpoint's current size,
+        or the largest smaller one that position is a multiple of.
+        """
+        with self._lock:
+            index = self._get_state(endpoint)[0]
+        for size in self.sizes[index:]:
+            if position % size == 0:
+                return size
+        return 1
+
+    def record(self, endpoint, per_page, seconds):
+        """Records that a page of per_page records took seconds to fetch."""
+        with self._lock:
+            state = self._get_state(endpoint)
+            if per_page in self.sizes:
+                index = self.sizes.index(per_page)
+            else:
+                index = len(self.sizes) - 1
+            if seconds > self.slow_seconds:
+                state[1] = 0
+                if index >= state[0] and index + 1 < len(self.sizes):
+                    state[0] = index + 1
+                    state[2] += 1
+                    log.info("Pages of %s took %.1fs, fetching %d at a time",
+                             endpoint, seconds, self.sizes[state[0]])
+            elif seconds < self.slow_seconds / 2 and index <= state[0]:
+                state[1] += 1
+                needed = self.grow_after << min(state[2], _MAX_BACKOFF)
+                if state[1] >= needed and state[0] > 0:
+                    state[0] -= 1
+                    state[1] = 0
+                    log.debug("Pages of %s are fast again, fetching %d at a "
+                              "time", endpoint, self.sizes[state[0]])
+            else:
+                state[1] = 0
+
+    def failed(self, endpoint, per_page, error):
+        """
+        Records that fetching a page of per_page records failed with error.
+        If the error was a timeout and there is a smaller page size, shrinks
+        the endpoint's page size and returns the smaller size to fetch the
+        page's records with. Otherwise returns None.
+        """
+        if not is_timeout(error):
+            return None
+        with self._lock:
+            state = self._get_state(endpoint)
+            state[1] = 0
+            smaller = [i for i, size in enumerate(self.sizes)
+                       if size < per_page]
+            if not smaller:
+                return None
+            if smaller[0] > state[0]:
+                state[0] = smaller[0]
+                state[2] += 1
+            log.info("A page of %d records of %s timed out (%s), fetching "
+                     "%d at a time", per_page, endpoint, error,
+                     self.sizes[state[0]])
+            return self.sizes[smaller[0]]
+
+    def for_endpoint(self, endpoint):
+        """Returns a view of the sizer for one endpoint, as used by
+        nbpy.paging.PageIterator."""
+        return _EndpointSizer(self, endpoint)
+
+
+class _EndpointSizer(object):
+
+    """The methods of a PageSizer, for one endpoint."""
+
+    def __init__(self, sizer, endpoint):
+        self.sizer = sizer
+        self.endpoint = endpoint
+
+    @property
+    def max_per_page(self):
+        return self.sizer.max_per_page
+
+    def per_page(self, position=0):
+        return self.sizer.per_page(self.endpoint, position)
+
+    def record(self, per_page, seconds):
+        self.sizer.record(self.endpoint, per_page, seconds)
+
+    def failed(self, per_page, error):
+        return self.sizer.failed(self.endpoint, per_page, error)
+
+
+def is_timeout(error):
+    """Returns True if error means that a request took too long: a socket
+    timeout, or a response error with one of the TIMEOUT_STATUSES."""
+    if isinstance(error, socket.timeout):
+        return True
+    header = getattr(error, 'header', None)
+    return getattr(header, 'status', None) in TIMEOUT_STATUSES
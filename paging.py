@@ -0,0 +1,378 @@
+# paging.py ---
+#
+# Filename: paging.py
+# Description: Helpers for walking paginated NationBuilder endpoints.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Helpers for walking paginated endpoints.
+
+All of the paginated endpoints return pages that look like
+
+    {"page": 1, "total_pages": 12, "per_page": 100, "total": 1134,
+     "results": [...]}
+
+The functions here take a get_page(page_number) function that fetches and
+decodes one such page, and take care of fetching the rest of the pages once
+total_pages is known.
+
+Functions:
+    iter_pages(get_page, prefetch=0, first_page=1)
+     -- generator yielding the pages in order, optionally fetching up to
+        'prefetch' pages ahead on background threads. The same mechanism is
+        used to fan out the page requests of the methods that return a whole
+        result set (search(), get_list(), etc.) over a bounded number of
+        worker threads.
+    iter_adaptive_pages(get_page, sizer, prefetch=0, position=0)
+     -- like iter_pages(), but with the page size chosen per page by a
+        nbpy.pagesize.PageSizer, and slow pages split into smaller ones.
+
+Classes:
+    PageIterator
+     -- iterator over the records of every page, which knows the total
+        number of records and pages as soon as the first page has arrived,
+        and can save its position to a checkpoint (see nbpy.checkpoint).
+"""
+
+import itertools
+import logging
+import sys
+import threading
+import time
+
+from pagesize import pages_needed
+
+log = logging.getLogger('nbpy')
+
+
+def iter_pages(get_page, prefetch=0, first_page=1):
+    """
+    Yields every page of a paginated endpoint, in page order.
+
+    Parameters:
+        get_page : function taking a page number (starting at 1) and returning
+            the decoded page.
+        prefetch : the number of pages to fetch ahead of the consumer on
+            background threads. 0 (the default) fetches each page only when
+            it is needed.
+        first_page : the page to start at, e.g. to resume a walk.
+
+    The first page is always fetched before anything is yielded, as it holds
+    total_pages.
+    """
+    page = get_page(first_page)
+    yield page
+    pages = xrange(first_page + 1, page['total_pages'] + 1)
+    if prefetch <= 0:
+        for page_no in pages:
+            yield get_page(page_no)
+        return
+    fetcher = _PageFetcher(get_page, pages, prefetch)
+    try:
+        for page_no in pages:
+            yield fetcher.get(page_no)
+    finally:
+        fetcher.stop()
+
+
+def iter_adaptive_pages(get_page, sizer, prefetch=0, position=0):
+    """
+    Yields the pages of a paginated endpoint in order, with page sizes
+    chosen by sizer.
+
+    Parameters:
+        get_page : function taking a page number and a page size, and
+            returning the decoded page.
+        sizer : the PageSizer of the endpoint (see
+            nbpy.pagesize.PageSizer.for_endpoint()).
+        prefetch : the number of pages to fetch ahead, see iter_pages().
+        position : the index of the first record to yield, e.g. to resume a
+            walk.
+
+    The results of the first page start at position. A page that times out
+    is fetched again as pages of the next smaller size, which are yielded as
+    one page.
+    """
+    def fetch(start, size):
+        started = time.time()
+        try:
+            page = get_page(start // size + 1, size)
+        except Exception as err:
+            exc_info = sys.exc_info()
+            smaller = sizer.failed(size, err)
+            if smaller is None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            log.info("Fetching records %d to %d again, %d at a time",
+                     start, start + size - 1, smaller)
+            parts = []
+            for part_start in xrange(start, start + size, smaller):
+                part = fetch(part_start, smaller)
+                parts.append(part)
+                total = part.get('total')
+                if total is not None and part_start + smaller >= total:
+                    break
+            page = dict(parts[0])
+            page['results'] = itertools.chain.from_iterable(
+                part['results'] for part in parts)
+            return page
+        sizer.record(size, time.time() - started)
+        return page
+
+    size = sizer.per_page()
+    first = position - position % size
+    page = fetch(first, size)
+    if first < position:
+        page = dict(page, results=itertools.islice(
+            page['results'], position - first, None))
+    yield page
+    total = page.get('total')
+    if total is None:
+        total = page['total_pages'] * size
+    # the size of each planned page, by the index of its first record.
+    sizes = {}
+
+    def plan():
+        start = first + size
+        while start < total:
+            page_size = sizes[start] = sizer.per_page(start)
+            yield start
+            start += page_size
+
+    if prefetch <= 0:
+        for start in plan():
+            yield fetch(start, sizes.pop(start))
+        return
+    fetcher = _PageFetcher(lambda start: fetch(start, sizes[start]), plan(),
+                           prefetch)
+    try:
+        start = first + size
+        while start < total:
+            yield fetcher.get(start)
+            start += sizes.pop(start)
+    finally:
+        fetcher.stop()
+
+
+class PageIterator(object):
+
+    """
+    Iterates over the results of every page of a paginated endpoint, one
+    page in memory at a time (plus any prefetched ones).
+
+    The total, total_pages and per_page attributes of the endpoint are
+    available as soon as the first page has been fetched; reading one of them
+    before iterating fetches the first page.
+
+    With a checkpoint (see nbpy.checkpoint), the iterator starts from the
+    cursor saved in it, if there is one, and saves its cursor every
+    checkpoint.every pages. The checkpoint is cleared when the iteration
+    finishes.
+
+    With a sizer (see nbpy.pagesize), the pages are fetched with
+    iter_adaptive_pages() and their sizes vary, so the cursor records the
+    position of the walk as the count of records only.
+
+    Public attributes:
+        checkpoint : the nbpy.checkpoint.Checkpoint, or None.
+        resumed_from : the saved cursor the iterator started from, or None.
+        count : the number of records yielded, including those yielded
+            before the walk was resumed.
+        autosave : whether the cursor is saved every checkpoint.every pages
+            and the checkpoint cleared at the end. Consumers that save the
+            cursor themselves (e.g. nbpy.export) turn this off.
+    """
+
+    def __init__(self, get_page, prefetch=0, transform=None,
+                 checkpoint=None, walk=None, sizer=None):
+        """
+        Parameters:
+            get_page : function taking a page number (and, with a sizer, a
+                page size) and returning the decoded page.
+            prefetch : the number of pages to fetch ahead, see iter_pages().
+            transform : optional function applied to each record.
+            checkpoint : optional nbpy.checkpoint.Checkpoint to resume from
+                and save the cursor to.
+            walk : the dict identifying the walk in the cursor (see
+                nbpy.checkpoint.walk_id()). Needed with a checkpoint.
+            sizer : optional PageSizer of the endpoint (see
+                nbpy.pagesize.PageSizer.for_endpoint()) that chooses the page
+                sizes.
+        """
+        self.checkpoint = checkpoint
+        self.resumed_from = None
+        self.count = 0
+        self.autosave = True
+        self._walk = walk or {}
+        self._sizer = sizer
+        self._page = 1
+        self._offset = 0
+        self._pages_done = 0
+        skip = 0
+        if checkpoint is not None:
+            saved = checkpoint.load()
+            if saved is not None:
+                for key, value in self._walk.iteritems():
+                    if saved.get(key) != value:
+                        raise ValueError(
+                            "%s is the checkpoint of a different walk "
+                            "(%s %r, not %r)" % (checkpoint.path, key,
+                                                 saved.get(key), value))
+                self.resumed_from = saved
+                self.count = saved['count']
+                if sizer is None:
+                    self._page = saved['page']
+                    skip = saved['offset']
+        if sizer is None:
+            self._pages = iter_pages(get_page, prefetch, self._page)
+        else:
+            self._pages = iter_adaptive_pages(get_page, sizer, prefetch,
+                                              self.count)
+        self._transform = transform
+        self._results = None
+        self._first = None
+        self._skip = skip
+
+    def _start(self):
+        if self._first is None:
+            self._first = next(self._pages)
+            self._results = iter(self._first['results'])
+            # the records of a resumed page that were already yielded.
+            for _ in xrange(self._skip):
+                next(self._results, None)
+            self._offset = self._skip
+        return self._first
+
+    @property
+    def total(self):
+        """The total number of records."""
+        return self._start().get('total')
+
+    @property
+    def total_pages(self):
+        """The total number of pages. With a sizer, the number of pages of
+        the largest size, i.e. the fewest requests the walk can take."""
+        first = self._start()
+        if self._sizer is None or first.get('total') is None:
+            return first['total_pages']
+        return pages_needed(first['total'], self._sizer.max_per_page)
+
+    @property
+    def per_page(self):
+        """The number of records per page."""
+        return self._start().get('per_page')
+
+    def cursor(self):
+        """
+        Returns the position after the last record yielded, as a dict that
+        can be saved in a checkpoint.
+        """
+        if self._sizer is not None:
+            return dict(self._walk, count=self.count)
+        return dict(self._walk, page=self._page, offset=self._offset,
+                    count=self.count)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self._start()
+        while True:
+            try:
+                record = next(self._results)
+            except StopIteration:
+                try:
+                    page = next(self._pages)
+                except StopIteration:
+                    if self.checkpoint is not None and self.autosave:
+                        self.checkpoint.clear()
+                    raise
+                self._results = iter(page['results'])
+                self._page += 1
+                self._offset = 0
+                self._pages_done += 1
+                if (self.checkpoint is not None and self.autosave
+                        and self._pages_done % self.checkpoint.every == 0):
+                    self.checkpoint.save(self.cursor())
+                continue
+            self._offset += 1
+            self.count += 1
+            if self._transform is not None:
+                record = self._transform(record)
+            return record
+
+    def close(self):
+        """Stops fetching pages, if the iteration isn't finished."""
+        self._pages.close()
+
+
+class _PageFetcher(object):
+
+    """
+    Fetches pages on 'depth' worker threads, never getting more than 'depth'
+    pages ahead of the pages that have been taken with get().
+    """
+
+    def __init__(self, get_page, pages, depth):
+        self._get_page = get_page
+        self._pages = iter(pages)
+        self._depth = depth
+        # one slot per page that is in flight or fetched but not yet taken.
+        self._slots = threading.Semaphore(depth)
+        self._done = threading.Condition()
+        self._results = {}
+        self._stopped = False
+        for _ in xrange(depth):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            self._slots.acquire()
+            with self._done:
+                if self._stopped:
+                    return
+                page_no = next(self._pages, None)
+            if page_no is None:
+                return
+            try:
+                result = (True, self._get_page(page_no))
+            except Exception:
+                result = (False, sys.exc_info())
+            with self._done:
+                self._results[page_no] = result
+                self._done.notify_all()
+
+    def get(self, page_no):
+        """Waits for page page_no, and returns it (or raises whatever
+        exception fetching it raised)."""
+        with self._done:
+            while page_no not in self._results:
+                # wait with a timeout so that KeyboardInterrupt gets through.
+                self._done.wait(1)
+            ok, result = self._results.pop(page_no)
+        self._slots.release()
+        if not ok:
+            raise result[0], result[1], result[2]
+        return result
+
+    def stop(self):
+        """Stops the workers once they have finished their current page."""
+        with self._done:
+            self._stopped = True
+        for _ in xrange(self._depth):
+            self._slots.release()
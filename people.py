@@ -7,9 +7,23 @@ classes:
 
 """
 
-from nb_api import NationBuilderApi
+from nb_api import NationBuilderApi, NBNotFoundError
+from lookup import normalise_email, normalise_phone, EMAIL_FIELDS, \
+    PHONE_FIELDS
+from paging import PageIterator
+from pool import map_concurrently
+from records import projection
+from checkpoint import walk_id
 import urllib2
 import json
+import logging
+import time
+
+log = logging.getLogger('nbpy')
+
+# how far back changed_people_iter() looks before 'since', to allow for clock
+# skew between us and NationBuilder.
+CHANGE_OVERLAP = 300
 
 
 class People(NationBuilderApi):
@@ -20,8 +34,8 @@ class People(NationBuilderApi):
     See http://nationbuilder.com/people_api for info on the data returned
     """
 
-    def __init__(self, slug, token):
-        super(People, self).__init__(slug, token)
+    def __init__(self, slug, token, session=None):
+        super(People, self).__init__(slug, token, session)
 
     def get_person(self, person_id):
         """
@@ -33,13 +47,19 @@ class People(NationBuilderApi):
         Returns:
             A person record, as a dict.
         """
+        cache_key = ('person', str(person_id))
+        person = self._cache_get(cache_key)
+        if person is not None:
+            return person
         self._authorise()
         # we need it as a string...
         person_id = urllib2.quote(str(person_id))
         url = self.GET_PERSON_URL.format(person_id)
-        headers, content = self.http.request(url, headers=self.HEADERS)
+        headers, content = self.session.request(url, headers=self.HEADERS)
         self._check_response(headers, content, "Get Person", url)
-        return json.loads(content)
+        person = self._decode(content)
+        self._cache_put(cache_key, person, person_id)
+        return person
 
     def update_person(self, person_id, update_body):
         """
@@ -67,12 +87,19 @@ class People(NationBuilderApi):
             update_str = update_body
         else:
             update_str = json.dumps(update_body)
-        header, content = self.http.request(url, method="PUT",
-                                            body=update_str,
-                                            headers=self.HEADERS)
+        header, content = self.session.request(url, method="PUT",
+                                               body=update_str,
+                                               headers=self.HEADERS)
         self._check_response(header, content,
                              "Update person with id %d" % person_id, url)
-        return json.loads(content)
+        person = self._decode(content)
+        self._cache_invalidate(person_id)
+        self._cache_put(('person', str(person_id)), person, person_id)
+        if self.person_index is not None:
+            self.person_index.add(person['person'])
+        if self.spatial_index is not None:
+            self.spatial_index.add(person['person'])
+        return person
 
     def create_person(self, person_body):
         """
@@ -101,10 +128,19 @@ class People(NationBuilderApi):
         """
         self._authorise()
         url = self.GET_PEOPLE_URL
-        header, content = self.http.request(uri=url, headers=self.HEADERS,
-                                            method='POST')
+        if isinstance(person_body, str):
+            body = person_body
+        else:
+            body = json.dumps(person_body)
+        header, content = self.session.request(uri=url, headers=self.HEADERS,
+                                               method='POST', body=body)
         self._check_response(header, content, "Create person", url)
-        return json.loads(content)
+        person = self._decode(content)
+        if self.person_index is not None:
+            self.person_index.add(person['person'])
+        if self.spatial_index is not None:
+            self.spatial_index.add(person['person'])
+        return person
 
     def set_recruiter_id(self, person_id, recruiter_id):
         """
@@ -151,23 +187,55 @@ class People(NationBuilderApi):
         'phone', or 'mobile'.
 
         To find people that have non-unique attributes, use search()
+
+        If the session has a person_index, a match by only email, phone or
+        mobile is looked up there, and the record fetched with get_person().
         """
+        cache_key = ('match',) + tuple(sorted(kwargs.items()))
+        person = self._cache_get(cache_key)
+        if person is not None:
+            return person
+        index = self.person_index
+        if index is not None and len(kwargs) == 1:
+            field, value = kwargs.items()[0]
+            nb_id = None
+            if field == 'email':
+                nb_id = index.lookup_email(value)
+                normalise, fields = normalise_email, EMAIL_FIELDS
+            elif field in ('phone', 'mobile'):
+                nb_id = index.lookup_phone(value)
+                normalise, fields = normalise_phone, PHONE_FIELDS
+            if nb_id is not None:
+                person = self._confirm_match(nb_id, normalise, value, fields)
+                if person is not None:
+                    return person
         self._authorise()
         # turn the kwargs into url-style ones. k1=v1&k2=v2...
         keyvals = ['='.join((urllib2.quote(key), urllib2.quote(val)))
                    for key, val in kwargs.iteritems()]
         query_string = '&'.join(keyvals)
         url = self.MATCH_PERSON_URL + query_string
-        hdr, cnt = self.http.request(url, headers=self.HEADERS)
+        hdr, cnt = self.session.request(url, headers=self.HEADERS)
         self._check_response(hdr, cnt, "Match %s" % kwargs, url)
-        return json.loads(cnt)
+        person = self._decode(cnt)
+        if index is not None:
+            index.add(person['person'])
+        self._cache_put(cache_key, person, person['person']['id'])
+        return person
 
-    def search(self, per_page=100, **kwargs):
+    def search(self, per_page=100, workers=0, fields=None, **kwargs):
         """
         Find people that have certain attributes.
 
         Parameters:
-            per_page : the number of people to fetch at a time.
+            per_page : the number of people to fetch at a time, or 'auto'
+                to adapt it to how quickly pages arrive (see nbpy.pagesize).
+            workers : once the number of pages is known, fetch the rest of
+                the pages on this many threads at once. Defaults to 0, which
+                fetches them one after another.
+            fields : a list of field names. If given, the people are
+                returned as namedtuples of just these fields (see
+                nbpy.records), rather than dicts.
             kwargs : attributes to search for. Allowable keys are:
                 first_name, last_name, city, state, sex, birthdate,
                 updated_since, with_mobile, civicrm_id, county_file_id,
@@ -180,44 +248,112 @@ class People(NationBuilderApi):
 
         Returns a list of abbreviated person records.
         """
-        self._authorise()
+        return list(self.search_iter(per_page, workers, fields, **kwargs))
+
+    def search_iter(self, per_page=100, prefetch=0, fields=None,
+                    checkpoint=None, **kwargs):
+        """
+        Iterator version of search(), which only holds a page of results at
+        a time.
+
+        Parameters:
+            per_page : the number of people to fetch at a time.
+            prefetch : the number of pages to fetch in the background ahead
+                of the one being consumed. Defaults to 0.
+            fields : the fields to return, see search().
+            checkpoint : a nbpy.checkpoint.Checkpoint to resume the walk
+                from and save its position to, or None.
+            kwargs : attributes to search for, see search().
+
+        Returns a nbpy.paging.PageIterator of abbreviated person records,
+        whose total and total_pages are known once the first page arrives.
+        """
         keyvals = ['='.join((urllib2.quote(key), urllib2.quote(val)))
                    for key, val in kwargs.iteritems()]
         query = self.SEARCH_PERSON_URL + '&' + '&'.join(keyvals)
 
-        def get_search_page(page):
-            url = query.format(page=page, per_page=per_page)
-            hdr, cnt = self.http.request(uri=url, headers=self.HEADERS)
+        def page_url(page, size=per_page):
+            return query.format(page=page, per_page=size)
+
+        def get_search_page(page, size=per_page):
+            self._authorise()
+            url = page_url(page, size)
+            hdr, cnt = self.session.request(uri=url, headers=self.HEADERS)
             self._check_response(hdr, cnt, "Search %s" % keyvals, url)
-            return json.loads(cnt)
+            return self._decode_page(cnt)
 
-        first_page = get_search_page(1)
-        total_pages = first_page['total_pages']
-        result = first_page['results']
-        for page_no in xrange(2, total_pages + 1):
-            result += get_search_page(page_no)['results']
+        return PageIterator(get_search_page, prefetch, projection(fields),
+                            checkpoint, walk_id(page_url(1), per_page),
+                            self._page_sizer(per_page, page_url(1)))
 
-        return result
+    def changed_people_iter(self, since=None, full=False, prefetch=0,
+                            fields=None):
+        """
+        Walks the people changed since a previous walk, for keeping a local
+        copy of the nation up to date: every person if since is None or
+        full is True, otherwise the people updated since the unix time since
+        (less CHANGE_OVERLAP seconds).
+
+        People deleted from the nation are only left out by a full walk.
+
+        Parameters:
+            since : when the previous walk started, or None.
+            full : walk every person regardless.
+            prefetch, fields : see get_people_iter().
+
+        Returns a nbpy.paging.PageIterator of abbreviated person records.
+        """
+        if full or since is None:
+            return self.get_people_iter(prefetch=prefetch, fields=fields)
+        updated_since = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                      time.gmtime(since - CHANGE_OVERLAP))
+        log.debug("Reading the people updated since %s", updated_since)
+        return self.search_iter(prefetch=prefetch, fields=fields,
+                                updated_since=updated_since)
 
     def get_person_by_email(self, email):
         """Returns the first person that has a given email address.
 
+        If the session has a person_index, the person is looked up there
+        first, and their record fetched with get_person().
+
         Parameters:
             email : the email address to look for.
 
         Returns: A person record or None if no match.
         """
+        cache_key = ('email', email.strip().lower())
+        person = self._cache_get(cache_key)
+        if person is not None:
+            return person
+        index = self.person_index
+        if index is not None:
+            nb_id = index.lookup_email(email)
+            if nb_id is not None:
+                person = self._confirm_match(nb_id, normalise_email, email,
+                                             EMAIL_FIELDS)
+                if person is not None:
+                    return person
+        return self._match_email(email, cache_key)
+
+    def _match_email(self, email, cache_key):
+        """Asks the API for the person with an email address, and adds them
+        to the person index and cache."""
         self._authorise()
         url = self.MATCH_EMAIL_URL.format(urllib2.quote(email))
-        header, content = self.http.request(url, headers=self.HEADERS)
+        header, content = self.session.request(url, headers=self.HEADERS)
         if header.status == 400:
-            if json.loads(content)['code'] == 'no_matches':
+            if self._decode(content)['code'] == 'no_matches':
                 return None
             else:
                 self._check_response(header, content,
                                      "Get person by email", url)
         elif header.status == 200:
-            return json.loads(content)
+            person = self._decode(content)
+            if self.person_index is not None:
+                self.person_index.add(person['person'])
+            self._cache_put(cache_key, person, person['person']['id'])
+            return person
         else:
             self._check_response(header, content, "Get person by email", url)
 
@@ -225,13 +361,127 @@ class People(NationBuilderApi):
         """
         wrapper around get_person_by_email().
 
+        If the session has a person_index, the ID is looked up there first.
+
         Returns: the NB ID or None if not found.
         """
-        person = self.get_person_by_email(email)
+        index = self.person_index
+        if index is not None and not index.confirm:
+            nb_id = index.lookup_email(email)
+            if nb_id is not None:
+                return nb_id
+            cache_key = ('email', email.strip().lower())
+            person = (self._cache_get(cache_key) or
+                      self._match_email(email, cache_key))
+        else:
+            person = self.get_person_by_email(email)
         if person is None:
             return None
         return person['person']['id']
 
+    def _confirm_match(self, nb_id, normalise, value, fields):
+        """Returns the person record of nb_id if one of its fields matches
+        value, otherwise None."""
+        try:
+            person = self.get_person(nb_id)
+        except NBNotFoundError:
+            return None
+        key = normalise(value)
+        for field in fields:
+            if person['person'].get(field) and \
+                    normalise(person['person'][field]) == key:
+                return person
+        return None
+
+    def upsert_person(self, person):
+        """
+        Updates the person with the same email address, or creates them if
+        there is no such person (or no email address).
+
+        Parameters:
+            person : the person's fields, e.g.
+                {"email": "bob@example.com", "first_name": "Bob"}
+
+        If the session has a person_index and the person it knows by that
+        email address no longer exists, they are removed from the index and
+        the person is created.
+
+        Returns:
+            a tuple of ("created" or "updated", the person record)
+        """
+        body = {"person": person}
+        nb_id = None
+        if person.get('email'):
+            nb_id = self.get_id_by_email(person['email'])
+        if nb_id is not None:
+            try:
+                return 'updated', self.update_person(nb_id, body)
+            except NBNotFoundError:
+                if self.person_index is None:
+                    raise
+                log.info("Person %d from the index no longer exists", nb_id)
+                self.person_index.remove(nb_id)
+        return 'created', self.create_person(body)
+
+    def upsert_people(self, people, workers=10, report_every=1000,
+                      progress=None, on_error=None, max_failed=100):
+        """
+        Creates or updates lots of people (see upsert_person()), running up
+        to 'workers' upserts at once.
+
+        people is read lazily, so it can be e.g. a csv.DictReader over a huge
+        file without everything being held in memory. Failed rows don't stop
+        the import; they are counted in the returned report, which keeps the
+        first max_failed of them, and each is passed to on_error, e.g. to
+        write it to a file of rows to fix and load again.
+
+        Parameters:
+            people : an iterable of person field dicts.
+            workers : the number of people to upsert at once.
+            report_every : log the progress every this many rows.
+            progress : optional function called with (rows done, rows per
+                second) every report_every rows.
+            on_error : optional function called with (person, error) for
+                each row that failed.
+            max_failed : the number of failed rows kept in the report, or
+                None to keep them all.
+
+        Returns:
+            a dict like
+            {
+                "created": 120,
+                "updated": 1030,
+                "failed_count": 2,
+                "failed": [(person, NBBadRequestError(...)), ...],
+                "rows_per_second": 45.2
+            }
+        """
+        report = {'created': 0, 'updated': 0, 'failed_count': 0,
+                  'failed': [], 'rows_per_second': 0.0}
+        start = time.time()
+        done = 0
+        for person, result, error in map_concurrently(self.upsert_person,
+                                                      people, workers):
+            done += 1
+            if error is None:
+                report[result[0]] += 1
+            else:
+                report['failed_count'] += 1
+                if (max_failed is None or
+                        len(report['failed']) < max_failed):
+                    report['failed'].append((person, error))
+                if on_error is not None:
+                    on_error(person, error)
+            if done % report_every == 0:
+                rate = done / (time.time() - start)
+                log.info("Upserted %d people (%.1f/s), %d failed", done,
+                         rate, report['failed_count'])
+                if progress is not None:
+                    progress(done, rate)
+        if done:
+            report['rows_per_second'] = done / (time.time() - start)
+        return report
+
     def do_registration(self, nb_id):
         """Causes NB to send the registration email to the person.
 
@@ -242,7 +492,7 @@ class People(NationBuilderApi):
         """
         self._authorise()
         url = self.REGISTER_PERSON_URL.format(urllib2.quote(nb_id))
-        hdr, content = self.http.request(url, headers=self.HEADERS)
+        hdr, content = self.session.request(url, headers=self.HEADERS)
         self._check_response(hdr, content,
                              "Do registration for ID %d" % nb_id, url)
 
@@ -258,83 +508,133 @@ class People(NationBuilderApi):
         """
         self._authorise()
         url = self.GET_PERSON_URL.format(str(nb_id))
-        hdr, cnt = self.http.request(uri=url, method="DELETE",
-                                     headers=self.HEADERS)
+        hdr, cnt = self.session.request(uri=url, method="DELETE",
+                                        headers=self.HEADERS)
         self._check_response(hdr, cnt, "Delete user %d" % nb_id, url)
-
-    def get_people_iter(self, per_page=100):
+        self._cache_invalidate(nb_id)
+        if self.person_index is not None:
+            self.person_index.remove(nb_id)
+        if self.spatial_index is not None:
+            self.spatial_index.remove(nb_id)
+
+    def get_people_iter(self, per_page=100, prefetch=0, fields=None,
+                        checkpoint=None):
         """
         Retrieves all people in the nation.
 
-        This is implemented as a generator function, as the amount of data
-        returned can be pretty big.
+        This returns an iterator rather than a list, as the amount of data
+        returned can be pretty big. The iterator's total and total_pages
+        attributes are known as soon as the first page has arrived.
 
         Parameters:
             per_page : the number of people to fetch at a time.
-                0 < per_page <= 100
+                0 < per_page <= 100, or 'auto' to adapt it to how quickly
+                pages arrive (see nbpy.pagesize).
+            prefetch : the number of pages to fetch in the background ahead
+                of the one being consumed (e.g. 1 to 4). Defaults to 0, which
+                fetches each page only when it is needed.
+            fields : a list of field names. If given, the people are
+                returned as namedtuples of just these fields (see
+                nbpy.records), rather than dicts.
+            checkpoint : a nbpy.checkpoint.Checkpoint to resume the walk
+                from and save its position to, or None.
 
         Note that the returned people records are abbreviated records. To get
         the full record use get_person() with the NB ID from this record.
         """
-        # TODO: it would be nice to fetch the next page asynchronously
-        # before it is needed.
-        def get_people_page(page):
+        def page_url(page, size=per_page):
+            return self.GET_PEOPLE_URL + self.PAGINATE_QUERY.format(
+                page=page, per_page=size)
+
+        def get_people_page(page, size=per_page):
             self._authorise()
-            url = self.GET_PEOPLE_URL + self.PAGINATE_QUERY.format(
-                page=page, per_page=per_page)
-            hdr, cnt = self.http.request(uri=url, headers=self.HEADERS)
+            url = page_url(page, size)
+            hdr, cnt = self.session.request(uri=url, headers=self.HEADERS)
             self._check_response(hdr, cnt, "Get people page %d" % page, url)
-            return json.loads(cnt)
-        # need to get the first page before to see the range
-        page = get_people_page(1)
-        total_pages = page['total_pages']
-        # loop starts at 2 because we already have the first page.
-        for current_page in xrange(2, total_pages + 1):
-            for person in page['results']:
-                yield person
-            page = get_people_page(current_page)
-
-    def get_nearby(self, lat, lng, dist, use_km=False, per_page=100):
+            return self._decode_page(cnt)
+
+        return PageIterator(get_people_page, prefetch, projection(fields),
+                            checkpoint, walk_id(page_url(1), per_page),
+                            self._page_sizer(per_page, page_url(1)))
+
+    def get_nearby(self, lat, lng, dist, use_km=False, per_page=100,
+                   workers=0, fields=None):
         """
         Fetches all people within a radius of dist miles of the
         coordinates (lat,lng).
 
+        If the session has a spatial_index that has been refreshed and keeps
+        the requested fields, the people are found there instead, nearest
+        first.
+
         Parameters:
             lat : latitude of the coordinate in WGS84
             lng : longitude of the coordinate
             dist : radius to search. (default in miles, see use_metric)
             use_km : set to True if dist is in kilometers
-            per_page : number of records to fetch at a time
+            per_page : number of records to fetch at a time, or 'auto'
+                (see nbpy.pagesize).
+            workers : once the number of pages is known, fetch the rest of
+                the pages on this many threads at once. Defaults to 0, which
+                fetches them one after another.
+            fields : a list of field names. If given, the people are
+                returned as namedtuples of just these fields (see
+                nbpy.records), rather than dicts.
 
         Returns:
             a list of people records.
         """
-        self._authorise()
+        return list(self.get_nearby_iter(lat, lng, dist, use_km, per_page,
+                                         workers, fields))
+
+    def get_nearby_iter(self, lat, lng, dist, use_km=False, per_page=100,
+                        prefetch=0, fields=None, checkpoint=None):
+        """
+        Iterator version of get_nearby(), which only holds a page of results
+        at a time.
+
+        Parameters:
+            lat, lng, dist, use_km, per_page, fields : see get_nearby().
+            prefetch : the number of pages to fetch in the background ahead
+                of the one being consumed. Defaults to 0.
+            checkpoint : a nbpy.checkpoint.Checkpoint to resume the walk
+                from and save its position to, or None.
+
+        Returns a nbpy.paging.PageIterator of people records.
+        """
+        index = self.spatial_index
+        if (index is not None and index.last_refresh is not None
+                and index.covers(fields)):
+            people = index.nearby(lat, lng, dist, use_km)
+            page = {'page': 1, 'total_pages': 1, 'per_page': len(people),
+                    'total': len(people), 'results': people}
+            return PageIterator(lambda number: page, 0, projection(fields))
+
         km = 0.621371
         if use_km:
             dist = dist * km
 
-        def get_nearby_page(page):
-            url = self.NEARBY_URL.format(lat=lat, lng=lng, dist=dist,
-                                         per_page=per_page, page=page)
-            hdr, cnt = self.http.request(uri=url, headers=self.HEADERS)
-            self._check_response(hdr, cnt, "Get nearby", url)
-            return json.loads(cnt)
+        def page_url(page, size=per_page):
+            return self.NEARBY_URL.format(lat=lat, lng=lng, dist=dist,
+                                          per_page=size, page=page)
 
-        first_page = get_nearby_page(1)
-        total_pages = first_page['total_pages']
-        result = first_page['results']
-        for p in xrange(2, total_pages + 1):
-            result += get_nearby_page(p)
+        def get_nearby_page(page, size=per_page):
+            self._authorise()
+            url = page_url(page, size)
+            hdr, cnt = self.session.request(uri=url, headers=self.HEADERS)
+            self._check_response(hdr, cnt, "Get nearby", url)
+            return self._decode_page(cnt)
 
-        return result
+        return PageIterator(get_nearby_page, prefetch, projection(fields),
+                            checkpoint, walk_id(page_url(1), per_page),
+                            self._page_sizer(per_page, page_url(1)))
 
     
     def me(self):
         """Fetches the Access token owner's profile"""
         self._authorise()
         url = self.GET_PEOPLE_URL + '/me'
-        hdr, cnt = self.http.request(uri=url, headers=self.HEADERS)
+        hdr, cnt = self.session.request(uri=url, headers=self.HEADERS)
         self._check_response(hdr, cnt, 'Get Me', url)
-        return json.loads(cnt)
+        return self._decode(cnt)
         
@@ -0,0 +1,96 @@
+# pool.py ---
+#
+# Filename: pool.py
+# Description: Running API calls on a bounded number of threads.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Running lots of API calls on a bounded number of threads.
+
+Functions:
+    map_concurrently(func, items, workers=10)
+     -- generator calling func(item) for every item on worker threads, and
+        yielding (item, result, error) tuples as the calls finish.
+"""
+
+import Queue
+import threading
+
+# tells a worker thread to exit.
+_STOP = object()
+
+
+def map_concurrently(func, items, workers=10):
+    """
+    Calls func(item) for each of items on 'workers' threads.
+
+    items is read lazily, and at most 2 * workers items are queued or being
+    worked on at any time, so items can be a generator over a huge input.
+
+    Parameters:
+        func : the function to call.
+        items : an iterable of arguments to call func with.
+        workers : the number of threads to call func on.
+
+    Yields (item, result, error) tuples in the order the calls finish. If
+    func raised an exception, result is None and error is the exception,
+    otherwise error is None.
+    """
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _STOP:
+                return
+            try:
+                results.put((item, func(item), None))
+            except Exception as err:
+                results.put((item, None, err))
+
+    threads = [threading.Thread(target=work) for _ in xrange(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        items = iter(items)
+        in_flight = 0
+        exhausted = False
+        while True:
+            while not exhausted and in_flight < 2 * workers:
+                try:
+                    tasks.put(next(items))
+                    in_flight += 1
+                except StopIteration:
+                    exhausted = True
+            if in_flight == 0:
+                return
+            yield _get(results)
+            in_flight -= 1
+    finally:
+        for _ in threads:
+            tasks.put(_STOP)
+
+
+def _get(queue):
+    """Queue.get() that can be interrupted with Ctrl-C."""
+    while True:
+        try:
+            return queue.get(True, 1)
+        except Queue.Empty:
+            pass
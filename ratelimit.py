@@ -0,0 +1,140 @@
+# ratelimit.py ---
+#
+# Filename: ratelimit.py
+# Description: Client-side rate limiting of NationBuilder API requests.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Client-side rate limiting.
+
+Classes:
+    RateLimiter
+     -- token bucket shared by all of the APIs of a nation, which also backs
+        off when the server answers 429 Too Many Requests or reports that
+        the quota has been used up.
+"""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger('nbpy')
+
+
+class RateLimiter(object):
+
+    """
+    A token bucket that allows up to 'rate' requests per second, with bursts
+    of up to 'burst' requests.
+
+    If rate is None, requests are not limited until the server says so:
+    429 responses (and their Retry-After header) and the
+    X-Ratelimit-Remaining / X-Ratelimit-Reset headers always pause the
+    requests of every thread using the limiter.
+
+    After a 429 the rate is halved, and then creeps back up to the
+    configured rate as requests succeed again.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        """
+        Parameters:
+            rate : the maximum number of requests per second, or None for no
+                limit other than what the server asks for.
+            burst : the number of requests that may be made at once after a
+                quiet period. Defaults to rate (i.e. one second's worth).
+        """
+        if rate is not None:
+            rate = float(rate)
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        # no requests are to be made before this time.
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be made."""
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self._paused_until - now
+                if wait <= 0 and self.rate is None:
+                    return
+                if wait <= 0:
+                    self._tokens = min(self.burst, self._tokens +
+                                       (now - self._last) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stops all requests for the next 'seconds' seconds."""
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     time.time() + seconds)
+
+    def update(self, headers):
+        """
+        Adjusts to a response's headers.
+
+        Parameters:
+            headers : the response headers (a httplib2 Response, or any dict
+                with lower-case keys and a 'status' attribute).
+        """
+        if headers.status == 429:
+            self.throttled(parse_seconds(headers.get('retry-after')))
+            return
+        remaining = parse_seconds(headers.get('x-ratelimit-remaining'))
+        if remaining is not None and remaining <= 0:
+            reset = parse_seconds(headers.get('x-ratelimit-reset'))
+            if reset is not None:
+                # the reset time is a unix timestamp.
+                self.pause(reset - time.time())
+        if self.rate is not None and self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def throttled(self, retry_after=None):
+        """
+        Called when the server refused a request because of the rate limit.
+
+        Parameters:
+            retry_after : how many seconds the server asked us to wait. If
+                None, waits one second.
+        """
+        if retry_after is None:
+            retry_after = 1
+        log.warning("Rate limited by NationBuilder, waiting %.1fs",
+                    retry_after)
+        self.pause(retry_after)
+        if self.rate is not None:
+            with self._lock:
+                self.rate = max(self.rate / 2, 0.1)
+
+
+def parse_seconds(value):
+    """Parses a numeric header value, returning None if it isn't one."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
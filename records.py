@@ -0,0 +1,99 @@
+# records.py ---
+#
+# Filename: records.py
+# Description: Compact representations of person records.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Compact representations of the records returned by the paginated readers.
+
+An abbreviated person record is a dict of a few dozen keys, which adds up
+to several KB per person. Jobs that only need a handful of fields can pass
+fields=[...] to the people readers (search(), get_people_iter(),
+Lists.get_list(), NBTags.get_people_by_tag(), ...), which then return
+namedtuples of just those fields.
+
+Functions:
+    record_type(fields)
+     -- returns the namedtuple class for a list of field names.
+    projection(fields)
+     -- returns a function turning a record dict into such a namedtuple, or
+        None if fields is None.
+    id_array(records)
+     -- packs the ids of records into an array of integers.
+
+Example usage:
+
+people = nb.lists.get_list(5, fields=['id', 'email'])
+people[0].email
+ids = id_array(people)
+"""
+
+from array import array
+from collections import namedtuple
+import threading
+
+# field names -> namedtuple class, so every page shares one class.
+_types = {}
+_types_lock = threading.Lock()
+
+
+def record_type(fields):
+    """
+    Returns the namedtuple class with the given field names. The class is
+    called Record, and is the same for equal lists of fields.
+    """
+    fields = tuple(fields)
+    with _types_lock:
+        cls = _types.get(fields)
+        if cls is None:
+            cls = _types[fields] = namedtuple('Record', fields)
+        return cls
+
+
+def projection(fields):
+    """
+    Returns a function that takes a record dict and returns a namedtuple of
+    the given fields of it. Fields the record doesn't have are None.
+
+    Returns None if fields is None, meaning the records are kept as they
+    are.
+    """
+    if fields is None:
+        return None
+    cls = record_type(fields)
+    fields = cls._fields
+
+    def project(record):
+        return cls._make([record.get(field) for field in fields])
+    return project
+
+
+def id_array(records, typecode='l'):
+    """
+    Returns an array.array of the 'id' of each of records, which may be
+    dicts or namedtuples with an id field. At 8 bytes per id, this is the
+    cheapest way to keep the members of a big list around, e.g. to make a
+    set of them.
+    """
+    ids = array(typecode)
+    for record in records:
+        if isinstance(record, dict):
+            ids.append(record['id'])
+        else:
+            ids.append(record.id)
+    return ids
@@ -0,0 +1,105 @@
+# retry.py ---
+#
+# Filename: retry.py
+# Description: Retrying of failed NationBuilder API requests.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Retrying of requests that failed for transient reasons.
+
+Classes:
+    RetryPolicy
+     -- decides which failed requests are tried again and how long to wait
+        in between, and counts the retries made for each endpoint.
+"""
+
+import httplib
+import random
+import socket
+import threading
+
+
+class RetryPolicy(object):
+
+    """
+    Retries idempotent requests (GET, PUT, DELETE) that fail with a
+    connection error or one of the retry_statuses (by default 502, 503 and
+    504), waiting an exponentially growing, jittered interval in between.
+
+    POST requests (create_person(), log_contact(), ...) are never retried, as
+    the server may have acted on the first attempt.
+
+    The number of retries made for each endpoint is kept in 'retries', a
+    dict of endpoint name (e.g. '/people/{id}/taggings') to count.
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    # errors raised by httplib2 when a connection fails or is reset.
+    TRANSIENT_ERRORS = (socket.error, httplib.HTTPException)
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, jitter=0.5,
+                 retry_statuses=(502, 503, 504)):
+        """
+        Parameters:
+            retries : the maximum number of times to retry a request. 0
+                turns retrying off.
+            backoff : the number of seconds to wait before the first retry.
+                The wait doubles for each following retry.
+            max_backoff : the longest to wait between two attempts.
+            jitter : the fraction (0 to 1) of each wait that is randomised,
+                so that many clients don't all retry at the same moment.
+            retry_statuses : the response statuses that are retried.
+        """
+        self.max_retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.retries = {}
+        self._lock = threading.Lock()
+
+    def can_retry(self, method, attempt):
+        """Returns True if a request with this method may be tried again
+        after 'attempt' failed attempts."""
+        return (attempt <= self.max_retries and
+                method.upper() in self.IDEMPOTENT_METHODS)
+
+    def should_retry(self, method, status, attempt):
+        """Returns True if a response with this status should be retried
+        after 'attempt' failed attempts."""
+        return (status in self.retry_statuses and
+                self.can_retry(method, attempt))
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns the number of seconds to wait before the next attempt.
+
+        Parameters:
+            attempt : the number of attempts that have failed so far.
+            retry_after : the server's Retry-After value, if it sent one.
+        """
+        wait = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        wait -= wait * self.jitter * random.random()
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        return wait
+
+    def record_retry(self, endpoint):
+        """Counts a retry of a request to 'endpoint'."""
+        with self._lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
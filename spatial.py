@@ -0,0 +1,374 @@
+# spatial.py ---
+#
+# Filename: spatial.py
+# Description: Local spatial index of people, for offline nearby queries.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+A local spatial index of people, by the location of their primary address.
+
+When passed to NationBuilder(spatial_index=...), People.get_nearby() and
+get_nearby_iter() are answered from the index, once it has been refreshed,
+instead of walking the nearby endpoint. Distances are great circle
+distances in miles (or km with use_km=True), and the people are returned
+nearest first.
+
+Classes:
+    SpatialIndex
+     -- the index: the people sorted into a grid of cells of cell_size
+        degrees, so a query only looks at the cells its circle overlaps.
+
+Example usage:
+
+index = SpatialIndex('people.geo', fields=['id', 'first_name', 'phone'])
+index.refresh(nb.people)   # full load the first time, incremental later
+index.save()
+nb = nbpy.nationbuilder.NationBuilder("slug", MY_API_KEY,
+                                      spatial_index=index)
+nb.people.get_nearby(39.78, -89.65, 2, fields=['id', 'phone'])
+"""
+
+from array import array
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from storage import atomic_write, read_header, write_header
+
+log = logging.getLogger('nbpy')
+
+# the mean radius of the earth.
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_KM = 0.621371
+
+# the number of people added before they are merged into the arrays.
+_MAX_RECENT = 10000
+
+
+def location(person):
+    """Returns the (lat, lng) of a person record's primary address, or None
+    if it doesn't have one."""
+    address = person.get('primary_address') or {}
+    try:
+        lat = float(address.get('lat'))
+        lng = float(address.get('lng'))
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+class SpatialIndex(object):
+
+    """
+    The locations of a nation's people, and their records.
+
+    The records are kept as JSON, which for abbreviated person records is
+    around 1KB per person; pass fields to keep just the ones the queries
+    need. A query asking for fields the index doesn't have goes to the API.
+
+    Like the other incremental readers, people deleted from the nation are
+    only dropped by a full refresh (or by People.delete_person()).
+
+    Public attributes:
+        path : the file the index is saved to, or None.
+        fields : the record fields kept, or None for whole records.
+        cell_size : the size of the grid cells, in degrees.
+        last_refresh : the unix time of the last refresh, or None.
+    """
+
+    def __init__(self, path=None, fields=None, cell_size=0.1):
+        """
+        Parameters:
+            path : where to save the index. If the file exists, the index is
+                loaded from it.
+            fields : the record fields to keep, see above.
+            cell_size : the size of the grid cells, in degrees. About the
+                typical query radius works well (0.1 degrees of latitude is
+                7 miles).
+        """
+        self.path = path
+        self.fields = list(fields) if fields is not None else None
+        if self.fields is not None and 'id' not in self.fields:
+            self.fields.insert(0, 'id')
+        self.cell_size = cell_size
+        self.last_refresh = None
+        self._columns = int(math.ceil(360 / cell_size))
+        # the merged people, sorted by grid cell.
+        self._cells = array('l')
+        self._ids = array('l')
+        self._lats = array('d')
+        self._lngs = array('d')
+        self._records = []
+        # people added since the arrays were merged: id -> (lat, lng,
+        # record), or None for people that were removed.
+        self._recent = {}
+        # set during a full refresh, whose walk replaces the merged arrays.
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        with self._lock:
+            merged = sum(1 for nb_id in self._ids
+                         if nb_id not in self._recent)
+            return merged + sum(1 for entry in self._recent.itervalues()
+                                if entry is not None)
+
+    def _cell(self, lat, lng):
+        row = int((lat + 90) / self.cell_size)
+        column = min(int((lng + 180) / self.cell_size), self._columns - 1)
+        return row * self._columns + column
+
+    def covers(self, fields):
+        """Returns True if the index keeps all of fields (None meaning the
+        whole record)."""
+        if self.fields is None:
+            return True
+        return fields is not None and set(fields) <= set(self.fields)
+
+    def add(self, person):
+        """Adds a person record, replacing the person's previous location.
+        A person without a location is removed."""
+        if person.get('id') is None:
+            return
+        point = location(person)
+        if point is None:
+            entry = None
+        else:
+            if self.fields is not None:
+                person = dict((field, person.get(field))
+                              for field in self.fields)
+            entry = (point[0], point[1], json.dumps(person))
+        with self._lock:
+            self._recent[person['id']] = entry
+            full = (len(self._recent) >= _MAX_RECENT and
+                    not self._rebuilding)
+        if full:
+            self.compact()
+
+    def remove(self, nb_id):
+        """Removes a person."""
+        with self._lock:
+            self._recent[nb_id] = None
+
+    def compact(self):
+        """Merges the recently added people into the sorted arrays."""
+        with self._lock:
+            if not self._recent:
+                return
+            entries = [(cell, nb_id, lat, lng, record)
+                       for cell, nb_id, lat, lng, record in zip(
+                           self._cells, self._ids, self._lats, self._lngs,
+                           self._records)
+                       if nb_id not in self._recent]
+            for nb_id, entry in self._recent.iteritems():
+                if entry is not None:
+                    lat, lng, record = entry
+                    entries.append((self._cell(lat, lng), nb_id, lat, lng,
+                                    record))
+            entries.sort()
+            self._cells = array('l', (entry[0] for entry in entries))
+            self._ids = array('l', (entry[1] for entry in entries))
+            self._lats = array('d', (entry[2] for entry in entries))
+            self._lngs = array('d', (entry[3] for entry in entries))
+            self._records = [entry[4] for entry in entries]
+            self._recent = {}
+
+    def _ranges(self, lat, lng, miles):
+        """Yields the (start, end) slices of the merged arrays holding the
+        cells within miles of (lat, lng)."""
+        degrees = math.degrees(miles / EARTH_RADIUS_MILES)
+        lat_lo = max(lat - degrees, -90.0)
+        lat_hi = min(lat + degrees, 90.0)
+        widest = max(abs(lat_lo), abs(lat_hi))
+        if widest >= 89.9:
+            spans = [(-180.0, 180.0)]
+        else:
+            lng_degrees = degrees / math.cos(math.radians(widest))
+            lo, hi = lng - lng_degrees, lng + lng_degrees
+            if hi - lo >= 360:
+                spans = [(-180.0, 180.0)]
+            elif lo < -180:
+                spans = [(lo + 360, 180.0), (-180.0, hi)]
+            elif hi > 180:
+                spans = [(lo, 180.0), (-180.0, hi - 360)]
+            else:
+                spans = [(lo, hi)]
+        first_row = self._cell(lat_lo, 0) // self._columns
+        last_row = self._cell(lat_hi, 0) // self._columns
+        for row in xrange(first_row, last_row + 1):
+            base = row * self._columns
+            for lo, hi in spans:
+                first = base + self._cell(0, lo) % self._columns
+                last = base + self._cell(0, hi) % self._columns
+                start = bisect.bisect_left(self._cells, first)
+                end = bisect.bisect_right(self._cells, last, start)
+                if start < end:
+                    yield start, end
+
+    def _search(self, lat, lng, miles):
+        """Returns the (haversine, id, record) of the people within miles
+        of (lat, lng)."""
+        half = min(miles / (2 * EARTH_RADIUS_MILES), math.pi / 2)
+        limit = math.sin(half) ** 2
+        lat1 = math.radians(lat)
+        lng1 = math.radians(lng)
+        cos1 = math.cos(lat1)
+        sin, cos, radians = math.sin, math.cos, math.radians
+
+        def haversine(plat, plng):
+            plat = radians(plat)
+            return (sin((plat - lat1) / 2) ** 2 +
+                    cos1 * cos(plat) * sin((radians(plng) - lng1) / 2) ** 2)
+
+        hits = []
+        with self._lock:
+            recent = self._recent
+            ids, lats, lngs = self._ids, self._lats, self._lngs
+            for start, end in self._ranges(lat, lng, miles):
+                for plat, plng, nb_id, i in zip(
+                        lats[start:end], lngs[start:end], ids[start:end],
+                        xrange(start, end)):
+                    h = haversine(plat, plng)
+                    if h <= limit and nb_id not in recent:
+                        hits.append((h, nb_id, i))
+            hits = [(dist, nb_id, self._records[i])
+                    for dist, nb_id, i in hits]
+            for nb_id, entry in recent.iteritems():
+                if entry is not None:
+                    h = haversine(entry[0], entry[1])
+                    if h <= limit:
+                        hits.append((h, nb_id, entry[2]))
+        hits.sort()
+        return hits
+
+    def nearby_ids(self, lat, lng, dist, use_km=False):
+        """
+        Returns the (distance, id) of each person within dist of (lat, lng),
+        nearest first. dist is in miles, or km if use_km is True, as is the
+        distance returned.
+        """
+        miles = dist * MILES_PER_KM if use_km else dist
+        radius = EARTH_RADIUS_MILES
+        if use_km:
+            radius /= MILES_PER_KM
+        return [(2 * radius * math.asin(math.sqrt(h)), nb_id)
+                for h, nb_id, _ in self._search(lat, lng, miles)]
+
+    def nearby(self, lat, lng, dist, use_km=False):
+        """Returns the records of the people within dist (in miles, or km if
+        use_km is True) of (lat, lng), nearest first."""
+        miles = dist * MILES_PER_KM if use_km else dist
+        return [json.loads(record)
+                for _, _, record in self._search(lat, lng, miles)]
+
+    def refresh(self, people_api, full=False, prefetch=4):
+        """
+        Brings the index up to date from the API.
+
+        The first refresh (or one with full=True) streams every person with
+        get_people_iter() into a new index, which replaces the current one
+        once the walk has finished, so queries made in the meantime (or
+        after the walk failed) are answered from the old one. Later
+        refreshes only read the people updated since the previous refresh.
+
+        Parameters:
+            people_api : the nbpy.people.People API to read from.
+            full : rebuild the index from scratch.
+            prefetch : the number of pages to fetch ahead.
+
+        Returns:
+            the number of people read.
+        """
+        started = time.time()
+        people = people_api.changed_people_iter(self.last_refresh, full,
+                                                prefetch)
+        rebuild = full or self.last_refresh is None
+        if rebuild:
+            # from here on _recent only holds changes made during the walk,
+            # which are kept when the new index is swapped in.
+            self.compact()
+            self._rebuilding = True
+            target = SpatialIndex(fields=self.fields,
+                                  cell_size=self.cell_size)
+        else:
+            target = self
+        try:
+            count = 0
+            for person in people:
+                target.add(person)
+                count += 1
+            if rebuild:
+                target.compact()
+                with self._lock:
+                    self._cells = target._cells
+                    self._ids = target._ids
+                    self._lats = target._lats
+                    self._lngs = target._lngs
+                    self._records = target._records
+        finally:
+            self._rebuilding = False
+        self.compact()
+        self.last_refresh = started
+        log.info("Indexed the locations of %d people in %.1fs", count,
+                 time.time() - started)
+        return count
+
+    def save(self, path=None):
+        """Saves the index to path (default: self.path)."""
+        path = path or self.path
+        self.compact()
+        with self._lock:
+            with atomic_write(path) as out:
+                write_header(out, {
+                    'count': len(self._ids), 'cell_size': self.cell_size,
+                    'fields': self.fields,
+                    'last_refresh': self.last_refresh})
+                for values in (self._cells, self._ids, self._lats,
+                               self._lngs):
+                    values.tofile(out)
+                for record in self._records:
+                    out.write(record + '\n')
+
+    def load(self, path=None):
+        """Loads the index from path (default: self.path)."""
+        path = path or self.path
+        with open(path, 'rb') as saved:
+            header = read_header(saved, path)
+            count = header['count']
+            columns = []
+            for typecode in 'lldd':
+                values = array(typecode)
+                values.fromfile(saved, count)
+                columns.append(values)
+            records = [saved.readline().rstrip('\n')
+                       for _ in xrange(count)]
+        with self._lock:
+            self.cell_size = header['cell_size']
+            self._columns = int(math.ceil(360 / self.cell_size))
+            self.fields = header['fields']
+            self._cells, self._ids, self._lats, self._lngs = columns
+            self._records = records
+            self._recent = {}
+        self.last_refresh = header['last_refresh']
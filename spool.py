@@ -0,0 +1,431 @@
+# spool.py ---
+#
+# Filename: spool.py
+# Description: Write-behind logging of contacts through a durable spool.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Write-behind logging of contacts.
+
+ContactSpool.log_contact() takes the same arguments as
+Contacts.log_contact(), but only appends the contact to a spool file and
+returns. A background thread sends the spooled contacts to the nation in
+batches, through the session's rate limiter, and keeps retrying the ones
+that fail for transient reasons (connection errors, 408, 429 and 5xx
+responses) until they are sent. Contacts the nation refuses outright (e.g.
+404 for an unknown person) are moved to a dead letter file,
+'<path>.failed', from which retry_failed() spools them again.
+
+The spool survives restarts: contacts that were spooled but not sent when
+the process stopped are sent by the next ContactSpool opened on the same
+path. Contacts are sent at least once; one whose response was lost may be
+sent again.
+
+Classes:
+    ContactSpool
+     -- the spool and its sender thread, with counters and a histogram of
+        the time from spooling to sending, exported by stats() and
+        prometheus().
+
+Example usage:
+
+spool = ContactSpool(nb.contacts, 'contacts.spool')
+spool.log_contact(123, 5, 'door_knock', 1058, status='not_interested')
+...
+print spool.prometheus()
+spool.close()
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import BUCKETS
+from pool import map_concurrently
+from retry import RetryPolicy
+from contacts import contact_body
+from storage import atomic_write
+
+log = logging.getLogger('nbpy')
+
+# response statuses that are worth sending a contact again for.
+_TRANSIENT_STATUSES = (408, 429)
+
+
+def is_transient(error):
+    """Returns True if sending a contact failed with error for a reason that
+    may go away: a connection error, or a 408, 429 or 5xx response."""
+    if isinstance(error, RetryPolicy.TRANSIENT_ERRORS):
+        return True
+    status = getattr(getattr(error, 'header', None), 'status', None)
+    return status is not None and (status >= 500 or
+                                   status in _TRANSIENT_STATUSES)
+
+
+def _describe(error):
+    """A short description of why sending a contact failed."""
+    status = getattr(getattr(error, 'header', None), 'status', None)
+    if status is not None:
+        return '%s returned %d' % (error, status)
+    return str(error) or error.__class__.__name__
+
+
+class ContactSpool(object):
+
+    """
+    A durable queue of contacts to log, and the thread that sends them.
+
+    Each contact is a line of JSON in the spool file. How far the sender has
+    got is kept in '<path>.offset', and the spool file is emptied whenever
+    everything in it has been sent. Thread safe.
+
+    Public attributes:
+        path : the spool file.
+        failed_path : the dead letter file.
+        batch_size : the number of contacts read from the spool at a time.
+            The position in the spool is saved once per batch.
+        workers : the number of contacts of a batch sent at once.
+        retry_policy : the RetryPolicy whose delays are waited between
+            attempts to send a contact. Only its backoff is used, as
+            transient failures are retried until they succeed.
+    """
+
+    def __init__(self, contacts, path, batch_size=20, workers=1,
+                 retry_policy=None, sync=True, start=True):
+        """
+        Parameters:
+            contacts : the nbpy.contacts.Contacts API to send with, e.g.
+                nb.contacts.
+            path : the spool file. Contacts left in it are sent.
+            batch_size, workers, retry_policy : see above. retry_policy
+                defaults to the session's.
+            sync : if True, log_contact() only returns once the contact has
+                been written to disk (fsync). False is faster, but contacts
+                can be lost if the machine crashes.
+            start : if True, start sending straight away, otherwise when
+                start() is called.
+        """
+        self.contacts = contacts
+        self.path = path
+        self.failed_path = path + '.failed'
+        self.batch_size = batch_size
+        self.workers = workers
+        self.retry_policy = retry_policy or contacts.session.retry_policy
+        self.sync = sync
+        self._offset_path = path + '.offset'
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self._sending = False
+        # metrics
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_error = None
+        self._buckets = [0] * len(BUCKETS)
+        self._latency = 0.0
+        self._open()
+        if start:
+            self.start()
+
+    def _open(self):
+        """Opens the spool file, dropping a line left half written by a
+        crash, and counts the contacts still to be sent."""
+        self._offset = 0
+        if os.path.exists(self._offset_path):
+            with open(self._offset_path, 'rb') as saved:
+                self._offset = json.load(saved)['offset']
+        self._depth = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r+b') as spool:
+                if self._offset > os.fstat(spool.fileno()).st_size:
+                    # emptied, but the offset wasn't saved.
+                    self._offset = 0
+                spool.seek(self._offset)
+                end = self._offset
+                for line in spool:
+                    if not line.endswith('\n'):
+                        log.warning("Dropping a partly written contact from "
+                                    "%s", self.path)
+                        spool.truncate(end)
+                        break
+                    end += len(line)
+                    self._depth += 1
+        self._file = open(self.path, 'ab')
+
+    def start(self):
+        """Starts the sender thread, if it isn't running."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='nbpy-contact-spool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def depth(self):
+        """The number of contacts waiting to be sent."""
+        return self._depth
+
+    def __len__(self):
+        return self._depth
+
+    def log_contact(self, nb_id, contact_type, contact_method, sender_id,
+                    status=None, broadcaster=None, note=None):
+        """
+        Spools a contact to be logged, and returns as soon as it has been
+        written. Takes the same parameters as Contacts.log_contact().
+        """
+        body = contact_body(contact_type, contact_method, sender_id, status,
+                            broadcaster, note)
+        self._append({'nb_id': nb_id, 'body': body, 'queued': time.time()})
+
+    def _append(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self._cond:
+            self._file.write(line)
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+            self._depth += 1
+            self.queued += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits until every contact spooled so far has been sent (or moved
+        to the dead letter file), or for timeout seconds. Returns True if
+        the spool is empty."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._depth:
+                if deadline is None:
+                    # a timeout keeps the wait interruptible by Ctrl-C.
+                    self._cond.wait(1)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(min(remaining, 1))
+            return not self._depth
+
+    def close(self, timeout=None):
+        """Waits up to timeout seconds for the spool to be sent, then stops
+        the sender. Whatever is left is sent by the next ContactSpool on
+        the same path."""
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            if not self._sending:
+                self._file.close()
+
+    def retry_failed(self):
+        """Spools the contacts in the dead letter file again, and empties
+        it. Returns the number of contacts spooled."""
+        with self._cond:
+            if not os.path.exists(self.failed_path):
+                return 0
+            with open(self.failed_path, 'rb') as failed:
+                entries = [json.loads(line) for line in failed]
+            for entry in entries:
+                entry.pop('error', None)
+                self._append(entry)
+            os.remove(self.failed_path)
+            return len(entries)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._depth and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                self._sending = True
+            try:
+                self._send_batch()
+            except Exception:
+                log.exception("Sending spooled contacts failed")
+                time.sleep(self.retry_policy.max_backoff)
+            finally:
+                with self._cond:
+                    self._sending = False
+
+    def _read_batch(self):
+        """Returns the next batch of entries from the spool, and the offset
+        just past them."""
+        with self._cond:
+            count = min(self.batch_size, self._depth)
+            # a new file object each time, as a buffered one can return
+            # what was in the spool before it was emptied.
+            with open(self.path, 'rb') as spool:
+                spool.seek(self._offset)
+                lines = [spool.readline() for _ in xrange(count)]
+        end = self._offset + sum(len(line) for line in lines)
+        return [json.loads(line) for line in lines], end
+
+    def _send_batch(self):
+        """Sends a batch of spooled contacts, retrying the transient
+        failures, then moves past them in the spool."""
+        entries, end = self._read_batch()
+        pending = entries
+        attempt = 0
+        while pending:
+            retry = []
+            for entry, error in self._send(pending):
+                if error is None:
+                    self._sent(entry)
+                elif is_transient(error):
+                    retry.append(entry)
+                    self.last_error = error
+                else:
+                    self._dead_letter(entry, error)
+            if retry:
+                attempt += 1
+                with self._cond:
+                    self.retries += len(retry)
+                    if self._stopping:
+                        # leave the batch in the spool for next time.
+                        return
+                wait = self.retry_policy.delay(attempt)
+                log.info("Sending %d spooled contacts failed (%s), retrying "
+                         "in %.1fs", len(retry), _describe(self.last_error),
+                         wait)
+                time.sleep(wait)
+            pending = retry
+        self._advance(end, len(entries))
+
+    def _send(self, entries):
+        """Sends entries, yielding (entry, error) pairs, where error is None
+        for the ones that were sent."""
+        def post(entry):
+            self.contacts._post_contact(entry['nb_id'], entry['body'])
+
+        if self.workers <= 1 or len(entries) == 1:
+            for entry in entries:
+                try:
+                    post(entry)
+                except Exception as err:
+                    yield entry, err
+                else:
+                    yield entry, None
+        else:
+            for entry, _, err in map_concurrently(post, entries,
+                                                  self.workers):
+                yield entry, err
+
+    def _sent(self, entry):
+        latency = time.time() - entry['queued']
+        with self._cond:
+            self.sent += 1
+            self._latency += latency
+            for i, bound in enumerate(BUCKETS):
+                if latency <= bound:
+                    self._buckets[i] += 1
+                    break
+
+    def _dead_letter(self, entry, error):
+        log.warning("Contact for person %s was refused (%s), moved to %s",
+                    entry['nb_id'], _describe(error), self.failed_path)
+        entry = dict(entry, error=_describe(error))
+        with self._cond:
+            with open(self.failed_path, 'ab') as failed:
+                failed.write(json.dumps(entry) + '\n')
+                failed.flush()
+                if self.sync:
+                    os.fsync(failed.fileno())
+            self.failed += 1
+            self.last_error = error
+
+    def _advance(self, end, count):
+        """Moves the start of the spool past count sent contacts, ending at
+        end. Empties the spool file if nothing is left in it."""
+        with self._cond:
+            self._depth -= count
+            if self._depth:
+                self._offset = end
+            else:
+                self._file.truncate(0)
+                self._offset = 0
+            self._save_offset()
+            self._cond.notify_all()
+
+    def _save_offset(self):
+        with atomic_write(self._offset_path, self.sync) as out:
+            json.dump({'offset': self._offset}, out)
+
+    def stats(self):
+        """
+        Returns a dict of the spool's metrics: depth, queued, sent, failed
+        and retries (counts), last_error, flush_seconds (the total time from
+        spooling to sending) and buckets, a list of (upper bound, count) of
+        that time.
+        """
+        with self._cond:
+            return {
+                'depth': self._depth,
+                'queued': self.queued,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retries': self.retries,
+                'last_error': self.last_error,
+                'flush_seconds': self._latency,
+                'buckets': zip(BUCKETS, self._buckets),
+            }
+
+    def prometheus(self, prefix='nbpy'):
+        """Returns the metrics in the Prometheus text exposition format."""
+        stats = self.stats()
+        lines = []
+
+        def header(name, kind, text):
+            lines.append('# HELP %s_%s %s' % (prefix, name, text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        header('contact_spool_depth', 'gauge',
+               'Spooled contacts waiting to be sent.')
+        lines.append('%s_contact_spool_depth %d' % (prefix, stats['depth']))
+        header('contact_spool_contacts_total', 'counter',
+               'Contacts spooled, sent and refused.')
+        for result in ('queued', 'sent', 'failed'):
+            lines.append('%s_contact_spool_contacts_total{result="%s"} %d'
+                         % (prefix, result, stats[result]))
+        header('contact_spool_retries_total', 'counter',
+               'Attempts to send a contact that failed and were retried.')
+        lines.append('%s_contact_spool_retries_total %d'
+                     % (prefix, stats['retries']))
+        header('contact_spool_flush_seconds', 'histogram',
+               'Time from spooling a contact to sending it.')
+        cumulative = 0
+        for bound, count in stats['buckets']:
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_contact_spool_flush_seconds_bucket{le="%s"} %d'
+                         % (prefix, le, cumulative))
+        lines.append('%s_contact_spool_flush_seconds_sum %r'
+                     % (prefix, stats['flush_seconds']))
+        lines.append('%s_contact_spool_flush_seconds_count %d'
+                     % (prefix, stats['sent']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,94 @@
+# storage.py ---
+#
+# Filename: storage.py
+# Description: Saving the local indexes and state files.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Helpers for the files that the local indexes, checkpoints and spools are
+saved in.
+
+The indexes (nbpy.lookup, nbpy.membership, nbpy.spatial) are saved as a
+line of JSON, the header, followed by the raw contents of their arrays.
+Arrays of C longs are only readable on a platform with the same size of
+long, which the header records.
+
+Functions:
+    atomic_write(path, sync=True)
+     -- a context manager giving a file that replaces path when it is
+        closed, so readers never see a half written file.
+    write_header(out, header)
+     -- writes an index header.
+    read_header(saved, path)
+     -- reads an index header, checking it was written on this platform.
+
+Example usage:
+
+with atomic_write('people.idx') as out:
+    write_header(out, {'count': len(ids)})
+    ids.tofile(out)
+"""
+
+from array import array
+import contextlib
+import json
+import os
+import tempfile
+
+# the size of the C long arrays the indexes are made of.
+ITEMSIZE = array('l').itemsize
+
+
+@contextlib.contextmanager
+def atomic_write(path, sync=True):
+    """
+    Yields a file, open for writing in binary mode, in the directory of
+    path. When the block finishes the file is flushed, synced to disk (if
+    sync is True) and renamed to path. If the block raises, the file is
+    removed and path is left as it was.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            yield out
+            out.flush()
+            if sync:
+                os.fsync(out.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_header(out, header):
+    """Writes the header of an index file: the dict header, with the size
+    of the arrays' items added."""
+    out.write(json.dumps(dict(header, itemsize=ITEMSIZE)) + '\n')
+
+
+def read_header(saved, path):
+    """Reads the header of the index file saved (opened from path), and
+    raises ValueError if it was written on a platform with a different
+    size of long."""
+    header = json.loads(saved.readline())
+    if header['itemsize'] != ITEMSIZE:
+        raise ValueError("%s was saved on a different platform" % path)
+    return header
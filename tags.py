@@ -25,47 +25,77 @@ People Tags API. See http://nationbuilder.com/people_tags_api for more details.
 
 import urllib2
 from nb_api import NationBuilderApi
+from paging import PageIterator
+from pool import map_concurrently
+from records import projection
+from checkpoint import walk_id
 import json
 
 
 class NBTags(NationBuilderApi):
 
-    def __init__(self, slug, token):
-        super(NBTags, self).__init__(slug, token)
+    def __init__(self, slug, token, session=None):
+        super(NBTags, self).__init__(slug, token, session)
 
-    def get_people_by_tag(self, tag, per_page=100):
+    def get_people_by_tag(self, tag, per_page=100, workers=0, fields=None):
         """
         Get a list of all the people with a tag.
 
         Parameters:
             tag: the tag to look for. Cannot contain '/' characters.
                  The tag is case sensitive.
-            tags_per_page: the number of tags to get at once (default 100)
-                 per_page must be in the range 0 < per_page <= 100
+            per_page: the number of people to get at once (default 100)
+                 per_page must be in the range 0 < per_page <= 100, or
+                 'auto' (see nbpy.pagesize).
+            workers: once the number of pages is known, fetch the rest of
+                 the pages on this many threads at once. Defaults to 0,
+                 which fetches them one after another.
+            fields: a list of field names. If given, the people are
+                 returned as namedtuples of just these fields (see
+                 nbpy.records), rather than dicts.
 
         Returns:
             a list of people records.
         """
-        self._authorise()
-        page = 1
-        url = self.GET_BY_TAG_URL.format(tag=urllib2.quote(str(tag), ''),
-                                         page=page,
-                                         per_page=str(per_page))
-        header, content = self.http.request(url, headers=self.HEADERS)
-        self._check_response(header, content, "Get people by tag", url)
-        content = json.loads(content)
-        people = content['results']
-        num_pages = content['total_pages']
-        while page < num_pages:
-            page += 1
-            url = self.GET_BY_TAG_URL.format(tag=str(tag),
-                                             page=page,
-                                             per_page=str(per_page))
-            header, content = self.http.request(url, headers=self.HEADERS)
+        return list(self.get_people_by_tag_iter(tag, per_page, workers,
+                                                fields))
+
+    def get_people_by_tag_iter(self, tag, per_page=100, prefetch=0,
+                               fields=None, checkpoint=None):
+        """
+        Iterator version of get_people_by_tag(), which only holds a page of
+        people at a time.
+
+        Parameters:
+            tag: the tag to look for.
+            per_page: the number of people to fetch at once (<= 100), or
+                 'auto' to adapt it to how quickly pages arrive (see
+                 nbpy.pagesize).
+            prefetch: the number of pages to fetch in the background ahead
+                 of the one being consumed. Defaults to 0.
+            fields: the fields to return, see get_people_by_tag().
+            checkpoint: a nbpy.checkpoint.Checkpoint to resume the walk
+                 from and save its position to, or None.
+
+        Returns:
+            a nbpy.paging.PageIterator of people records, whose total and
+            total_pages are known once the first page arrives.
+        """
+        def page_url(page, size=per_page):
+            return self.GET_BY_TAG_URL.format(
+                tag=urllib2.quote(str(tag), ''), page=page,
+                per_page=str(size))
+
+        def get_tag_page(page, size=per_page):
+            self._authorise()
+            url = page_url(page, size)
+            header, content = self.session.request(url, headers=self.HEADERS)
             self._check_response(header, content, "Get people by tag", url)
-            content = json.loads(content)
-            people.extend(content['results'])
-        return people
+            return self._decode_page(content)
+
+        return PageIterator(get_tag_page, prefetch, projection(fields),
+                            checkpoint, walk_id(page_url(1), per_page),
+                            self._page_sizer(per_page, page_url(1)))
 
     def get_person_tags(self, person_id):
         """
@@ -77,41 +107,55 @@ class NBTags(NationBuilderApi):
         Returns:
             a (possibly empty) list of tags.
         """
+        cache_key = ('tags', str(person_id))
+        tags = self._cache_get(cache_key)
+        if tags is not None:
+            return tags
         self._authorise()
         url = self.PERSON_TAGS_URL.format(str(person_id))
-        headers, content = self.http.request(url, headers=self.HEADERS)
+        headers, content = self.session.request(url, headers=self.HEADERS)
         self._check_response(headers, content,
                              "Get Person %d Tags" % person_id, url)
-        return json.loads(content)['taggings']
+        tags = self._decode(content)['taggings']
+        self._cache_put(cache_key, tags, person_id)
+        return tags
 
-    def list_tags(self, tags_per_page=100):
+    def list_tags(self, tags_per_page=100, workers=0):
         """
         Show the tags that have been used before in a nation.
         Parameters:
             tags_per_page : how many tags to fetch per call, maximum.
                 Defaults to 100
+            workers : once the number of pages is known, fetch the rest of
+                the pages on this many threads at once. Defaults to 0, which
+                fetches them one after another.
 
         Returns:
             a list of tags.
         """
-        def get_list_tags_page(tags_per_page, page_num):
+        return list(self.list_tags_iter(tags_per_page, workers))
+
+    def list_tags_iter(self, tags_per_page=100, prefetch=0):
+        """
+        Iterator version of list_tags().
+
+        Parameters:
+            tags_per_page : how many tags to fetch per call, maximum.
+            prefetch : the number of pages to fetch in the background ahead
+                of the one being consumed. Defaults to 0.
+
+        Returns:
+            a nbpy.paging.PageIterator of tag names.
+        """
+        def get_list_tags_page(page_num):
             # gets a page of results of the tag list
             self._authorise()
             url = self.LIST_TAGS_URL.format(page=str(page_num),
                                             per_page=str(tags_per_page))
-            header, content = self.http.request(url, headers=self.HEADERS)
-            self._check_response(header, content, "Get tags page", url)
-            return json.loads(content)
-
-        page = get_list_tags_page(tags_per_page, 1)
-        tags = [tag['name'] for tag in page['results']]
-        total_pages = page['total_pages']
-        current_page = page['page']
-        while total_pages > current_page:
-            current_page += 1
-            next_page = get_list_tags_page(tags_per_page, current_page)
-            tags.extend([tag['name'] for tag in next_page['results']])
-        return tags
+            return self._get_json(url, "Get tags page", cacheable=True)
+
+        return PageIterator(get_list_tags_page, prefetch,
+                            lambda tag: tag['name'])
 
     def remove_tag(self, person_id, tag):
         """
@@ -127,11 +171,12 @@ class NBTags(NationBuilderApi):
         self._authorise()
         url = self.REMOVE_TAG_URL.format(urllib2.quote(str(person_id)),
                                          urllib2.quote(str(tag)))
-        hdr, cnt = self.http.request(url, method="DELETE",
-                                     headers=self.HEADERS)
+        hdr, cnt = self.session.request(url, method="DELETE",
+                                        headers=self.HEADERS)
         self._check_response(hdr, cnt,
                              "Remove Tag '%s' from id %d" % (tag, person_id),
                              url)
+        self._cache_invalidate(person_id)
 
     def tag_person(self, nb_id, tag):
         """
@@ -152,11 +197,78 @@ class NBTags(NationBuilderApi):
             "tagging":
             {"tag": urllib2.quote(tag)}
         }
-        hdr, cnt = self.http.request(url, method="PUT",
-                                     headers=self.HEADERS,
-                                     body=json.dumps(body))
+        hdr, cnt = self.session.request(url, method="PUT",
+                                        headers=self.HEADERS,
+                                        body=json.dumps(body))
         self._check_response(hdr, cnt,
                              "Tag %d with '%s'" % (nb_id, tag),
                              url)
-        return json.loads(cnt)
+        self._cache_invalidate(nb_id)
+        return self._decode(cnt)
         # TODO: check that the returned content includes the tag.
+
+    def tag_people(self, ids, tag, members=None, workers=10):
+        """
+        Tags lots of people with a tag, making up to 'workers' requests at
+        once. The requests share the nation's rate limiter.
+
+        Parameters:
+            ids : the NationBuilder IDs of the people to tag.
+            tag : the tag to add.
+            members : the IDs of people that are known to already have the
+                tag, who are skipped. e.g.
+                set(p['id'] for p in tags.get_people_by_tag(tag))
+            workers : the number of requests to make at once.
+
+        Returns:
+            a dict like
+            {
+                "succeeded": [1, 2, 3],
+                "skipped": [4],
+                "failed": {5: NBNotFoundError(...)}
+            }
+        """
+        def skip(nb_id):
+            return members is not None and nb_id in members
+        return self._bulk_tagging(self.tag_person, ids, tag, skip, workers)
+
+    def untag_people(self, ids, tag, members=None, workers=10):
+        """
+        Removes a tag from lots of people, making up to 'workers' requests
+        at once. The requests share the nation's rate limiter.
+
+        Parameters:
+            ids : the NationBuilder IDs of the people to remove the tag from.
+            tag : the tag to remove.
+            members : the IDs of the people known to have the tag. If given,
+                anyone not in it is skipped.
+            workers : the number of requests to make at once.
+
+        Returns:
+            a dict of "succeeded", "skipped" and "failed" IDs, as for
+            tag_people().
+        """
+        def skip(nb_id):
+            return members is not None and nb_id not in members
+        return self._bulk_tagging(self.remove_tag, ids, tag, skip, workers)
+
+    def _bulk_tagging(self, action, ids, tag, skip, workers):
+        """Calls action(nb_id, tag) for each id that skip(nb_id) is false
+        for, and reports which calls succeeded or failed."""
+        report = {'succeeded': [], 'skipped': [], 'failed': {}}
+
+        def to_do():
+            for nb_id in ids:
+                if skip(nb_id):
+                    report['skipped'].append(nb_id)
+                else:
+                    yield nb_id
+
+        results = map_concurrently(lambda nb_id: action(nb_id, tag),
+                                   to_do(), workers)
+        for nb_id, _, error in results:
+            if error is None:
+                report['succeeded'].append(nb_id)
+            else:
+                report['failed'][nb_id] = error
+        return report
@@ -0,0 +1,395 @@
+# transport.py ---
+#
+# Filename: transport.py
+# Description: HTTP transports used by NationBuilderSession.
+# Author: Niklas Rehfeld
+#
+#    Copyright 2014 Niklas Rehfeld
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+The HTTP transports that a NationBuilderSession sends its requests with.
+
+A transport has a request(uri, method, body, headers) method returning a
+(response, content) tuple like httplib2.Http.request(): response has a
+status attribute and maps lower case header names to values. Transports
+raise socket.error or httplib.HTTPException when a request fails without a
+response, which the session's RetryPolicy knows to retry.
+
+Classes:
+    Transport
+     -- base class of the transports.
+    Httplib2Transport
+     -- the default: httplib2.Http objects authorised with oauth2client's
+        AccessTokenCredentials, shared by the threads one request at a time.
+    PooledTransport
+     -- a thread safe pool of keep-alive connections built on httplib, with
+        connect and read timeouts and gzip compressed responses.
+    Response
+     -- the response headers and status returned by PooledTransport.
+
+Example usage:
+
+transport = PooledTransport(pool_size=20, read_timeout=30)
+nb = nbpy.nationbuilder.NationBuilder("slug", MY_API_KEY, transport=transport)
+"""
+
+import errno
+import httplib
+import Queue
+import select
+import socket
+import ssl
+import threading
+import urlparse
+import zlib
+
+from retry import RetryPolicy
+
+
+class Transport(object):
+
+    """
+    Base class of the transports.
+
+    Public attributes:
+        access_token : the NationBuilder API token. If it is None when the
+            transport is given to a session, the session's token is used.
+    """
+
+    def __init__(self, access_token=None):
+        self.access_token = access_token
+
+    def authorise(self):
+        """Prepares the calling thread for making requests. Does nothing by
+        default."""
+        pass
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        """Makes a request, and returns the (response, content) tuple."""
+        raise NotImplementedError
+
+    def close(self):
+        """Closes any open connections."""
+        pass
+
+
+class Httplib2Transport(Transport):
+
+    """
+    Sends requests with httplib2. httplib2.Http objects aren't thread safe,
+    so each request takes an idle one (or makes a new one if they are all
+    busy) and returns it when it is done. Their keep-alive connections are
+    kept for the next request from any thread, so short lived threads, such
+    as the page prefetch workers, don't connect to the server again.
+
+    httplib2 and oauth2client are slow to import, so they are only imported
+    when the first request is made.
+    """
+
+    def __init__(self, access_token=None):
+        Transport.__init__(self, access_token)
+        self._credentials = None
+        # the first http object made, see http.
+        self._http = None
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @property
+    def http(self):
+        """An authorised http object, or None before authorise() is called.
+        It is also used by request(), so it should only be used directly
+        when no other thread is making requests."""
+        return self._http
+
+    def authorise(self):
+        """Gets AccessTokenCredentials with the access token and authorises a
+        first httplib2 http object.
+
+        If this has already been done, does nothing."""
+        if self._credentials is not None:
+            return
+        assert self.access_token is not None
+        from oauth2client.client import AccessTokenCredentials
+
+        with self._lock:
+            if self._credentials is not None:
+                return
+            # if cred.user_agent is not none, then it adds appends the
+            # user-agent to the end of the existing user-agent string
+            # each time request() is called...
+            # ...Until you get a "headers too long" error.
+            # so make it None
+            cred = AccessTokenCredentials(self.access_token, None)
+            self._http = self._authorised_http(cred)
+            self._idle.put(self._http)
+            self._credentials = cred
+
+    def _authorised_http(self, cred):
+        import httplib2
+
+        # NationBuilder has a lot of problems with their SSL certs...
+        http = httplib2.Http(disable_ssl_certificate_validation=True)
+        return cred.authorize(http)
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        self.authorise()
+        try:
+            http = self._idle.get_nowait()
+        except Queue.Empty:
+            http = self._authorised_http(self._credentials)
+        try:
+            return http.request(uri, method=method, body=body,
+                                headers=headers)
+        finally:
+            self._idle.put(http)
+
+    def close(self):
+        while True:
+            try:
+                http = self._idle.get_nowait()
+            except Queue.Empty:
+                return
+            for conn in http.connections.values():
+                conn.close()
+
+
+class Response(dict):
+
+    """
+    The headers of a response, keyed by lower case name, with the status
+    code in the status attribute (and, like httplib2, under 'status').
+    """
+
+    def __init__(self, status, reason, headers):
+        dict.__init__(self, headers)
+        self.status = status
+        self.reason = reason
+        self['status'] = str(status)
+
+
+class PooledTransport(Transport):
+
+    """
+    Sends requests over a pool of keep-alive connections, shared by all
+    threads.
+
+    Up to pool_size connections are opened per host; a thread that needs a
+    connection while all of them are busy waits for one to be returned.
+
+    A request is only sent again on a new connection if the server had
+    closed the reused one without acting on it (see _stale()); anything
+    else, including a read timeout, is left to the session's RetryPolicy,
+    which never retries POSTs.
+    """
+
+    def __init__(self, access_token=None, pool_size=10, connect_timeout=10,
+                 read_timeout=60, gzip=True,
+                 disable_ssl_certificate_validation=True):
+        """
+        Parameters:
+            access_token : the API token, see Transport.
+            pool_size : the maximum number of connections per host.
+            connect_timeout : seconds to wait for a connection to be made.
+            read_timeout : seconds to wait for the server to send data.
+            gzip : ask for gzip compressed responses.
+            disable_ssl_certificate_validation : don't check the server's
+                certificate, as the httplib2 transport doesn't.
+        """
+        Transport.__init__(self, access_token)
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.gzip = gzip
+        self.validate_certificates = not disable_ssl_certificate_validation
+        # (scheme, host, port) -> _Pool
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = _Pool(self, scheme, host, port)
+            return pool
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        parts = urlparse.urlsplit(uri)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        headers['Authorization'] = 'Bearer %s' % self.access_token
+        if self.gzip:
+            headers['Accept-Encoding'] = 'gzip'
+        pool = self._pool(parts.scheme, parts.hostname, parts.port)
+
+        conn, reused = pool.get()
+        try:
+            if reused and conn.dropped():
+                # the server closed the idle connection; use a new one.
+                conn.close()
+                reused = False
+            try:
+                response = _send(conn, method, path, body, headers)
+            except (socket.error, httplib.HTTPException) as err:
+                if not (reused and _stale(err, method)):
+                    raise
+                conn.close()
+                response = _send(conn, method, path, body, headers)
+            content = response.read()
+        except Exception:
+            conn.close()
+            pool.put(conn)
+            raise
+        if response.will_close:
+            conn.close()
+        pool.put(conn)
+
+        result = Response(response.status, response.reason,
+                          response.getheaders())
+        if result.get('content-encoding') == 'gzip':
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            # like httplib2, so that content-length doesn't mislead.
+            result['-content-encoding'] = result.pop('content-encoding')
+        return result, content
+
+    def close(self):
+        with self._lock:
+            pools = self._pools.values()
+            self._pools = {}
+        for pool in pools:
+            pool.close()
+
+
+def _send(conn, method, path, body, headers):
+    try:
+        conn.request(method, path, body, headers)
+    except socket.error as err:
+        if err.errno in (errno.ECONNRESET, errno.EPIPE):
+            raise _SendError(err)
+        raise
+    return conn.getresponse()
+
+
+class _SendError(socket.error):
+
+    """The connection was reset or closed while the request was being
+    sent, before any of the response arrived."""
+
+    def __init__(self, err):
+        socket.error.__init__(self, err.errno, err.strerror)
+
+
+def _stale(error, method):
+    """
+    Returns True if a request on a reused connection that failed with error
+    can be sent again on a new one, because the server had closed the
+    connection rather than acted on the request: the connection was reset
+    while sending, or, for idempotent methods, closed without any response.
+
+    Timeouts are never resent, as the server has usually got the request.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, _SendError):
+        return True
+    return (isinstance(error, httplib.BadStatusLine) and
+            method.upper() in RetryPolicy.IDEMPOTENT_METHODS)
+
+
+class _Pool(object):
+
+    """The connections to one host. Connections are handed out most
+    recently used first, so idle ones can be closed by the server without
+    being needed again."""
+
+    def __init__(self, transport, scheme, host, port):
+        self.transport = transport
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.Semaphore(transport.pool_size)
+
+    def _connect(self):
+        transport = self.transport
+        if self.scheme == 'https':
+            kwargs = {}
+            if not transport.validate_certificates and hasattr(
+                    ssl, '_create_unverified_context'):
+                kwargs['context'] = ssl._create_unverified_context()
+            conn = httplib.HTTPSConnection(
+                self.host, self.port, timeout=transport.connect_timeout,
+                **kwargs)
+        else:
+            conn = httplib.HTTPConnection(
+                self.host, self.port, timeout=transport.connect_timeout)
+        return _TimeoutConnection(conn, transport.read_timeout)
+
+    def get(self):
+        """Returns an idle connection, or a new one if there are fewer than
+        pool_size, and whether it has been used before."""
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait(), True
+        except Queue.Empty:
+            return self._connect(), False
+
+    def put(self, conn):
+        self._idle.put(conn)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+class _TimeoutConnection(object):
+
+    """Wraps a httplib connection, switching the socket from the connect
+    timeout to the read timeout once it is connected."""
+
+    def __init__(self, conn, read_timeout):
+        self._conn = conn
+        self._read_timeout = read_timeout
+
+    def request(self, method, path, body, headers):
+        conn = self._conn
+        if conn.sock is None:
+            conn.connect()
+            conn.sock.settimeout(self._read_timeout)
+        conn.request(method, path, body, headers)
+
+    def getresponse(self):
+        return self._conn.getresponse()
+
+    def dropped(self):
+        """Returns True if the server has closed the connection while it
+        was idle: an idle keep-alive connection has nothing to read, unless
+        it is the end of the stream."""
+        sock = self._conn.sock
+        if sock is None:
+            return False
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def close(self):
+        self._conn.close()